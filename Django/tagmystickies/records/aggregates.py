@@ -0,0 +1,20 @@
+from django.db.models import Aggregate, CharField, Value
+
+'''
+Database functions that django doesn't come with.
+'''
+
+
+class GroupConcat(Aggregate):
+    '''
+    Joins all the grouped values into one comma separated string (GROUP_CONCAT on sqlite, STRING_AGG on postgres).
+    Only use it on values that can't contain commas themselves, like tags.
+    '''
+    function = 'GROUP_CONCAT'
+    output_field = CharField()
+
+    def __init__(self, expression, **extra):
+        super().__init__(expression, Value(','), **extra)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, function='STRING_AGG', **extra_context)
@@ -0,0 +1,155 @@
+import json
+from django.views import View
+from .filtering import AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_MAX_LIMIT, MATCH_ALL, StickerQuery, autocomplete_queryset, page_from_matches, page_response, sticker_queryset
+from .fuzzy import aexpand_from_database
+from .inline_snapshots import asnapshot_page, snapshot_tag
+from .models import UserEntry
+from .serializers import UserEntrySerializer
+from .tag_index import tag_index, tag_index_enabled
+from .response_cache import filter_cache
+from .renderers import json_response
+from .throttling import athrottle
+from .write_behind import asee_pending_writes
+
+'''
+Async versions of the read endpoints that the bot hits on every inline query.
+
+We run under hypercorn (ASGI), where every rest framework view gets handed to a thread and keeps it until the
+response is done. These views are plain django async views instead, so they run right on the event loop.
+When the tag index is on and the user is cached, an inline query never leaves the event loop at all.
+Database work goes through django's async ORM (afirst, async for, ...).
+
+They're served next to the sync views under records/async/ and give the same responses as them.
+Run python manage.py inline_bench to compare the two.
+'''
+
+
+class AsyncAPIView(View):
+    '''
+    Base class for the async views. Like rest framework's APIView, these skip CSRF because the API doesn't use sessions.
+    '''
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True
+        return view
+
+    def parse(self, request):
+        '''
+        reads the request body the way rest framework's JSON and form parsers would
+        '''
+        if request.content_type == 'application/json':
+            return json.loads(request.body or b'{}')
+        return request.POST
+
+
+async def get_user_entry(user):
+    '''
+    The async version of get_object_or_404(UserEntry, user=user). Returns None instead of raising.
+    '''
+    try:
+        return await UserEntry.objects.filter(user=user).afirst()
+    except (TypeError, ValueError):
+        return None
+
+
+def not_found():
+    return json_response({"detail": "No UserEntry matches the given query."}, status=404)
+
+
+class AsyncUserEntryDetail(AsyncAPIView):
+    '''
+    Displays a single, specific user entry. The async version of UserEntryDetail's GET.
+    '''
+
+    async def get(self, request, pk):
+        usr = await get_user_entry(pk)
+        if usr is None:
+            return not_found()
+        return json_response(UserEntrySerializer(usr).data)
+
+
+class AsyncFilterStickersView(AsyncAPIView):
+    '''
+    The async version of FilterStickersView, takes the same POST body and gives the same response.
+    Example: {"user": 1234, "tags": ["cat", "happy"], "match": "all", "offset": ""}
+    '''
+
+    async def post(self, request):
+        try:
+            data = self.parse(request)
+        except ValueError as e:
+            return json_response({"detail": f"JSON parse error - {e}"}, status=400)
+        try:
+            user = int(data.get("user", None))
+        except (TypeError, ValueError):
+            return not_found()
+        # the same limits as the sync views, see records/throttling.py
+        throttled = await athrottle(request, 'filter', user)
+        if throttled is not None:
+            return throttled
+        await asee_pending_writes(user)
+        # a user who's cached in the tag index has to exist (deleting them throws them out of it),
+        # so for them the whole request is answered without a trip to the database
+        in_memory = tag_index_enabled() and user in tag_index
+        cache_key = None
+        if not in_memory:
+            # the response cache is only worth the trip for queries that would go to the database
+            cache_key = await filter_cache.akey_for(data)
+            body = await filter_cache.aget(cache_key)
+            if body is not None:
+                return json_response(body)
+            if await get_user_entry(user) is None:
+                return not_found()
+
+        try:
+            query = StickerQuery.from_data(user, data)
+            if query.fuzzy:
+                query.matched_tags = await tag_index.aexpand(query.user, query.tags) if tag_index_enabled() \
+                    else await aexpand_from_database(query.user, query.tags)
+
+            if tag_index_enabled():
+                matches = await tag_index.amatch(
+                    query.user, query.terms, query.exclude_tags, match_all=query.match == MATCH_ALL, prefix=query.prefix,
+                    expression=query.expression)
+                rows = page_from_matches(query, matches, await tag_index.ascores(query.user))
+            elif (tag := snapshot_tag(query)) is not None:
+                rows = await asnapshot_page(query, tag)
+            else:
+                rows = [row async for row in sticker_queryset(query)]
+
+            body = page_response(query, rows)
+            await filter_cache.aset(cache_key, body)
+            return json_response(body)
+        except Exception as e:
+            return json_response({"error": str(e)}, status=400)
+
+
+class AsyncTagAutocompleteView(AsyncAPIView):
+    '''
+    The async version of TagAutocompleteView.
+    e.g. records/async/tags/autocomplete/1234/?prefix=ha gives {"tags": [{"tag": "happy", "count": 12}, {"tag": "hat", "count": 3}]}
+    '''
+
+    async def get(self, request, user):
+        throttled = await athrottle(request, 'filter', user)
+        if throttled is not None:
+            return throttled
+        await asee_pending_writes(user)
+        if not (tag_index_enabled() and user in tag_index) and await get_user_entry(user) is None:
+            return not_found()
+        prefix = request.GET.get('prefix', '').lower().strip()
+        try:
+            limit = min(int(request.GET.get(
+                'limit', AUTOCOMPLETE_LIMIT)), AUTOCOMPLETE_MAX_LIMIT)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return json_response({"error": "limit must be a positive integer."}, status=400)
+
+        if tag_index_enabled():
+            tags = await tag_index.aautocomplete(user, prefix, limit)
+        else:
+            tags = [row async for row in autocomplete_queryset(user, prefix, limit)]
+        return json_response({"tags": [{"tag": tag, "count": count} for tag, count in tags]})
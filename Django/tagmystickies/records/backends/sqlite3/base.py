@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+'''
+django's sqlite backend, with transactions that start the way SQLITE_TRANSACTION_MODE in settings.py says.
+
+django starts every transaction with a plain BEGIN, which is DEFERRED: the transaction only asks for the write lock
+at its first write. If another connection is writing by then, sqlite can't wait for it the way busy_timeout waits,
+because the transaction may already have read something the other write is about to change, so the write fails with
+"database is locked" right away. With IMMEDIATE the transaction takes the write lock when it starts, before it reads
+anything, so it waits for the other writer like any single statement does.
+'''
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f'BEGIN {settings.SQLITE_TRANSACTION_MODE}')
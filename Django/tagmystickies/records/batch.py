@@ -0,0 +1,117 @@
+import json
+import threading
+from urllib.parse import urlsplit
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.db import transaction
+from django.test import RequestFactory
+from django.urls import Resolver404, resolve
+
+'''
+Runs a list of requests to the other records endpoints in one database transaction, for /records/batch/.
+
+The bot usually makes a few calls in a row for one interaction (look the user up, patch their status, tag a sticker,
+...). Sending them as one batch saves the round trips, and either all of them happen or none of them do.
+
+Every operation is {"method": "PATCH", "path": "/records/user-entries/1234/", "body": {...}} and gets run by the same
+view that would answer it on its own, so it behaves exactly the same. Operations run in order, and the first one that
+fails (a 4xx or 5xx status) rolls back everything before it and stops the batch.
+'''
+
+# the most operations one batch can have
+MAX_OPERATIONS = 50
+METHODS = {'GET', 'POST', 'PUT', 'PATCH', 'DELETE'}
+
+# builds the sub requests, it's only used for building requests and never touches the test client machinery
+factory = RequestFactory()
+# whether this thread is running a batch right now
+state = threading.local()
+
+
+class OperationFailed(Exception):
+    '''
+    Raised inside the transaction to roll it back
+    '''
+
+
+def clean_operations(operations):
+    '''
+    Returns the error message for a malformed list of operations, or None if it's fine
+    '''
+    if not isinstance(operations, list) or not operations:
+        return 'operations must be a non-empty list.'
+    if len(operations) > MAX_OPERATIONS:
+        return f'a batch can have at most {MAX_OPERATIONS} operations.'
+    for i, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            return f'operation {i} must be an object.'
+        if str(operation.get('method', '')).upper() not in METHODS:
+            return f'operation {i} has an unsupported method, use one of {", ".join(sorted(METHODS))}.'
+        if not isinstance(operation.get('path', None), str) or not operation['path'].startswith('/records/'):
+            return f'operation {i} needs a path to a /records/ endpoint.'
+    return None
+
+
+def response_body(response):
+    if hasattr(response, 'render') and not response.is_rendered:
+        response.render()
+    content = b''.join(response.streaming_content) if response.streaming else response.content
+    if not content:
+        return None
+    try:
+        return json.loads(content)
+    except ValueError:
+        return content.decode(errors='replace')
+
+
+def run_operation(operation, host, secure=False):
+    '''
+    Runs one operation through the view its path resolves to. Returns (status, body).
+    host and secure are the batch request's, so links the views build (like pagination's "next") point at this server.
+    '''
+    path = operation['path']
+    try:
+        match = resolve(urlsplit(path).path)
+    except Resolver404:
+        return 404, {"detail": f"No endpoint matches {path}."}
+    if match.url_name == 'batch':
+        return 400, {"detail": "Batches can't be nested."}
+
+    body = operation.get('body', None)
+    sub_request = factory.generic(
+        operation['method'].upper(), path, b'' if body is None else json.dumps(body).encode(),
+        content_type='application/json', secure=secure, HTTP_HOST=host)
+    sub_request.resolver_match = match
+    # the request that brought the operation in was rate limited already, see records/throttling.py
+    sub_request.internal = True
+    view = match.func
+    if iscoroutinefunction(view):
+        # the async views' database calls come back to this thread, so they run inside the batch's transaction too
+        view = async_to_sync(view)
+    response = view(sub_request, *match.args, **match.kwargs)
+    return response.status_code, response_body(response)
+
+
+def in_batch():
+    return getattr(state, 'running', False)
+
+
+def run_batch(request, operations):
+    '''
+    Runs the operations in one transaction. Returns the result of every operation that ran and whether the
+    transaction was committed.
+    '''
+    results = []
+    host, secure = request.get_host(), request.is_secure()
+    state.running = True
+    try:
+        with transaction.atomic():
+            for operation in operations:
+                status, body = run_operation(operation, host, secure)
+                results.append({"status": status, "body": body})
+                if status >= 400:
+                    raise OperationFailed()
+    except OperationFailed:
+        return results, False
+    finally:
+        state.running = False
+    return results, True
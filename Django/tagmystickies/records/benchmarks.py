@@ -0,0 +1,85 @@
+import random
+from records import tag_stats
+from records.models import Sticker, StickerTagEntry, UserEntry
+from records.response_cache import filter_cache
+
+'''
+Shared pieces of the benchmark commands (python manage.py bench and python manage.py inline_bench):
+seeding a realistic dataset and summarizing latencies.
+
+Tag popularity follows a Zipf distribution like real tags do: a handful of tags ("cat", "happy", ...) are on a big
+share of the stickers and there's a long tail of tags that are only used a few times.
+'''
+
+INSERT_BATCH_SIZE = 500
+
+
+def zipf_weights(size, exponent):
+    # the weight of the tag at rank r is 1 / r^exponent
+    return [1 / rank ** exponent for rank in range(1, size + 1)]
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(percent / 100 * (len(values) - 1)))]
+
+
+class Dataset:
+    '''
+    What got seeded, plus a random generator to pick users, stickers and tags from it
+    '''
+
+    def __init__(self, users, stickers, vocabulary, exponent, seed):
+        self.users = users  # list of user ids
+        self.stickers = stickers  # user id -> list of that user's stickers
+        self.vocabulary = vocabulary  # tags, most popular first
+        self.weights = zipf_weights(len(vocabulary), exponent)
+        self.rng = random.Random(seed)
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def sticker(self, user):
+        return self.rng.choice(self.stickers[user])
+
+    def tags(self, count):
+        '''
+        count tags picked by popularity (there can be repeats, like a user typing the same tag twice)
+        '''
+        return self.rng.choices(self.vocabulary, self.weights, k=count)
+
+
+def seed_dataset(users, stickers_per_user, tags, tags_per_sticker, exponent=1.1, seed=0, first_user=1):
+    '''
+    Creates users users with stickers_per_user stickers each, every sticker tagged with up to tags_per_sticker tags
+    out of a vocabulary of tags tags. Users share stickers out of a common pool, like popular sticker sets in telegram.
+    '''
+    rng = random.Random(seed)
+    vocabulary = [f'tag{i}' for i in range(tags)]
+    weights = zipf_weights(tags, exponent)
+    user_ids = list(range(first_user, first_user + users))
+    pool = [f'sticker{i:07}' for i in range(max(stickers_per_user, users * stickers_per_user // 2))]
+
+    UserEntry.objects.bulk_create(
+        [UserEntry(user=user, chat=user) for user in user_ids], batch_size=INSERT_BATCH_SIZE)
+    Sticker.objects.bulk_create(
+        [Sticker(sticker=sticker, file_id=f'file_{sticker}', set_name=f'set{i // 50}') for i, sticker in enumerate(pool)],
+        batch_size=INSERT_BATCH_SIZE)
+
+    stickers = {}
+    entries = []
+    for user in user_ids:
+        stickers[user] = sorted(rng.sample(pool, stickers_per_user))
+        for sticker in stickers[user]:
+            for tag in set(rng.choices(vocabulary, weights, k=tags_per_sticker)):
+                entries.append(StickerTagEntry(user_id=user, sticker=sticker, tag=tag))
+            if len(entries) >= INSERT_BATCH_SIZE * 10:
+                StickerTagEntry.objects.bulk_create(entries, batch_size=INSERT_BATCH_SIZE)
+                entries = []
+        # bulk_create doesn't send signals, so make sure nothing cached from an earlier run can match these users
+        filter_cache.invalidate(user)
+    StickerTagEntry.objects.bulk_create(entries, batch_size=INSERT_BATCH_SIZE)
+    # bulk_create doesn't count the tags either
+    tag_stats.rebuild(user_ids)
+
+    return Dataset(user_ids, stickers, vocabulary, exponent, seed)
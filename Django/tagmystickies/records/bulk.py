@@ -0,0 +1,233 @@
+import re
+from collections import Counter
+from django.db import connection, transaction
+from django.db.models import Count
+from django.db.models.constants import OnConflict
+from records.models import Sticker, StickerTagEntry
+from records.signals import notify_tags_changed
+from records import tag_stats
+
+'''
+Bulk tagging for the views that tag lots of stickers at once (MultiStickerView, MassTagReplaceView, ...).
+
+Instead of running a serializer per sticker/tag pair, the whole payload gets validated in one go, the pairs that
+already exist are found with one query, and everything else gets inserted a few hundred rows per INSERT in a single
+transaction.
+'''
+
+# how many stickers go into a single "sticker IN (...)" lookup, so we stay under sqlite's variable limit
+LOOKUP_BATCH_SIZE = 500
+# how many rows go into a single INSERT
+INSERT_BATCH_SIZE = 500
+
+MAX_LENGTH = StickerTagEntry._meta.get_field('tag').max_length
+# matches any of the characters tags can't have, one regex search is a lot faster than checking them one by one
+SPECIAL_CHARS = re.compile('[' + re.escape(''.join(StickerTagEntry.special_chars)) + ']')
+
+
+def clean_tags(tags):
+    '''
+    Lowercases and strips tags the same way StickerTagEntrySerializer does.
+    Returns the valid tags (without duplicates) and the ones that were rejected.
+    '''
+    valid = {}
+    invalid = []
+    for tag in tags or []:
+        cleaned = tag.strip().lower() if isinstance(tag, str) else ''
+        if not cleaned or len(cleaned) > MAX_LENGTH or SPECIAL_CHARS.search(cleaned):
+            invalid.append(tag)
+        else:
+            valid[cleaned] = True
+    return list(valid), invalid
+
+
+def clean_stickers(stickers):
+    '''
+    Strips the sticker, file_id and set_name of every sticker object. All three are required, like in the serializer.
+    Returns a dictionary of sticker -> (file_id, set_name) and the sticker objects that were rejected.
+    '''
+    valid = {}
+    invalid = []
+    for sticker in stickers or []:
+        if not isinstance(sticker, dict):
+            invalid.append(sticker)
+            continue
+        fields = [sticker.get(name) for name in ('sticker', 'file_id', 'set_name')]
+        fields = [field.strip() if isinstance(field, str) else '' for field in fields]
+        if not all(fields) or any(len(field) > MAX_LENGTH for field in fields):
+            invalid.append(sticker)
+            continue
+        valid[fields[0]] = (fields[1], fields[2])
+    return valid, invalid
+
+
+def existing_pairs(user, stickers, tags):
+    '''
+    Returns the set of (sticker, tag) pairs out of stickers x tags that the user already has.
+    '''
+    pairs = set()
+    stickers = list(stickers)
+    for i in range(0, len(stickers), LOOKUP_BATCH_SIZE):
+        pairs.update(StickerTagEntry.objects.filter(
+            user=user, sticker__in=stickers[i:i + LOOKUP_BATCH_SIZE], tag__in=tags).order_by().values_list('sticker', 'tag'))
+    return pairs
+
+
+def insert_pairs(user, pairs):
+    '''
+    Inserts the user's (sticker, tag) pairs, skipping the ones that are there already, the way
+    bulk_create(ignore_conflicts=True) would. Returns how many really got inserted.
+    '''
+    ops = connection.ops
+    table = StickerTagEntry._meta
+    columns = ', '.join(ops.quote_name(table.get_field(name).column) for name in ('user', 'sticker', 'tag'))
+    inserted = 0
+    with connection.cursor() as cursor:
+        for i in range(0, len(pairs), INSERT_BATCH_SIZE):
+            batch = pairs[i:i + INSERT_BATCH_SIZE]
+            cursor.execute(f'{ops.insert_statement(on_conflict=OnConflict.IGNORE)} {ops.quote_name(table.db_table)} '
+                           f'({columns}) VALUES {", ".join(["(%s, %s, %s)"] * len(batch))} '
+                           f'{ops.on_conflict_suffix_sql([], OnConflict.IGNORE, [], [])}',
+                           [value for sticker, tag in batch for value in (user, sticker, tag)])
+            inserted += cursor.rowcount
+    return inserted
+
+
+def bulk_tag(user, stickers, tags):
+    '''
+    Tags every sticker with every tag, skipping the pairs that already exist.
+    stickers is a list of {"sticker", "file_id", "set_name"} objects, like the views receive them.
+    Returns a report of what was created and skipped, overall and per sticker.
+    Call this inside transaction.atomic() to combine it with other writes, it opens its own otherwise.
+    '''
+    tags, invalid_tags = clean_tags(tags)
+    stickers, invalid_stickers = clean_stickers(stickers)
+
+    with transaction.atomic():
+        # looked up inside the transaction, so what gets counted in the tag stats is what really got inserted
+        existing = existing_pairs(user, stickers, tags) if tags else set()
+        results = []
+        new_pairs = []
+        for sticker, (file_id, set_name) in stickers.items():
+            created = 0
+            for tag in tags:
+                if (sticker, tag) in existing:
+                    continue
+                new_pairs.append((sticker, tag))
+                created += 1
+            results.append(
+                {"sticker": sticker, "created": created, "skipped": len(tags) - created})
+
+        # the stickers' file_ids and set_names get refreshed even when they had every tag already
+        Sticker.remember((sticker, file_id, set_name)
+                         for sticker, (file_id, set_name) in stickers.items())
+        inserted = insert_pairs(user, new_pairs)
+        if inserted == len(new_pairs):
+            tag_stats.entries_added(user, new_pairs)
+        else:
+            # another request inserted some of them since we looked, and there's no telling which ones
+            tag_stats.rebuild([user])
+        if stickers:
+            # the stickers' file_ids could have changed too, so every tag they have counts as changed
+            notify_tags_changed(user, stickers=stickers, tags=tags)
+
+    return {
+        "created": inserted,
+        "skipped": len(stickers) * len(tags) - inserted,
+        "stickers": results,
+        "invalid_tags": invalid_tags,
+        "invalid_stickers": invalid_stickers,
+    }
+
+
+def rename_tag(user, old_tag, new_tag):
+    '''
+    Renames one of a user's tags on every sticker that has it, in a couple of queries however many stickers that is.
+    Stickers that already have the new tag just lose the old one (the two tags get merged).
+    The tags should already be cleaned with clean_tags. Returns how many entries got renamed and merged.
+    '''
+    with transaction.atomic():
+        # the old tag's rows on stickers that have the new tag already would break the unique constraint if renamed
+        merged, _ = StickerTagEntry.objects.filter(user=user, tag=old_tag, sticker__in=StickerTagEntry.objects.filter(
+            user=user, tag=new_tag).values('sticker')).delete()
+        renamed = StickerTagEntry.objects.filter(user=user, tag=old_tag).update(tag=new_tag)
+        # every sticker still has a tag afterwards, only the two tags' counts change
+        tag_stats.apply(user, {old_tag: -(merged + renamed), new_tag: renamed})
+        if merged or renamed:
+            # only the two tags' stickers changed
+            notify_tags_changed(user, stickers=[], tags=[old_tag, new_tag])
+    return {"renamed": renamed, "merged": merged}
+
+
+def set_entries(user, set_name):
+    '''
+    The user's entries on the stickers of a sticker set. The set's stickers come out of the sticker_set_name_idx index
+    and each one is looked up in the user's entries, so this doesn't depend on how many stickers the user has.
+    '''
+    return StickerTagEntry.objects.filter(
+        user=user, sticker__in=Sticker.objects.filter(set_name=set_name).values('sticker')).order_by()
+
+
+def set_size(user, set_name):
+    '''
+    How many of the user's stickers are in the set
+    '''
+    return set_entries(user, set_name).aggregate(stickers=Count('sticker', distinct=True))['stickers']
+
+
+def set_tags(user, set_name):
+    '''
+    Returns how many of the user's stickers are in the set, and the tags on them with how many of them have each one,
+    the most common first
+    '''
+    # a set has a couple hundred stickers at most, so they're counted here. a GROUP BY tag lets sqlite pick the
+    # (user, tag) index and read every entry the user has to skip the sort
+    stickers = set()
+    counts = Counter()
+    for sticker, tag in set_entries(user, set_name).values_list('sticker', 'tag'):
+        stickers.add(sticker)
+        counts[tag] += 1
+    return len(stickers), sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+def tag_set(user, set_name, tags):
+    '''
+    Adds the tags to every sticker the user has in the set, with one INSERT ... SELECT per tag, so the stickers never
+    leave the database. Tags they already have get skipped. The tags should already be cleaned with clean_tags.
+    Returns how many stickers the set has and how many entries got created.
+    '''
+    stickers_sql, params = set_entries(user, set_name).values('sticker').distinct().query.sql_with_params()
+    ops = connection.ops
+    table = StickerTagEntry._meta
+    columns = ', '.join(ops.quote_name(table.get_field(name).column) for name in ('user', 'sticker', 'tag'))
+    # the same conflict handling bulk_create(ignore_conflicts=True) uses, for whichever database this is
+    sql = (f'{ops.insert_statement(on_conflict=OnConflict.IGNORE)} {ops.quote_name(table.db_table)} ({columns}) '
+           f'SELECT %s, set_stickers.sticker, %s FROM ({stickers_sql}) set_stickers '
+           f'{ops.on_conflict_suffix_sql([], OnConflict.IGNORE, [], [])}')
+    created = {}
+    with transaction.atomic():
+        stickers = set_size(user, set_name)
+        if stickers:
+            with connection.cursor() as cursor:
+                for tag in tags:
+                    cursor.execute(sql, (user, tag, *params))
+                    created[tag] = cursor.rowcount
+        # the set's stickers all had tags already, so only the tags' counts change
+        tag_stats.apply(user, created)
+        tags = [tag for tag, count in created.items() if count]
+        created = sum(created.values())
+        if created:
+            notify_tags_changed(user, stickers=[], tags=tags)
+    return stickers, created
+
+
+def untag_set(user, set_name, tags):
+    '''
+    Removes the tags from every sticker the user has in the set with one DELETE (and a read for the tag stats).
+    Returns how many entries it removed.
+    '''
+    with transaction.atomic():
+        removed, tags = tag_stats.delete_entries(set_entries(user, set_name).filter(tag__in=tags))
+        if removed:
+            notify_tags_changed(user, stickers=[], tags=tags)
+    return removed
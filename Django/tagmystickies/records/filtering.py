@@ -0,0 +1,268 @@
+import base64
+import binascii
+from bisect import bisect_right
+from django.db.models import Count, F, Q
+from records.models import StickerTagEntry
+from records.tag_query import parse_query
+
+'''
+The sticker filtering that FilterStickersView (the bot's inline mode) does.
+
+Stickers come back with the ones the user uses the most first (their usage score, see records/usage.py), then the
+ones they never used ordered by their file_unique_id, so pages never repeat or skip anything. Clients can page with
+the old "page" number, or pass "offset" and get a "next_offset" back, which is an opaque cursor that can be handed
+straight to telegram's answerInlineQuery and comes back as the next inline query's offset.
+
+With "prefix" set, the last tag is treated as the start of a tag the user is still typing, and any of their tags
+that start with it will do.
+
+With "fuzzy" set, every tag is matched to the user's closest existing tags instead (see records/fuzzy.py), so "hapy"
+finds the "happy" stickers. The response then says what each tag was matched to in "matched_tags".
+
+With "query" set instead of "tags", stickers are filtered by a boolean query like "cat (happy | excited) -sad"
+(see records/tag_query.py).
+
+With "ids" set, the response also lists the file_unique_id of every sticker in "ids". The bot uses them as the
+inline result ids, so telegram's chosen_inline_result says which sticker got sent.
+'''
+
+PAGE_SIZE = 50
+
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+
+MATCH_ANY = 'any'  # stickers with at least one of the tags
+MATCH_ALL = 'all'  # stickers with every one of the tags
+MATCH_MODES = [MATCH_ANY, MATCH_ALL]
+
+
+def normalize_tags(tags):
+    '''
+    lowercases and strips a list of tags, dropping blanks and duplicates but keeping the order
+    '''
+    if not tags:
+        return []
+    if not isinstance(tags, list):
+        raise ValueError("tags must be a list.")
+    return list(dict.fromkeys(tag.lower().strip() for tag in tags if tag.strip()))
+
+
+def list_field(data, name):
+    # form encoded bodies come in as a QueryDict, where .get() would only give us the last item of the list
+    if hasattr(data, 'getlist'):
+        return data.getlist(name)
+    return data.get(name, [])
+
+
+def encode_cursor(sticker, score=None):
+    # file_unique_ids never have a ":" in them. repr() gives back the exact float, so the keyset compares right
+    value = sticker if score is None else f'{score!r}:{sticker}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(offset):
+    '''
+    turns a next_offset back into the (usage score, sticker) it points after. An empty offset is the first page.
+    '''
+    if not offset:
+        return None, None
+    try:
+        value = base64.b64decode(offset + '=' * (-len(offset) % 4), altchars=b'-_', validate=True).decode()
+        if ':' not in value:
+            return None, value
+        score, sticker = value.split(':', 1)
+        return float(score), sticker
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("offset is not a valid cursor.")
+
+
+def rank_key(sticker, score):
+    '''
+    the order stickers come back in: highest usage score first, never used ones last, then by sticker
+    '''
+    return (score is None, -score if score is not None else 0.0, sticker)
+
+
+class StickerQuery:
+    '''
+    A parsed filter request. "after" is the sticker the page starts after (cursor paging) and "after_score" its
+    usage score,
+    "page" is the old page number and is only used when there's no cursor.
+    "prefix" is the unfinished last tag, if the request asked for one, and isn't part of "tags".
+    In fuzzy mode "matched_tags" gets filled in with tag -> the user's tags it matched before the query runs.
+    "expression" is the parsed "query" (a records.tag_query.Plan), it's used instead of "tags" and "match".
+    '''
+
+    def __init__(self, user, tags=None, exclude_tags=None, match=MATCH_ANY, after=None, page=1, limit=PAGE_SIZE,
+                 prefix=None, fuzzy=False, after_score=None, ids=False, expression=None):
+        self.user = user
+        self.tags = tags or []
+        self.exclude_tags = exclude_tags or []
+        self.match = match
+        self.prefix = prefix
+        self.after = after
+        self.after_score = after_score
+        self.page = page
+        self.limit = limit
+        self.fuzzy = fuzzy
+        self.ids = ids
+        self.expression = expression
+        self.matched_tags = None
+
+    @classmethod
+    def from_data(cls, user, data):
+        '''
+        builds a query out of a request body, raising ValueError when something in it is wrong
+        '''
+        match = data.get('match', MATCH_ANY) or MATCH_ANY
+        if match not in MATCH_MODES:
+            raise ValueError(f"match must be one of {MATCH_MODES}.")
+        try:
+            page = int(data.get('page', 1) or 1)
+        except (TypeError, ValueError):
+            page = 0
+        if page < 1:
+            raise ValueError("page must be a positive integer.")
+        offset = data.get('offset', None)
+        if offset is not None and not isinstance(offset, str):
+            raise ValueError("offset must be a string.")
+        tags = normalize_tags(list_field(data, 'tags'))
+        prefix = None
+        if data.get('prefix', False) and tags:
+            prefix = tags.pop()
+        after_score, after = decode_cursor(offset)
+        text = data.get('query', None)
+        if text is not None and not isinstance(text, str):
+            raise ValueError("query must be a string.")
+        expression = parse_query(text) if text else None
+        if expression is not None and (tags or data.get('fuzzy', False)):
+            raise ValueError("query can't be combined with tags or fuzzy.")
+        return cls(user,
+                   tags=tags,
+                   exclude_tags=normalize_tags(list_field(data, 'exclude_tags')),
+                   match=match,
+                   after=after,
+                   after_score=after_score,
+                   page=page,
+                   prefix=prefix,
+                   fuzzy=bool(data.get('fuzzy', False)),
+                   ids=bool(data.get('ids', False)),
+                   expression=expression)
+
+    @property
+    def terms(self):
+        '''
+        the tags to match: as they are, or in fuzzy mode a tuple of the tags each one matched (any of them will do)
+        '''
+        if self.matched_tags is None:
+            return self.tags
+        return [tuple(self.matched_tags[tag]) for tag in self.tags]
+
+    @property
+    def start(self):
+        # cursor paging starts right after the cursor, so there's nothing to skip
+        if self.after is not None:
+            return 0
+        return (self.page - 1) * self.limit
+
+
+def sticker_queryset(query):
+    '''
+    Returns (sticker, file_id, usage score) rows for one page of the query plus 1 extra row, so we can tell if there's
+    another page.
+    '''
+    return ranked_stickers(query)[query.start:query.start + query.limit + 1]
+
+
+def ranked_stickers(query):
+    '''
+    (sticker, file_id, usage score) rows for every sticker that matches the query and comes after its cursor, in the
+    order they're returned in.
+    This is one aggregated query: rows are grouped per sticker, and in "all" mode the HAVING clause keeps only the
+    stickers that matched every tag. A boolean query is a HAVING clause of its own (see records/tag_query.py).
+    '''
+    entries = StickerTagEntry.objects.filter(user=query.user)
+    fuzzy = query.matched_tags is not None
+    # in fuzzy mode every tag has become a tuple of the tags it matched
+    tags = [tag for term in query.terms for tag in term] if fuzzy else query.tags
+    match_all = query.tags and query.match == MATCH_ALL
+    if query.expression is not None:
+        entries = query.expression.filter(query.user, entries)
+    elif match_all:
+        entries = entries.filter(tag__in=tags)
+        if fuzzy:
+            # HAVING can't count alternatives, so each fuzzy tag gets its own "sticker IN (...)" instead
+            for term in query.terms:
+                entries = entries.filter(sticker__in=StickerTagEntry.objects.filter(
+                    user=query.user, tag__in=term).values('sticker'))
+        if query.prefix is not None:
+            entries = entries.filter(sticker__in=StickerTagEntry.objects.filter(
+                user=query.user, tag__startswith=query.prefix).values('sticker'))
+    elif query.tags or query.prefix is not None:
+        tag_filter = Q(tag__in=tags)
+        if query.prefix is not None:
+            tag_filter |= Q(tag__startswith=query.prefix)
+        entries = entries.filter(tag_filter)
+    if query.exclude_tags:
+        entries = entries.exclude(sticker__in=StickerTagEntry.objects.filter(
+            user=query.user, tag__in=query.exclude_tags).values('sticker'))
+    if query.after is not None:
+        # everything that comes after the cursor in rank_key order
+        if query.after_score is None:
+            entries = entries.filter(usage__score__isnull=True, sticker__gt=query.after)
+        else:
+            entries = entries.filter(Q(usage__score__lt=query.after_score) | Q(usage__isnull=True) |
+                                     Q(usage__score=query.after_score, sticker__gt=query.after))
+
+    # order_by() first so the model's default ordering doesn't end up in the GROUP BY.
+    # a sticker only has one file_id and one usage score, so grouping by them as well doesn't split any groups
+    stickers = entries.order_by().values('sticker', 'sticker_info__file_id', 'usage__score')
+    if query.expression is not None:
+        stickers = query.expression.having(stickers)
+    elif match_all and not fuzzy:
+        stickers = stickers.annotate(matched=Count('tag', distinct=True)).filter(
+            matched=len(query.tags))
+    else:
+        stickers = stickers.distinct()
+    return stickers.order_by(F('usage__score').desc(nulls_last=True), 'sticker').values_list(
+        'sticker', 'sticker_info__file_id', 'usage__score')
+
+
+def page_from_matches(query, matches, scores=None):
+    '''
+    Does the same ordering and paging as sticker_queryset on an in-memory dictionary of sticker -> file_id,
+    with the usage scores from a dictionary of sticker -> score
+    '''
+    scores = scores or {}
+    keys = sorted(rank_key(sticker, scores.get(sticker)) for sticker in matches)
+    start = query.start
+    if query.after is not None:
+        start = bisect_right(keys, rank_key(query.after, query.after_score))
+    return [(sticker, matches[sticker], None if never_used else -score)
+            for never_used, score, sticker in keys[start:start + query.limit + 1]]
+
+
+def page_response(query, rows):
+    '''
+    turns the rows of a page (with the extra row on the end, if there is one) into the response body
+    '''
+    rows = list(rows)
+    next_offset = ''
+    if len(rows) > query.limit:
+        rows = rows[:query.limit]
+        next_offset = encode_cursor(rows[-1][0], rows[-1][2])
+    response = {"stickers": [file_id for _, file_id, _ in rows], "next_offset": next_offset}
+    if query.ids:
+        response["ids"] = [sticker for sticker, _, _ in rows]
+    if query.matched_tags is not None:
+        response["matched_tags"] = query.matched_tags
+    return response
+
+
+def autocomplete_queryset(user, prefix, limit):
+    '''
+    (tag, sticker count) rows for the tags starting with the prefix, most used first.
+    This is the fallback for when the tag index is turned off.
+    '''
+    return StickerTagEntry.objects.filter(user=user, tag__startswith=prefix).order_by().values('tag').annotate(
+        count=Count('sticker')).order_by('-count', 'tag').values_list('tag', 'count')[:limit]
@@ -0,0 +1,158 @@
+import heapq
+import threading
+from asgiref.sync import sync_to_async
+from collections import Counter, OrderedDict
+from django.conf import settings
+from records.models import StickerTagEntry
+from records.response_cache import filter_cache
+
+'''
+Typo tolerant tag matching for the filter endpoint's "fuzzy" mode.
+
+Every tag gets split into trigrams (the 3 letter pieces of "  tag ", so "hug" is "  h", " hu", "hug", "ug ").
+Two tags are similar when they share a big part of their trigrams, like postgres' pg_trgm measures it:
+shared / (trigrams of the first + trigrams of the second - shared). "hapy" and "happy" share 4 out of 7, 0.57.
+
+A TrigramIndex maps trigram -> tags, so finding the tags similar to a term only looks at the tags that share at least
+one trigram with it. The tag index keeps one per cached user and adds and removes tags as they're written
+(see records/tag_index.py). With the tag index off, the ones built from the database are kept per user until the
+user's filter cache generation moves on (see records/response_cache.py).
+'''
+
+# how similar (0 to 1) a tag has to be to a term to count as a match, pg_trgm's default
+FUZZY_THRESHOLD = 0.3
+# the most tags a single term gets matched to
+FUZZY_LIMIT = 3
+
+
+def trigrams(word):
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    '''
+    trigram -> tags, for one user's tags
+    '''
+    __slots__ = ('tags', 'sizes')
+
+    def __init__(self, tags=()):
+        self.tags = {}  # trigram -> set of tags
+        self.sizes = {}  # tag -> how many trigrams it has
+        for tag in tags:
+            self.add(tag)
+
+    def add(self, tag):
+        if tag in self.sizes:
+            return
+        tag_trigrams = trigrams(tag)
+        self.sizes[tag] = len(tag_trigrams)
+        for trigram in tag_trigrams:
+            self.tags.setdefault(trigram, set()).add(tag)
+
+    def remove(self, tag):
+        if self.sizes.pop(tag, None) is None:
+            return
+        for trigram in trigrams(tag):
+            tags = self.tags[trigram]
+            tags.discard(tag)
+            if not tags:
+                del self.tags[trigram]
+
+    def similar(self, term, threshold=FUZZY_THRESHOLD, limit=FUZZY_LIMIT):
+        '''
+        Returns up to limit tags similar to the term, most similar first.
+        A term that is one of the tags only matches itself, fuzzy mode shouldn't widen a search that was typed right.
+        '''
+        if term in self.sizes:
+            return [term]
+        term_trigrams = trigrams(term)
+        shared = Counter()
+        for trigram in term_trigrams:
+            shared.update(self.tags.get(trigram, ()))
+        scored = []
+        for tag, count in shared.items():
+            similarity = count / (len(term_trigrams) + self.sizes[tag] - count)
+            if similarity >= threshold:
+                scored.append((similarity, tag))
+        return [tag for _, tag in heapq.nsmallest(limit, scored, key=lambda pair: (-pair[0], pair[1]))]
+
+    def expand(self, terms):
+        '''
+        term -> the tags it matches, for every term
+        '''
+        return {term: self.similar(term) for term in terms}
+
+
+class IndexCache:
+    '''
+    The trigram indexes built from the database, per user, each under the generation it was built at.
+    A write to the user's tags bumps their generation, which makes the next lookup rebuild it.
+    '''
+
+    def __init__(self, max_tags):
+        self.max_tags = max_tags
+        self._indexes = OrderedDict()  # user -> (generation, TrigramIndex), least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, user, generation):
+        with self._lock:
+            cached = self._indexes.get(user)
+            if cached is None or cached[0] != generation:
+                return None
+            self._indexes.move_to_end(user)
+            return cached[1]
+
+    def put(self, user, generation, index):
+        size = len(index.sizes)
+        with self._lock:
+            self._remove(user)
+            # a single user bigger than the whole cap would just evict everyone else and then itself
+            if size > self.max_tags:
+                return
+            self._indexes[user] = (generation, index)
+            self._size += size
+            while self._size > self.max_tags:
+                _, (_, evicted) = self._indexes.popitem(last=False)
+                self._size -= len(evicted.sizes)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._size = 0
+
+    def _remove(self, user):
+        cached = self._indexes.pop(user, None)
+        if cached is not None:
+            self._size -= len(cached[1].sizes)
+
+
+index_cache = IndexCache(max_tags=settings.FUZZY_INDEX_MAX_TAGS)
+
+
+def user_tags_queryset(user):
+    return StickerTagEntry.objects.filter(user=user).order_by().values_list('tag', flat=True).distinct()
+
+
+def user_index(user):
+    # the generation is read before the tags, so a write landing in between leaves this one stale and the next
+    # lookup rebuilds it
+    generation = filter_cache.generation(user)
+    index = index_cache.get(user, generation)
+    if index is None:
+        index = TrigramIndex(user_tags_queryset(user))
+        index_cache.put(user, generation, index)
+    return index
+
+
+def expand_from_database(user, terms):
+    '''
+    The fallback for when the tag index is turned off: reads all of the user's tags the first time, then reuses their
+    trigram index until one of their tags changes.
+    '''
+    return user_index(user).expand(terms)
+
+
+async def aexpand_from_database(user, terms):
+    return (await sync_to_async(user_index)(user)).expand(terms)
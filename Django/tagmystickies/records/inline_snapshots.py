@@ -0,0 +1,196 @@
+import json
+import threading
+import time
+from bisect import bisect_right
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, transaction
+from django.db.models import Q
+from django.dispatch import receiver
+from records.filtering import StickerQuery, rank_key, ranked_stickers
+from records.models import InlineSnapshot, StickerTagEntry
+from records.renderers import orjson
+from records.signals import sticker_used, tags_changed
+from records.streaming import dumps
+
+'''
+Snapshots of the inline results for one-tag queries, which is most of what the bot's inline mode asks for.
+
+They're for when the tag index (records/tag_index.py) is off, e.g. with more than one worker, and filter-stickers
+has to go to the database. A snapshot is one InlineSnapshot row per (user, tag) with every matching sticker in it,
+already in the order filter-stickers returns them. The empty tag has all of the user's stickers, for queries without
+tags. A query with one tag (or none) and no exclude_tags, prefix or fuzzy gets answered with one lookup by
+(user, tag) and a slice of the list, instead of filtering, grouping and ordering the user's entries all over again
+for every page.
+
+Snapshots get built the first time a query needs them. Every writer sends tags_changed (see records/signals.py) with
+the stickers and tags it changed, and only the snapshots those could be in get thrown away: the ones for the tags, for
+every tag the stickers have (their file_ids could have changed) and the one with all the user's stickers. Writers
+that can't say what they changed throw away all of the user's snapshots. Recording a use throws away the ones with
+that sticker in them, since its place in the order changed. Only the snapshots that get asked for again are rebuilt.
+The rows are deleted in the writer's transaction, so the delete costs no extra write.
+
+With the tag index on, snapshots are never read, so nothing is built or thrown away. Snapshots left over from a time
+it was off don't know about the writes since, so after switching it off again run python manage.py
+rebuild_inline_snapshots (or wait INLINE_SNAPSHOT_MAX_AGE seconds) before they get used.
+
+A snapshot that's being built while the user's tags change isn't stored. On sqlite the build reads and stores in one
+transaction, so a write that commits in between makes the store fail. Other processes can't tell this one about
+their writes, so on other databases a snapshot can be stored stale by a worker that was building it when another
+worker wrote. INLINE_SNAPSHOT_MAX_AGE bounds how long that can last, and python manage.py rebuild_inline_snapshots
+--check compares every snapshot with the sticker tag entries.
+'''
+
+ALL_STICKERS = ''
+# invalidations are counted per slot, a user's slot is user % SLOTS. two users that share a slot only cost each other
+# a snapshot that doesn't get stored
+SLOTS = 4096
+
+loads = orjson.loads if orjson is not None else json.loads
+
+_generations = [0] * SLOTS
+_lock = threading.Lock()
+# a change to more stickers than this throws away all of the user's snapshots, which is one cheap DELETE anyway
+MAX_CHANGED_STICKERS = 500
+
+
+def snapshots_enabled():
+    # filter-stickers only reads snapshots when the tag index is off
+    return settings.INLINE_SNAPSHOTS_ENABLED and not settings.TAG_INDEX_ENABLED
+
+
+def snapshot_tag(query):
+    '''
+    The tag of the snapshot that can answer a query, or None if it needs the full filter
+    '''
+    if not snapshots_enabled() or query.fuzzy or query.prefix is not None or query.exclude_tags:
+        return None
+    if query.expression is not None:
+        # a "query" that's just one tag is the same as "tags" with it
+        return query.expression.single_tag
+    if len(query.tags) > 1:
+        return None
+    return query.tags[0] if query.tags else ALL_STICKERS
+
+
+def ranked_rows(user, tag):
+    '''
+    What a snapshot holds: [sticker, file_id, usage score] for every sticker of the user's with the tag, in order
+    '''
+    query = StickerQuery(user, tags=[tag] if tag != ALL_STICKERS else [])
+    return [list(row) for row in ranked_stickers(query)]
+
+
+def build(user, tag):
+    '''
+    Builds a snapshot and stores it, unless the user's tags changed while it was being built. Returns its rows.
+    '''
+    generation = _generations[user % SLOTS]
+    rows = None
+    try:
+        # reading and storing in one transaction, see above
+        with transaction.atomic():
+            rows = ranked_rows(user, tag)
+            if _generations[user % SLOTS] == generation:
+                InlineSnapshot.objects.bulk_create(
+                    [InlineSnapshot(user_id=user, tag=tag, results=dumps(rows), built=time.time())],
+                    update_conflicts=True, unique_fields=['user', 'tag'], update_fields=['results', 'built'])
+    except (IntegrityError, OperationalError):
+        # the user got deleted, or their tags changed, while it was being built
+        if rows is None:
+            raise
+    return rows
+
+
+def fresh(built):
+    return time.time() - built <= settings.INLINE_SNAPSHOT_MAX_AGE
+
+
+def rows_for(user, tag):
+    snapshot = InlineSnapshot.objects.filter(user=user, tag=tag).values_list('results', 'built').first()
+    if snapshot is not None and fresh(snapshot[1]):
+        return loads(snapshot[0])
+    return build(user, tag)
+
+
+async def arows_for(user, tag):
+    snapshot = await InlineSnapshot.objects.filter(user=user, tag=tag).values_list('results', 'built').afirst()
+    if snapshot is not None and fresh(snapshot[1]):
+        return loads(snapshot[0])
+    return await sync_to_async(build)(user, tag)
+
+
+def page(query, rows):
+    '''
+    Does the same paging as sticker_queryset on a snapshot's rows: one page plus 1 extra row
+    '''
+    start = query.start
+    if query.after is not None:
+        start = bisect_right(rows, rank_key(query.after, query.after_score), key=lambda row: rank_key(row[0], row[2]))
+    return rows[start:start + query.limit + 1]
+
+
+def snapshot_page(query, tag):
+    return page(query, rows_for(query.user, tag))
+
+
+async def asnapshot_page(query, tag):
+    return page(query, await arows_for(query.user, tag))
+
+
+def invalidate(user, stickers=None, tags=(), drop=True):
+    '''
+    Throws away the user's snapshots that changes to the stickers and tags could be in, or all of them when stickers
+    is None. With drop False, only stops the snapshots being built right now from being stored.
+    '''
+    with _lock:
+        _generations[user % SLOTS] += 1
+    if not drop:
+        return
+    snapshots = InlineSnapshot.objects.filter(user=user)
+    if stickers is not None and len(stickers) <= MAX_CHANGED_STICKERS:
+        changed = Q(tag=ALL_STICKERS)
+        if tags:
+            changed |= Q(tag__in=tags)
+        if stickers:
+            changed |= Q(tag__in=StickerTagEntry.objects.filter(user=user, sticker__in=stickers).values('tag'))
+        snapshots = snapshots.filter(changed)
+    snapshots.delete()
+
+
+def out_of_date(users):
+    '''
+    The (user, tag) of every snapshot of the users that doesn't match their sticker tag entries
+    '''
+    snapshots = InlineSnapshot.objects.filter(user__in=users).order_by('user', 'tag').values_list(
+        'user', 'tag', 'results')
+    return [(user, tag) for user, tag, results in snapshots.iterator() if loads(results) != ranked_rows(user, tag)]
+
+
+def rebuild(users, all_tags=False):
+    '''
+    Rebuilds every snapshot the users have. With all_tags, builds one for every tag they have as well, and for all of
+    their stickers. Returns how many were built.
+    '''
+    wanted = set(InlineSnapshot.objects.filter(user__in=users).values_list('user', 'tag'))
+    if all_tags:
+        wanted.update(StickerTagEntry.objects.filter(user__in=users).order_by().values_list('user', 'tag').distinct())
+        wanted.update((user, ALL_STICKERS) for user in
+                      StickerTagEntry.objects.filter(user__in=users).order_by().values_list('user', flat=True).distinct())
+    for user, tag in sorted(wanted):
+        build(user, tag)
+    return len(wanted)
+
+
+@receiver(tags_changed)
+def drop_snapshots(sender, user, stickers=None, tags=(), after_commit=False, **kwargs):
+    if not snapshots_enabled():
+        return
+    # the rows went with the writer's transaction, after it commits only the builds that read before it need stopping
+    invalidate(user, stickers, tags, drop=not after_commit)
+
+
+@receiver(sticker_used)
+def drop_snapshots_with_sticker(sender, user, sticker, **kwargs):
+    if snapshots_enabled():
+        invalidate(user, [sticker])
@@ -0,0 +1,392 @@
+import json
+import platform
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.urls import URLPattern
+from rest_framework.test import APIClient
+from records import urls
+from records.benchmarks import percentile, seed_dataset
+from records.models import Sticker, StickerTagEntry
+from records.tag_index import tag_index
+from records.write_behind import write_behind
+
+'''
+python manage.py bench
+
+Seeds a throwaway test database with a production sized dataset (--users users with --stickers stickers each, tagged
+out of a Zipf distributed vocabulary of --tags tags) and then sends --requests requests to every endpoint in
+records/urls.py through the test client. For every endpoint it reports:
+- p50/p95/p99 latency
+- SQL queries per request
+- full table scans per request, from the query plans of the endpoint's queries
+- sqlite VM steps per request (sqlite doesn't count rows scanned per statement, this is the closest thing it has:
+  every row visited costs a handful of steps, so it grows with the rows scanned)
+
+Use --output results.json to save everything as JSON, so runs from different commits can be compared.
+Endpoints that write get a fresh target for every request (some of the setup isn't timed), so the dataset keeps its
+shape for the whole run.
+'''
+
+# the sqlite progress handler gets called every this many VM steps
+VM_STEP_GRANULARITY = 100
+
+# the large user ids the benchmark creates users with, so they never clash with the seeded ones
+NEW_USER_START = 10 ** 9
+
+
+def json_body(data):
+    # strings are sent as they are, for the endpoints that don't take JSON
+    return data if isinstance(data, str) else json.dumps(data)
+
+
+class Endpoints:
+    '''
+    One method per url name in records/urls.py. Each gets the request number and returns (method, path, body),
+    doing any untimed setup the request needs first.
+    '''
+
+    def __init__(self, dataset):
+        self.data = dataset
+
+    def sticker_object(self, sticker):
+        return {"sticker": sticker, "file_id": f"file_{sticker}", "set_name": "bench"}
+
+    def scratch_sticker(self, user, i, tags):
+        # a sticker that only exists for one request to delete
+        sticker = f"scratch{i:07}"
+        StickerTagEntry.objects.bulk_create(
+            [StickerTagEntry(user_id=user, sticker=sticker, tag=tag) for tag in tags], ignore_conflicts=True)
+        return sticker
+
+    def user_entries_list(self, i):
+        if i % 2:
+            return 'post', '/records/user-entries/', {"user": NEW_USER_START + i, "chat": NEW_USER_START + i}
+        return 'get', f'/records/user-entries/?user={self.data.user()}', None
+
+    def user_entry_detail(self, i):
+        user = self.data.user()
+        if i % 2:
+            return 'patch', f'/records/user-entries/{user}/', {"status": f"bench {i}"}
+        return 'get', f'/records/user-entries/{user}/', None
+
+    def sticker_tag_entries_list(self, i):
+        user = self.data.user()
+        if i % 2:
+            return 'post', '/records/ste/', {"user": user, "tag": f"bench{i}", **self.sticker_object(self.data.sticker(user))}
+        return 'get', f'/records/ste/?user={user}&tag={self.data.tags(1)[0]}', None
+
+    def sticker_tag_entry_detail(self, i):
+        user = self.data.user()
+        entry = StickerTagEntry.objects.filter(user=user, sticker=self.data.sticker(user)).first()
+        if i % 3 == 1:
+            return 'patch', f'/records/ste/{entry.id}/', {"tag": f"patched{i}"}
+        if i % 3 == 2:
+            entry = StickerTagEntry.objects.create(user_id=user, sticker=f"scratch{i:07}", tag="scratch")
+            return 'delete', f'/records/ste/{entry.id}/', None
+        return 'get', f'/records/ste/{entry.id}/', None
+
+    def filter_stickers(self, i):
+        return 'post', '/records/filter-stickers/', self.inline_query()
+
+    def async_filter_stickers(self, i):
+        return 'post', '/records/async/filter-stickers/', self.inline_query()
+
+    def inline_query(self):
+        query = {"user": self.data.user(), "tags": self.data.tags(self.data.rng.randint(1, 3)),
+                 "match": self.data.rng.choice(['any', 'all']), "offset": ""}
+        if self.data.rng.random() < 0.3:
+            query["tags"][-1] = query["tags"][-1][:2]
+            query["prefix"] = True
+        return query
+
+    def filter_cache_stats(self, i):
+        return 'get', '/records/filter-stickers/cache/', None
+
+    def user_sticker_tag_list(self, i):
+        return 'get', f'/records/user-sticker-tag-list/{self.data.user()}/', None
+
+    def manipulate_multi_sticker(self, i):
+        user = self.data.user()
+        if i % 3 == 1:
+            sticker = self.data.sticker(user)
+            return 'patch', f'/records/stickers/{user}/{sticker}/', {
+                "tags_to_remove": [f"bench{i - 1}"], "tags_to_add": [f"bench{i}"], **self.sticker_object(sticker)}
+        if i % 3 == 2:
+            return 'delete', f'/records/stickers/{user}/{self.scratch_sticker(user, i, self.data.tags(3))}/', None
+        sticker = self.data.sticker(user)
+        return 'post', f'/records/stickers/{user}/{sticker}/', {
+            "tags_to_add": [f"bench{i}", *self.data.tags(2)], **self.sticker_object(sticker)}
+
+    def sticker_used(self, i):
+        user = self.data.user()
+        return 'post', f'/records/stickers/{user}/{self.data.sticker(user)}/used/', None
+
+    def sticker_multi(self, i):
+        user = self.data.user()
+        if i % 2:
+            stickers = [self.scratch_sticker(user, i * 10 + n, ["scratch"]) for n in range(10)]
+            return 'delete', f'/records/stickers/{user}/', {"stickers": stickers}
+        stickers = [self.sticker_object(self.data.sticker(user)) for _ in range(10)]
+        return 'post', f'/records/stickers/{user}/', {"stickers": stickers, "tags": [f"bench{i}", *self.data.tags(2)]}
+
+    def delete_tag_set(self, i):
+        user = self.data.user()
+        sticker = self.scratch_sticker(user, i, ["scratch", *self.data.tags(2)])
+        return 'delete', f'/records/stickers/tags/{user}/{sticker}/', {"tags_to_remove": ["scratch"]}
+
+    def delete_multi_tag_set(self, i):
+        user = self.data.user()
+        stickers = [self.scratch_sticker(user, i * 10 + n, ["scratch", "other"]) for n in range(10)]
+        return 'delete', f'/records/stickers/tags/multi/{user}/', {"stickers": stickers, "tags_to_remove": ["scratch"]}
+
+    def mass_tag_replace(self, i):
+        user = self.data.user()
+        stickers = [self.sticker_object(self.data.sticker(user)) for _ in range(10)]
+        return 'patch', f'/records/stickers/tags/mass-replace/{user}/', {
+            "stickers": stickers, "tags_to_remove": [f"bench{i - 1}"], "tags_to_add": [f"bench{i}"]}
+
+    def tag_rename(self, i):
+        # a popular tag gets renamed back and forth, merging into stickers that have both
+        user = self.data.users[i // 2 % len(self.data.users)]
+        tag = self.data.vocabulary[i // 2 % 10]
+        if i % 2:
+            return 'post', f'/records/tags/rename/{user}/', {"old_tag": f"renamed{i - 1}", "new_tag": tag}
+        return 'post', f'/records/tags/rename/{user}/', {"old_tag": tag, "new_tag": f"renamed{i}"}
+
+    def sticker_set_tags(self, i):
+        # a set one of the user's stickers is in, tagged and untagged in turns
+        user = self.data.users[i // 3 % len(self.data.users)]
+        set_name = Sticker.objects.get(sticker=self.data.stickers[user][i // 3 % 10]).set_name
+        path = f'/records/sets/{user}/{set_name}/tags/'
+        if i % 3 == 1:
+            return 'post', path, {"tags": [f"set{i - 1}"]}
+        if i % 3 == 2:
+            return 'delete', path, {"tags": [f"set{i - 2}"]}
+        return 'get', path, None
+
+    def tag_stats(self, i):
+        return 'get', f'/records/tags/stats/{self.data.user()}/', None
+
+    def tag_autocomplete(self, i):
+        return 'get', f'/records/tags/autocomplete/{self.data.user()}/?prefix={self.data.tags(1)[0][:4]}', None
+
+    def batch(self, i):
+        # what one bot interaction does: look the user up, update their status and tag a sticker
+        user = self.data.user()
+        sticker = self.data.sticker(user)
+        return 'post', '/records/batch/', {"operations": [
+            {"method": "GET", "path": f"/records/user-entries/{user}/"},
+            {"method": "PATCH", "path": f"/records/user-entries/{user}/", "body": {"status": f"bench {i}"}},
+            {"method": "POST", "path": f"/records/stickers/{user}/{sticker}/",
+             "body": {"tags_to_add": [f"bench{i}"], **self.sticker_object(sticker)}},
+        ]}
+
+    def write_operation(self, i):
+        # a queued sticker-multi write that the request waits for, so it times queueing's worst case: written alone
+        user = self.data.user()
+        stickers = [self.sticker_object(self.data.sticker(user)) for _ in range(10)]
+        operation = write_behind.submit(user, 'POST', f'/records/stickers/{user}/',
+                                        {"stickers": stickers, "tags": [f"bench{i}"]}, 'testserver')
+        return 'get', f'/records/operations/{operation.id}/?wait=true', None
+
+    def library_export(self, i):
+        return 'get', f'/records/export/{self.data.user()}/', None
+
+    def library_export_all(self, i):
+        return 'get', '/records/export/', None
+
+    def library_import(self, i):
+        # a small library for a new user each time
+        user = NEW_USER_START + i
+        lines = [{"user": user, "chat": user}] + [
+            {"user": user, "sticker": sticker, "file_id": f"file_{sticker}", "set_name": "bench", "tags": self.data.tags(3)}
+            for sticker in self.data.stickers[self.data.user()][:50]]
+        return 'post', '/records/import/', ''.join(json.dumps(line) + '\n' for line in lines)
+
+    def async_user_entry_detail(self, i):
+        return 'get', f'/records/async/user-entries/{self.data.user()}/', None
+
+    def async_tag_autocomplete(self, i):
+        return 'get', f'/records/async/tags/autocomplete/{self.data.user()}/?prefix={self.data.tags(1)[0][:4]}', None
+
+
+class Command(BaseCommand):
+    help = 'Seeds a large dataset and reports latency and database work for every endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--stickers', type=int, default=500, help='stickers per user')
+        parser.add_argument('--tags', type=int, default=1000, help='size of the tag vocabulary')
+        parser.add_argument('--tags-per-sticker', type=int, default=4)
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help='exponent of the tag popularity distribution, higher means a few tags are on more stickers')
+        parser.add_argument('--requests', type=int, default=200, help='timed requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=5, help='untimed requests per endpoint before timing')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--endpoint', action='append', dest='endpoints',
+                            help='only benchmark this url name (can be repeated)')
+        parser.add_argument('--no-index', action='store_true', help='turn the tag index off')
+        parser.add_argument('--no-cache', action='store_true', help='turn the filter-stickers response cache off')
+        parser.add_argument('--output', help='write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['users'] < 1 or options['stickers'] < 1 or options['tags'] < 1:
+            raise CommandError('--requests, --users, --stickers and --tags must be positive.')
+        names = [pattern.name for pattern in urls.urlpatterns if isinstance(pattern, URLPattern)]
+        selected = options['endpoints'] or names
+        unknown = set(selected) - set(names)
+        if unknown:
+            raise CommandError(f'unknown endpoints: {", ".join(sorted(unknown))}')
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(TAG_INDEX_ENABLED=not options['no_index'],
+                                   FILTER_CACHE_ENABLED=not options['no_cache']):
+                started = time.perf_counter()
+                dataset = seed_dataset(options['users'], options['stickers'], options['tags'],
+                                       options['tags_per_sticker'], options['zipf'], options['seed'])
+                seconds = time.perf_counter() - started
+                self.stdout.write(f"seeded {StickerTagEntry.objects.count()} sticker tag entries in {seconds:.1f}s")
+                endpoints = Endpoints(dataset)
+                self.stdout.write(self.header())
+                results = {}
+                skipped = []
+                for name in selected:
+                    request = getattr(endpoints, name.replace('-', '_'), None)
+                    if request is None:
+                        skipped.append(name)
+                        continue
+                    results[name] = self.run(request, options)
+                    for row in self.rows(name, results[name]):
+                        self.stdout.write(row)
+        finally:
+            tag_index.clear()
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        if skipped:
+            self.stderr.write(f"no benchmark for: {', '.join(skipped)}, add them to Endpoints in {__name__}")
+        if options['output']:
+            report = {
+                "options": {key: options[key] for key in ('users', 'stickers', 'tags', 'tags_per_sticker', 'zipf',
+                                                          'requests', 'warmup', 'seed', 'no_index', 'no_cache')},
+                "database": settings.DATABASES['default']['ENGINE'],
+                "python": platform.python_version(),
+                "endpoints": results,
+                "skipped": skipped,
+            }
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(f"wrote {options['output']}")
+
+    def run(self, request, options):
+        '''
+        Times the requests to one endpoint. Returns a summary per HTTP method, since e.g. a GET and a POST to the same
+        url do completely different work.
+        '''
+        client = APIClient()
+        for i in range(options['warmup']):
+            self.send(client, *request(i - options['warmup']))
+
+        samples = {}
+        for i in range(options['requests']):
+            method, path, body = request(i)
+            steps = self.count_vm_steps()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                status = self.send(client, method, path, body)
+                latency = time.perf_counter() - started
+            sample = samples.setdefault(method.upper(), {
+                "latencies": [], "queries": [], "vm_steps": [], "errors": 0,
+                # the query plans are the same every time, so only the first request's get explained
+                "full_scans": self.full_scans(captured.captured_queries)})
+            sample["latencies"].append(latency)
+            sample["queries"].append(len(captured))
+            sample["vm_steps"].append(steps() if steps else None)
+            if status >= 400:
+                sample["errors"] += 1
+        return {method: self.summary(sample) for method, sample in samples.items()}
+
+    def summary(self, sample):
+        latencies = sample["latencies"]
+        vm_steps = sample["vm_steps"]
+        return {
+            "requests": len(latencies),
+            "errors": sample["errors"],
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "queries_per_request": round(sum(sample["queries"]) / len(latencies), 2),
+            "vm_steps_per_request": round(sum(vm_steps) / len(vm_steps)) if vm_steps[0] is not None else None,
+            "full_scans": sample["full_scans"],
+        }
+
+    def send(self, client, method, path, body):
+        if body is None:
+            response = getattr(client, method)(path)
+        else:
+            response = getattr(client, method)(path, json_body(body), content_type='application/json')
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response.status_code
+
+    def count_vm_steps(self):
+        '''
+        Starts counting sqlite VM steps, returns a function that stops counting and gives the total.
+        Returns None on other databases.
+        '''
+        if connection.vendor != 'sqlite':
+            return None
+        connection.ensure_connection()
+        steps = 0
+
+        def progress():
+            nonlocal steps
+            steps += VM_STEP_GRANULARITY
+            return 0
+
+        connection.connection.set_progress_handler(progress, VM_STEP_GRANULARITY)
+
+        def stop():
+            connection.connection.set_progress_handler(None, VM_STEP_GRANULARITY)
+            return steps
+        return stop
+
+    def full_scans(self, queries):
+        '''
+        The number of full table scans (no index used) in the query plans of a request's SELECT queries
+        '''
+        if connection.vendor != 'sqlite':
+            return None
+        scans = 0
+        with connection.cursor() as cursor:
+            for query in queries:
+                if not query['sql'].lstrip().upper().startswith('SELECT'):
+                    continue
+                try:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                except Exception:
+                    # the captured SQL has its parameters quoted for display, which doesn't always round trip
+                    continue
+                for row in cursor.fetchall():
+                    detail = row[-1]
+                    if detail.startswith('SCAN ') and 'USING' not in detail and 'CONSTANT' not in detail and '(' not in detail:
+                        scans += 1
+        return scans
+
+    def header(self):
+        return (f"{'endpoint':<28}{'method':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>8}"
+                f"{'vm steps':>10}{'scans':>6}{'errors':>7}")
+
+    def rows(self, name, results):
+        for method, result in results.items():
+            steps = result['vm_steps_per_request']
+            scans = result['full_scans']
+            yield (f"{name:<28}{method:>7}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+                   f"{result['p99_ms']:>10.2f}{result['queries_per_request']:>8}{steps if steps is not None else '-':>10}"
+                   f"{scans if scans is not None else '-':>6}{result['errors']:>7}")
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from records.models import UserEntry
+from records.ndjson import export_lines
+
+'''
+python manage.py export_library [--user 1234] [--output library.ndjson]
+
+Writes every user's tag library (or one user's) as NDJSON, see records/ndjson.py for the format.
+It goes to stdout unless --output is given. python manage.py import_library reads it back in.
+'''
+
+
+class Command(BaseCommand):
+    help = "Exports tag libraries as NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='only export this user')
+        parser.add_argument('--output', help='write to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        user = options['user']
+        if user is not None and not UserEntry.objects.filter(user=user).exists():
+            raise CommandError(f'user {user} does not exist.')
+        output = open(options['output'], 'w', encoding='utf-8') if options['output'] else None
+        try:
+            lines = 0
+            for line in export_lines(user):
+                if output is None:
+                    self.stdout.write(line, ending='')
+                else:
+                    output.write(line)
+                lines += 1
+        finally:
+            if output is not None:
+                output.close()
+        if options['output']:
+            self.stderr.write(f"wrote {lines} lines to {options['output']}")
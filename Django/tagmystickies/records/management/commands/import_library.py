@@ -0,0 +1,39 @@
+import json
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from records.ndjson import IMPORT_CHUNK_SIZE, Importer
+
+'''
+python manage.py import_library library.ndjson
+
+Imports NDJSON written by python manage.py export_library (or GET records/export/), see records/ndjson.py for the
+format. Pass - to read from stdin. Prints a report of what got imported as JSON.
+'''
+
+
+class Command(BaseCommand):
+    help = "Imports tag libraries from NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='the NDJSON file, or - for stdin')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE,
+                            help='lines written per transaction')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+        started = time.perf_counter()
+        importer = Importer(chunk_size=options['chunk_size'])
+        if options['path'] == '-':
+            report = importer.run(sys.stdin.buffer)
+        else:
+            try:
+                with open(options['path'], 'rb') as lines:
+                    report = importer.run(lines)
+            except OSError as e:
+                raise CommandError(str(e))
+        report["seconds"] = round(time.perf_counter() - started, 2)
+        self.stdout.write(json.dumps(report, indent=2))
+        if "error" in report:
+            raise CommandError(report["error"])
@@ -0,0 +1,309 @@
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import OperationalError, connection
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from records.benchmarks import percentile, seed_dataset, zipf_weights
+from records.bulk import bulk_tag
+from records.models import StickerTagEntry
+from records.signals import notify_tags_changed
+from records.tag_index import tag_index
+from records.tag_stats import delete_entries
+
+'''
+python manage.py inline_bench
+
+Fires a burst of concurrent inline queries at the sync FilterStickersView and at AsyncFilterStickersView and prints
+the throughput and latency of each.
+
+By default the requests go straight into django's ASGI application (the same thing hypercorn calls for every request)
+against a throwaway test database that gets seeded with one user's stickers, so nothing real is touched.
+With sqlite the test database is a real file, so journaling and locking work like in production.
+
+--writers starts threads that keep tagging and untagging the user's stickers during the burst, like the bot does while
+people use inline mode. Run it once with STORAGE_PROFILE=sqlite-plain and once with the default sqlite-tuned profile
+to see what WAL mode, the pragmas and the IMMEDIATE transactions in settings.py do for reads and writes that compete
+("locked" counts the writes that failed with "database is locked").
+To measure a real server instead, start it with hypercorn tagmystickies.asgi:application and pass --url and the
+--user whose stickers should be searched.
+'''
+
+VARIANTS = [
+    ('sync', '/records/filter-stickers/'),
+    ('async', '/records/async/filter-stickers/'),
+]
+
+
+def inline_queries(user, vocabulary, count, seed):
+    '''
+    Request bodies for count inline queries. Popular tags get searched more, and some queries are still being typed.
+    '''
+    rng = random.Random(seed)
+    weights = zipf_weights(len(vocabulary), 1)
+    bodies = []
+    for _ in range(count):
+        tags = rng.choices(vocabulary, weights, k=rng.randint(1, 3))
+        body = {"user": user, "tags": tags, "match": rng.choice(['any', 'all']), "offset": ""}
+        if rng.random() < 0.3:
+            # the user is halfway through typing the last tag
+            body["tags"][-1] = body["tags"][-1][:2]
+            body["prefix"] = True
+        bodies.append(json.dumps(body).encode())
+    return bodies
+
+
+class Writers:
+    '''
+    Background threads that write to a user's tags until they're stopped, counting their writes and failures
+    '''
+
+    def __init__(self, count, user, stickers, interval):
+        self.count = count
+        self.user = user
+        self.stickers = stickers
+        self.interval = interval
+        self.latencies = []
+        self.errors = 0
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._threads = [threading.Thread(target=self.run, args=(n,), daemon=True) for n in range(self.count)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def run(self, n):
+        rng = random.Random(n)
+        i = 0
+        try:
+            while not self._stop.is_set():
+                # every writer cycles through 10 tags of its own, adding them all and then removing them all
+                tag = f'written{n}x{i % 10}'
+                started = time.perf_counter()
+                try:
+                    if i // 10 % 2 == 0:
+                        sticker = rng.choice(self.stickers)
+                        bulk_tag(self.user, [{"sticker": sticker, "file_id": f"file_{sticker}", "set_name": "bench"}],
+                                 [tag])
+                    else:
+                        # through delete_entries like every other delete, so the tag stats stay right
+                        _, tags = delete_entries(StickerTagEntry.objects.filter(user=self.user, tag=tag))
+                        notify_tags_changed(self.user, stickers=[], tags=tags)
+                    with self._lock:
+                        self.latencies.append(time.perf_counter() - started)
+                except OperationalError:
+                    # database is locked
+                    with self._lock:
+                        self.errors += 1
+                i += 1
+                self._stop.wait(self.interval)
+        finally:
+            connection.close()
+
+    def summary(self, elapsed):
+        return {
+            "writes": len(self.latencies),
+            "write_errors": self.errors,
+            "writes_per_second": round(len(self.latencies) / elapsed, 1),
+            "write_p95_ms": round(percentile(self.latencies, 95) * 1000, 2) if self.latencies else None,
+        }
+
+
+class Command(BaseCommand):
+    help = 'Compares the throughput of the sync and async inline query views under concurrent load'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000,
+                            help='number of inline queries sent to each view')
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help='number of requests in flight at once')
+        parser.add_argument('--stickers', type=int, default=2000,
+                            help='number of stickers the seeded user has')
+        parser.add_argument('--tags', type=int, default=300,
+                            help='size of the seeded tag vocabulary')
+        parser.add_argument('--tags-per-sticker', type=int, default=5)
+        parser.add_argument('--writers', type=int, default=0,
+                            help='number of threads writing tags while the queries run')
+        parser.add_argument('--write-interval', type=float, default=10,
+                            help='milliseconds each writer waits between writes')
+        parser.add_argument('--no-index', action='store_true',
+                            help='turn the tag index off so every query goes to the database')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--url', help='base url of a running server, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--user', type=int, help='the user to search, required with --url')
+        parser.add_argument('--json', action='store_true',
+                            help='print the results as JSON')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be positive.')
+
+        if options['url']:
+            if options['user'] is None:
+                raise CommandError('--user is required with --url.')
+            vocabulary = self.remote_vocabulary(options['url'], options['user'])
+            bodies = inline_queries(options['user'], vocabulary, options['requests'], options['seed'])
+            results = {name: self.run_remote(options['url'] + path, bodies, options['concurrency'])
+                       for name, path in VARIANTS}
+        else:
+            directory = None
+            if connection.vendor == 'sqlite':
+                directory = tempfile.mkdtemp()
+                connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'inline_bench.sqlite3')
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                # the response cache would answer most of the repeated queries, and this is about the views themselves
+                with override_settings(TAG_INDEX_ENABLED=not options['no_index'], FILTER_CACHE_ENABLED=False):
+                    dataset = seed_dataset(1, options['stickers'], options['tags'], options['tags_per_sticker'],
+                                           exponent=1, seed=options['seed'])
+                    bodies = inline_queries(dataset.users[0], dataset.vocabulary, options['requests'], options['seed'])
+                    results = asyncio.run(self.run_local(bodies, options, dataset))
+            finally:
+                tag_index.clear()
+                teardown_databases(old_config, verbosity=0)
+                if directory:
+                    shutil.rmtree(directory, ignore_errors=True)
+
+        self.report(results, options)
+
+    async def run_local(self, bodies, options, dataset):
+        application = ASGIHandler()
+        user = dataset.users[0]
+        results = {}
+        for name, path in VARIANTS:
+            # one request first so both views start with a warm tag index
+            await self.asgi_post(application, path, bodies[0])
+            with Writers(options['writers'], user, dataset.stickers[user], options['write_interval'] / 1000) as writers:
+                results[name] = await self.run_batch(
+                    lambda body, path=path: self.asgi_post(application, path, body), bodies, options['concurrency'])
+            if options['writers']:
+                results[name].update(writers.summary(results[name]["seconds"]))
+        return results
+
+    async def run_batch(self, send, bodies, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        errors = 0
+
+        async def one(body):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                status = await send(body)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(body) for body in bodies))
+        return self.summary(latencies, errors, time.perf_counter() - start)
+
+    async def asgi_post(self, application, path, body):
+        '''
+        Sends one POST through the ASGI application like a server would and returns the response status
+        '''
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': 'POST', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+            'query_string': b'', 'root_path': '',
+            'headers': [(b'host', b'localhost'), (b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode())],
+            'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        status = None
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            # the client never disconnects early
+            await asyncio.Future()
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+        await application(scope, receive, send)
+        return status
+
+    def remote_vocabulary(self, url, user):
+        '''
+        the user's tags, most used first, taken from the running server's autocomplete endpoint
+        '''
+        with urllib.request.urlopen(f'{url}/records/tags/autocomplete/{user}/?prefix=&limit=50') as response:
+            tags = [item['tag'] for item in json.load(response)['tags']]
+        if not tags:
+            raise CommandError(f'user {user} has no tags to search for.')
+        return tags
+
+    def run_remote(self, url, bodies, concurrency):
+        def one(body):
+            request = urllib.request.Request(
+                url, data=body, headers={'Content-Type': 'application/json'})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            return time.perf_counter() - start, status
+
+        one(bodies[0])
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            responses = list(pool.map(one, bodies))
+        elapsed = time.perf_counter() - start
+        return self.summary([latency for latency, _ in responses],
+                            sum(1 for _, status in responses if status != 200), elapsed)
+
+    def summary(self, latencies, errors, elapsed):
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "seconds": round(elapsed, 3),
+            "requests_per_second": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        }
+
+    def report(self, results, options):
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        line = f"{options['requests']} inline queries per view, {options['concurrency']} at a time"
+        if options['writers']:
+            line += f", {options['writers']} writers"
+        if not options['url']:
+            line += f", storage profile {settings.STORAGE_PROFILE}"
+        self.stdout.write(line)
+        header = f"{'view':<8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}"
+        if options['writers']:
+            header += f"{'writes/s':>10}{'write p95':>11}{'locked':>8}"
+        self.stdout.write(header)
+        for name, result in results.items():
+            line = (f"{name:<8}{result['requests_per_second']:>10}{result['p50_ms']:>10}"
+                    f"{result['p95_ms']:>10}{result['p99_ms']:>10}{result['errors']:>8}")
+            if 'writes' in result:
+                line += f"{result['writes_per_second']:>10}{str(result['write_p95_ms']):>11}{result['write_errors']:>8}"
+            self.stdout.write(line)
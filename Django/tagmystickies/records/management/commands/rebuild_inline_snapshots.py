@@ -0,0 +1,52 @@
+import json
+import time
+from django.core.management.base import BaseCommand, CommandError
+from records.inline_snapshots import out_of_date, rebuild
+from records.models import UserEntry
+from records.tag_stats import BATCH_SIZE
+
+'''
+python manage.py rebuild_inline_snapshots
+
+Checks every user's inline snapshots (see records/inline_snapshots.py) against their sticker tag entries and rebuilds
+the users that have one that doesn't match. --user only checks those users, --check only reports what's out of date
+without fixing anything, and --all-tags builds a snapshot for every tag too, so even first queries are fast.
+Prints a report as JSON.
+'''
+
+
+class Command(BaseCommand):
+    help = "Finds and rebuilds inline snapshots that don't match the sticker tag entries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users',
+                            help='only check this user (can be repeated)')
+        parser.add_argument('--check', action='store_true',
+                            help="only report the snapshots that are out of date, exit with an error if there are any")
+        parser.add_argument('--all-tags', action='store_true',
+                            help="build a snapshot for every tag of every user that's checked")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        users = UserEntry.objects.order_by('user').values_list('user', flat=True)
+        if options['users']:
+            users = users.filter(user__in=options['users'])
+        users = list(users)
+        stale = []
+        built = 0
+        for i in range(0, len(users), BATCH_SIZE):
+            batch = users[i:i + BATCH_SIZE]
+            found = out_of_date(batch)
+            stale += found
+            if options['check']:
+                continue
+            if options['all_tags']:
+                built += rebuild(batch, all_tags=True)
+            elif found:
+                built += rebuild(sorted({user for user, _ in found}))
+        report = {"users": len(users), "out_of_date": len(stale),
+                  "out_of_date_snapshots": [{"user": user, "tag": tag} for user, tag in stale[:100]],
+                  "built": built, "seconds": round(time.perf_counter() - started, 2)}
+        self.stdout.write(json.dumps(report, indent=2))
+        if stale and options['check']:
+            raise CommandError(f"{len(stale)} inline snapshots are out of date.")
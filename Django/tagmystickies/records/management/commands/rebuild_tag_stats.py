@@ -0,0 +1,42 @@
+import json
+import time
+from django.core.management.base import BaseCommand, CommandError
+from records.models import UserEntry
+from records.tag_stats import BATCH_SIZE, out_of_date, rebuild
+
+'''
+python manage.py rebuild_tag_stats
+
+Checks every user's tag stats (see records/tag_stats.py) against their sticker tag entries and recounts the ones that
+don't match. --user only checks those users, --check only reports who's out of date without fixing anything.
+Prints a report as JSON.
+'''
+
+
+class Command(BaseCommand):
+    help = "Finds and recounts tag stats that don't match the sticker tag entries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users',
+                            help='only check this user (can be repeated)')
+        parser.add_argument('--check', action='store_true',
+                            help="only report the users that are out of date, exit with an error if there are any")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        users = UserEntry.objects.order_by('user').values_list('user', flat=True)
+        if options['users']:
+            users = users.filter(user__in=options['users'])
+        users = list(users)
+        stale = []
+        for i in range(0, len(users), BATCH_SIZE):
+            batch = users[i:i + BATCH_SIZE]
+            found = sorted(out_of_date(batch))
+            if found and not options['check']:
+                rebuild(found)
+            stale += found
+        report = {"users": len(users), "out_of_date": len(stale), "out_of_date_users": stale[:100],
+                  "fixed": not options['check'], "seconds": round(time.perf_counter() - started, 2)}
+        self.stdout.write(json.dumps(report, indent=2))
+        if stale and options['check']:
+            raise CommandError(f"{len(stale)} users have tag stats that are out of date.")
@@ -0,0 +1,101 @@
+import json
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from records import renderers
+from records.benchmarks import percentile, zipf_weights
+from records.models import StickerTagEntry
+from records.serializers import StickerTagEntrySerializer
+
+'''
+python manage.py render_bench
+
+Compares rest framework's JSONRenderer with the orjson and MessagePack renderers (see records/renderers.py) on the
+response bodies of the hot endpoints: a filter-stickers page, a whole user library like user-sticker-tag-list gives,
+and a page of the ste list. Reports the median and p95 time to encode each body and its size.
+Renderers whose package isn't installed get skipped.
+'''
+
+RENDERERS = [
+    ('json', JSONRenderer, None),
+    ('orjson', renderers.ORJSONRenderer, renderers.orjson),
+    ('msgpack', renderers.MessagePackRenderer, renderers.msgpack),
+]
+
+
+def file_id(rng):
+    # telegram file_ids are about this long
+    return 'CAACAgIAAxkBAAI' + ''.join(rng.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-', k=56))
+
+
+def payloads(stickers, tags_per_sticker, seed):
+    '''
+    name -> a response body shaped like the endpoint's
+    '''
+    rng = random.Random(seed)
+    vocabulary = [f'tag{i}' for i in range(1000)]
+    weights = zipf_weights(len(vocabulary), 1.1)
+    library = [{"sticker": f"AgAD{i:012}", "tags": sorted(set(rng.choices(vocabulary, weights, k=tags_per_sticker))),
+                "set_name": f"set{i // 50}", "file_id": file_id(rng)} for i in range(stickers)]
+    entries = []
+    for i, sticker in enumerate(library[:250]):
+        for tag in sticker["tags"]:
+            entry = StickerTagEntry(id=len(entries) + 1, user_id=1234, sticker=sticker["sticker"], tag=tag)
+            entry.file_id = sticker["file_id"]
+            entry.set_name = sticker["set_name"]
+            entries.append(entry)
+    return {
+        "filter-stickers page": {"stickers": [sticker["file_id"] for sticker in library[:50]],
+                                 "next_offset": "QWdBRDAwMDAwMDAwMDA0OQ"},
+        "user library": {"user": 1234, "chat": 1234, "status": "", "stickers": library},
+        "ste list": StickerTagEntrySerializer(entries, many=True).data,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compares the encode time and size of the JSON, orjson and MessagePack renderers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stickers', type=int, default=2000, help='stickers in the user library body')
+        parser.add_argument('--tags-per-sticker', type=int, default=4)
+        parser.add_argument('--repeat', type=int, default=200, help='encodes per body and renderer')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='print the results as JSON')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1 or options['stickers'] < 1:
+            raise CommandError('--repeat and --stickers must be positive.')
+        bodies = payloads(options['stickers'], options['tags_per_sticker'], options['seed'])
+        results = {}
+        for body_name, body in bodies.items():
+            results[body_name] = {}
+            for name, renderer_class, package in RENDERERS:
+                if renderer_class is not JSONRenderer and package is None:
+                    continue
+                results[body_name][name] = self.measure(renderer_class(), body, options['repeat'])
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{'body':<22}{'renderer':>9}{'p50 us':>11}{'p95 us':>11}{'bytes':>10}{'speedup':>9}{'size':>7}")
+        for body_name, by_renderer in results.items():
+            baseline = by_renderer['json']
+            for name, result in by_renderer.items():
+                self.stdout.write(
+                    f"{body_name:<22}{name:>9}{result['p50_us']:>11.1f}{result['p95_us']:>11.1f}{result['bytes']:>10}"
+                    f"{baseline['p50_us'] / result['p50_us']:>8.1f}x{result['bytes'] / baseline['bytes']:>7.0%}")
+        skipped = [name for name, _, package in RENDERERS[1:] if package is None]
+        if skipped:
+            self.stderr.write(f"not installed, skipped: {', '.join(skipped)}")
+
+    def measure(self, renderer, body, repeat):
+        # one untimed encode first, so nothing that only happens once gets counted
+        size = len(renderer.render(body))
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            renderer.render(body)
+            timings.append(time.perf_counter() - started)
+        return {"p50_us": round(percentile(timings, 50) * 1e6, 1), "p95_us": round(percentile(timings, 95) * 1e6, 1),
+                "bytes": size}
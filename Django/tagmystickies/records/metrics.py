@@ -0,0 +1,388 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+try:
+    import fcntl
+except ImportError:
+    # windows, where the snapshots of workers that exited are never merged (see below)
+    fcntl = None
+
+'''
+Request metrics in Prometheus' text format, served at /metrics.
+
+MetricsMiddleware times every request and records, per route (the url pattern, e.g. "records/ste/<int:pk>/") and
+HTTP method:
+- a latency histogram
+- how many SQL queries ran and how long they took, counted by an execute wrapper on every database connection
+- response bytes (streamed responses aren't counted, their size isn't known when they're returned)
+- the status codes
+
+and, per scope, how many requests the rate limiter refused (see records/throttling.py).
+
+Everything is counted in memory with a lock held for a few dictionary updates, so it can stay on all the time.
+
+Every hypercorn worker is its own process with its own counters. With METRICS_DIR set, each worker writes a snapshot
+of its counters into that directory (at most once a second, and whenever /metrics is scraped), and /metrics adds up
+the snapshots of every worker that has ever run, so the totals come out right whichever worker answers the scrape.
+
+What's in the directory:
+- metrics-<worker>.json, a snapshot per running worker. <worker> is the pid plus a random part, so a new worker that
+  gets a dead one's pid starts its own file instead of overwriting the other's counts (which would make them go
+  backwards).
+- metrics-<worker>.lock, locked by its worker for as long as it runs. The operating system lets go of the lock when
+  the process exits, however it exits.
+- metrics-base.json, the added up counts of every worker that exited. When a worker starts and on every scrape,
+  the snapshots whose lock can be taken get added into it and deleted, so the directory doesn't grow with every
+  restart and the totals never go down.
+- metrics.lock, which keeps scrapes from reading while snapshots are being merged.
+
+The directory can be deleted while the server is stopped, which starts every counter from 0 again (Prometheus sees
+that as a restart). On windows there's no fcntl to lock with, so nothing gets merged and the snapshots of old workers
+stay until the directory is cleaned up by hand.
+'''
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# seconds between snapshot writes
+FLUSH_INTERVAL = 1.0
+
+PREFIX = 'tagmystickies'
+
+METRICS = ('requests', 'latency', 'queries', 'response_bytes', 'throttled')
+# the worker name of the snapshot that adds up the workers that exited
+BASE = 'base'
+
+
+class RequestStats:
+    '''
+    The SQL queries of the request that's currently running
+    '''
+    __slots__ = ('queries', 'query_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+
+
+# asgiref copies context variables into the thread a sync view runs in, so the queries of sync views get counted
+# under ASGI too
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+def count_queries(execute, sql, params, many, context):
+    stats = current_request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.query_seconds += time.perf_counter() - started
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    # connection_created fires again when a connection reconnects, the wrapper only needs to be there once
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+def add_up(totals, snapshot):
+    '''
+    Adds a snapshot into totals, a dictionary of metric -> {label tuple -> value}
+    '''
+    for metric, rows in snapshot.items():
+        total = totals.setdefault(metric, {})
+        for *key, value in rows:
+            key = tuple(key)
+            if isinstance(value, list):
+                previous = total.get(key, [0] * len(value))
+                total[key] = [a + b for a, b in zip(previous, value)]
+            else:
+                total[key] = total.get(key, 0) + value
+
+
+def as_snapshot(totals):
+    return {metric: [[*key, value] for key, value in totals.get(metric, {}).items()] for metric in METRICS}
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as snapshot:
+            return json.load(snapshot)
+    except (OSError, ValueError):
+        return None
+
+
+def write_snapshot(path, snapshot):
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(snapshot, file)
+    # the replace is atomic, so a scrape never reads half a snapshot
+    os.replace(temporary, path)
+
+
+class Metrics:
+    '''
+    The counters of this process. All of them are dictionaries keyed by label tuples, so they can be added up with the
+    snapshots of other processes.
+    '''
+
+    def __init__(self, directory=None, worker=None):
+        self.directory = directory
+        # names this process' snapshot file
+        self.worker = worker or f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._lock = threading.Lock()
+        self._flushed = 0.0
+        # this worker's .lock file, held open (and locked) until the process exits
+        self._running = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}  # (route, method, status) -> count
+            self.latency = {}  # (route, method) -> [count per bucket..., count over the last bucket, sum of seconds]
+            self.queries = {}  # (route, method) -> [queries, seconds]
+            self.response_bytes = {}  # (route, method) -> bytes
+            self.throttled = {}  # (scope,) -> requests refused by the rate limiter, see records/throttling.py
+
+    def observe(self, route, method, status, seconds, stats, size):
+        key = (route, method)
+        bucket = len(LATENCY_BUCKETS)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                bucket = i
+                break
+        with self._lock:
+            status_key = (route, method, str(status))
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            latency = self.latency.get(key)
+            if latency is None:
+                latency = self.latency[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            latency[bucket] += 1
+            latency[-1] += seconds
+            queries = self.queries.get(key)
+            if queries is None:
+                queries = self.queries[key] = [0, 0.0]
+            queries[0] += stats.queries
+            queries[1] += stats.query_seconds
+            if size is not None:
+                self.response_bytes[key] = self.response_bytes.get(key, 0) + size
+        if self.directory and time.monotonic() - self._flushed > FLUSH_INTERVAL:
+            self.flush()
+
+    def count_throttled(self, scope):
+        with self._lock:
+            self.throttled[(scope,)] = self.throttled.get((scope,), 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": [[*key, value] for key, value in self.requests.items()],
+                "latency": [[*key, value[:]] for key, value in self.latency.items()],
+                "queries": [[*key, value[:]] for key, value in self.queries.items()],
+                "response_bytes": [[*key, value] for key, value in self.response_bytes.items()],
+                "throttled": [[*key, value] for key, value in self.throttled.items()],
+            }
+
+    def path(self, worker, extension='json'):
+        return os.path.join(self.directory, f'metrics-{worker}.{extension}')
+
+    def workers(self):
+        '''
+        the workers that have a snapshot in the directory, the base one included
+        '''
+        return [name[len('metrics-'):-len('.json')] for name in os.listdir(self.directory)
+                if name.startswith('metrics-') and name.endswith('.json')]
+
+    @contextmanager
+    def directory_lock(self, operation):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, 'metrics.lock'), 'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def start(self):
+        '''
+        Locks this worker's .lock file for as long as it runs, and merges the snapshots of workers that exited
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        if fcntl is not None:
+            self._running = open(self.path(self.worker, 'lock'), 'a')
+            fcntl.flock(self._running, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.merge_exited()
+
+    def flush(self):
+        '''
+        Writes this process' snapshot into the metrics directory
+        '''
+        self._flushed = time.monotonic()
+        if self._running is None:
+            self.start()
+        write_snapshot(self.path(self.worker), self.snapshot())
+
+    def merge_exited(self):
+        '''
+        Adds the snapshots of the workers that aren't running anymore into the base snapshot and deletes them.
+        A worker's lock is only free once it exited, and it takes the lock before writing its first snapshot.
+        '''
+        if fcntl is None:
+            return
+        with self.directory_lock(fcntl.LOCK_EX):
+            exited = []
+            totals = {}
+            for worker in self.workers():
+                if worker in (BASE, str(self.worker)):
+                    continue
+                with open(self.path(worker, 'lock'), 'a') as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue  # still running
+                    add_up(totals, read_snapshot(self.path(worker)) or {})
+                    exited.append(worker)
+            if not exited:
+                return
+            add_up(totals, read_snapshot(self.path(BASE)) or {})
+            # the base is written before the snapshots are deleted: a crash in between counts them twice, which is
+            # better than counters that go down
+            write_snapshot(self.path(BASE), as_snapshot(totals))
+            for worker in exited:
+                for extension in ('json', 'lock'):
+                    try:
+                        os.remove(self.path(worker, extension))
+                    except FileNotFoundError:
+                        pass
+
+    def collect(self):
+        '''
+        All the snapshots added up: this process' own, or every worker's when there's a metrics directory
+        '''
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        self.merge_exited()
+        totals = {}
+        with self.directory_lock(fcntl.LOCK_SH if fcntl is not None else None):
+            for worker in self.workers():
+                add_up(totals, read_snapshot(self.path(worker)) or {})
+        return as_snapshot(totals)
+
+
+metrics = Metrics(directory=settings.METRICS_DIR or None)
+
+
+def labels(**values):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in values.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(values, escaped)) + '}'
+
+
+def render(snapshot):
+    '''
+    Turns a snapshot into Prometheus' text exposition format
+    '''
+    lines = [f'# HELP {PREFIX}_http_requests_total Requests by route, method and status code.',
+             f'# TYPE {PREFIX}_http_requests_total counter']
+    for route, method, status, count in sorted(snapshot["requests"]):
+        lines.append(f'{PREFIX}_http_requests_total{labels(route=route, method=method, status=status)} {count}')
+
+    lines += [f'# HELP {PREFIX}_http_request_duration_seconds Request latency by route and method.',
+              f'# TYPE {PREFIX}_http_request_duration_seconds histogram']
+    for route, method, latency in sorted(snapshot["latency"]):
+        cumulative = 0
+        for bound, count in zip([*LATENCY_BUCKETS, '+Inf'], latency):
+            cumulative += count
+            lines.append(f'{PREFIX}_http_request_duration_seconds_bucket'
+                         f'{labels(route=route, method=method, le=bound)} {cumulative}')
+        lines.append(f'{PREFIX}_http_request_duration_seconds_sum{labels(route=route, method=method)} {latency[-1]}')
+        lines.append(f'{PREFIX}_http_request_duration_seconds_count{labels(route=route, method=method)} {cumulative}')
+
+    lines += [f'# HELP {PREFIX}_db_queries_total SQL queries run by route and method.',
+              f'# TYPE {PREFIX}_db_queries_total counter']
+    for route, method, (count, _) in sorted(snapshot["queries"]):
+        lines.append(f'{PREFIX}_db_queries_total{labels(route=route, method=method)} {count}')
+    lines += [f'# HELP {PREFIX}_db_query_seconds_total Time spent running SQL queries by route and method.',
+              f'# TYPE {PREFIX}_db_query_seconds_total counter']
+    for route, method, (_, seconds) in sorted(snapshot["queries"]):
+        lines.append(f'{PREFIX}_db_query_seconds_total{labels(route=route, method=method)} {seconds}')
+
+    lines += [f'# HELP {PREFIX}_http_response_bytes_total Response body bytes by route and method.',
+              f'# TYPE {PREFIX}_http_response_bytes_total counter']
+    for route, method, size in sorted(snapshot["response_bytes"]):
+        lines.append(f'{PREFIX}_http_response_bytes_total{labels(route=route, method=method)} {size}')
+
+    lines += [f'# HELP {PREFIX}_throttled_requests_total Requests refused by the rate limiter by scope.',
+              f'# TYPE {PREFIX}_throttled_requests_total counter']
+    for scope, count in sorted(snapshot["throttled"]):
+        lines.append(f'{PREFIX}_throttled_requests_total{labels(scope=scope)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    return HttpResponse(render(metrics.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class MetricsMiddleware:
+    '''
+    Records the metrics of every request. Works for sync and async views without adding a thread hop to either.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        self.observe(request, response, time.perf_counter() - started, stats)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.METRICS_ENABLED:
+            return await self.get_response(request)
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        self.observe(request, response, time.perf_counter() - started, stats)
+        return response
+
+    def observe(self, request, response, seconds, stats):
+        match = getattr(request, 'resolver_match', None)
+        # the url pattern instead of the path, so every user id doesn't become its own time series
+        route = match.route if match is not None else 'unmatched'
+        size = None if response.streaming else len(response.content)
+        metrics.observe(route, request.method, response.status_code, seconds, stats, size)
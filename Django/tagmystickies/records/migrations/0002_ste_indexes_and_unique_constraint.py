@@ -0,0 +1,42 @@
+# Generated by Django 4.2.15 on 2026-10-17 22:21
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+import django.db.models.deletion
+
+
+def remove_duplicates(apps, schema_editor):
+    '''
+    The duplicate checks used to be done in python and could lose races, so get rid of any duplicates that
+    slipped through before adding the constraint. The oldest row of each (user, sticker, tag) is kept.
+    '''
+    StickerTagEntry = apps.get_model('records', 'StickerTagEntry')
+    duplicates = StickerTagEntry.objects.order_by().values('user', 'sticker', 'tag').annotate(
+        keep=Min('id'), count=Count('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        StickerTagEntry.objects.filter(user=duplicate['user'], sticker=duplicate['sticker'], tag=duplicate['tag']).exclude(
+            id=duplicate['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('records', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='stickertagentry',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='stickers', to='records.userentry'),
+        ),
+        migrations.AddIndex(
+            model_name='stickertagentry',
+            index=models.Index(fields=['user', 'tag', 'sticker', 'file_id'], name='ste_user_tag_sticker_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='stickertagentry',
+            constraint=models.UniqueConstraint(fields=('user', 'sticker', 'tag'), name='unique_user_sticker_tag'),
+        ),
+    ]
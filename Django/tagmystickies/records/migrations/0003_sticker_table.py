@@ -0,0 +1,87 @@
+# Generated by Django 4.2.15 on 2026-10-17 22:24
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def copy_stickers(apps, schema_editor):
+    '''
+    Moves the file_id and set_name of every sticker out of the tag entries and into the new Sticker table.
+    If a sticker's tag entries disagree, the biggest value wins, which at least skips blanks.
+    '''
+    StickerTagEntry = apps.get_model('records', 'StickerTagEntry')
+    Sticker = apps.get_model('records', 'Sticker')
+    rows = StickerTagEntry.objects.order_by().values('sticker').annotate(
+        max_file_id=Max('file_id'), max_set_name=Max('set_name')).values_list('sticker', 'max_file_id', 'max_set_name')
+    batch = []
+    for sticker, file_id, set_name in rows.iterator():
+        batch.append(Sticker(sticker=sticker, file_id=file_id, set_name=set_name))
+        if len(batch) >= 1000:
+            Sticker.objects.bulk_create(batch)
+            batch = []
+    Sticker.objects.bulk_create(batch)
+
+
+def copy_stickers_back(apps, schema_editor):
+    StickerTagEntry = apps.get_model('records', 'StickerTagEntry')
+    Sticker = apps.get_model('records', 'Sticker')
+    info = Sticker.objects.filter(sticker=OuterRef('sticker'))
+    StickerTagEntry.objects.update(file_id=Coalesce(Subquery(info.values('file_id')[:1]), Value('')),
+                                   set_name=Coalesce(Subquery(info.values('set_name')[:1]), Value('')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('records', '0002_ste_indexes_and_unique_constraint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Sticker',
+            fields=[
+                ('sticker', models.CharField(max_length=128, primary_key=True, serialize=False)),
+                ('file_id', models.CharField(blank=True, max_length=128)),
+                ('set_name', models.CharField(blank=True, max_length=128)),
+            ],
+        ),
+        migrations.RunPython(copy_stickers, copy_stickers_back),
+        migrations.RemoveIndex(
+            model_name='stickertagentry',
+            name='ste_user_tag_sticker_idx',
+        ),
+        # the defaults are only there so migrating backwards can add the columns back to a table that has rows
+        migrations.AlterField(
+            model_name='stickertagentry',
+            name='file_id',
+            field=models.CharField(default='', max_length=128),
+        ),
+        migrations.AlterField(
+            model_name='stickertagentry',
+            name='set_name',
+            field=models.CharField(default='', max_length=128),
+        ),
+        migrations.RemoveField(
+            model_name='stickertagentry',
+            name='file_id',
+        ),
+        migrations.RemoveField(
+            model_name='stickertagentry',
+            name='set_name',
+        ),
+        migrations.AddIndex(
+            model_name='stickertagentry',
+            index=models.Index(fields=['user', 'tag', 'sticker'], name='ste_user_tag_sticker_idx'),
+        ),
+        # sticker_info has no column of its own, so there's nothing to do in the database
+        # (and sqlite's schema editor can't remove it again when migrating backwards)
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AddField(
+                model_name='stickertagentry',
+                name='sticker_info',
+                field=models.ForeignObject(from_fields=('sticker',), null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='tag_entries', to='records.sticker', to_fields=('sticker',)),
+            ),
+        ]),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.15 on 2026-10-17 22:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('records', '0003_sticker_table'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stickertagentry',
+            index=models.Index(fields=['user', 'id'], name='ste_user_id_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.15 on 2026-10-17 22:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('records', '0004_ste_user_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StickerUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sticker', models.CharField(max_length=128)),
+                ('score', models.FloatField()),
+                ('uses', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sticker_usage', to='records.userentry')),
+            ],
+        ),
+        # usage is joined on the existing user and sticker columns, it has no column of its own
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AddField(
+                model_name='stickertagentry',
+                name='usage',
+                field=models.ForeignObject(from_fields=('user', 'sticker'), null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='records.stickerusage', to_fields=('user', 'sticker')),
+            ),
+        ]),
+        migrations.AddConstraint(
+            model_name='stickerusage',
+            constraint=models.UniqueConstraint(fields=('user', 'sticker'), name='unique_user_sticker_usage'),
+        ),
+    ]
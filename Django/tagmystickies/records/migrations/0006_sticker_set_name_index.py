@@ -0,0 +1,17 @@
+# Generated by Django 4.2.15 on 2026-10-17 22:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('records', '0005_sticker_usage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sticker',
+            index=models.Index(fields=['set_name', 'sticker'], name='sticker_set_name_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.15 on 2026-10-17 23:02
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def count_tags(apps, schema_editor):
+    '''
+    Counts the tags everyone already has, like records/tag_stats.py rebuild() does
+    '''
+    StickerTagEntry = apps.get_model('records', 'StickerTagEntry')
+    TagStat = apps.get_model('records', 'TagStat')
+    entries = StickerTagEntry.objects.order_by()
+    per_tag = entries.values('user', 'tag').annotate(stickers=Count('id')).values_list('user', 'tag', 'stickers')
+    totals = entries.values('user').annotate(stickers=Count('sticker', distinct=True)).values_list('user', 'stickers')
+    rows = [(user, tag, stickers) for user, tag, stickers in per_tag.iterator()]
+    # the row with an empty tag counts the stickers with any tag
+    rows += [(user, '', stickers) for user, stickers in totals.iterator()]
+    TagStat.objects.bulk_create([TagStat(user_id=user, tag=tag, stickers=stickers) for user, tag, stickers in rows],
+                                batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('records', '0006_sticker_set_name_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tag', models.CharField(blank=True, max_length=128)),
+                ('stickers', models.IntegerField()),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='tag_stats', to='records.userentry')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='tagstat',
+            constraint=models.UniqueConstraint(fields=('user', 'tag'), name='unique_user_tag_stat'),
+        ),
+        migrations.RunPython(count_tags, migrations.RunPython.noop),
+    ]
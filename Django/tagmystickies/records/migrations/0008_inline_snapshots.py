@@ -0,0 +1,28 @@
+# Generated by Django 4.2.15 on 2026-10-17 23:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('records', '0007_tag_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InlineSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tag', models.CharField(blank=True, max_length=128)),
+                ('results', models.TextField()),
+                ('built', models.FloatField()),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='inline_snapshots', to='records.userentry')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='inlinesnapshot',
+            constraint=models.UniqueConstraint(fields=('user', 'tag'), name='unique_user_inline_snapshot'),
+        ),
+    ]
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import DEFERRED
 from django.core.exceptions import ValidationError
 
 '''
@@ -27,22 +28,185 @@ class UserEntry(models.Model):
         ordering = ['user']
 
 
+class Sticker(models.Model):
+    '''
+    Sticker model stores what telegram tells us about a sticker, once per sticker no matter how many users tagged it
+    or how many tags it has. Refreshing a sticker's file_id is a single row update.
+    '''
+    sticker = models.CharField(
+        max_length=128, primary_key=True)  # the file_unique_id of the sticker
+    file_id = models.CharField(max_length=128, blank=True)  # the file_id of the sticker
+    # the set that the sticker belongs to
+    set_name = models.CharField(max_length=128, blank=True)
+
+    class Meta:
+        indexes = [
+            # the stickers of a set, for the set level endpoints. the sticker is in it so the table isn't touched
+            models.Index(fields=['set_name', 'sticker'], name='sticker_set_name_idx'),
+        ]
+
+    @classmethod
+    def remember(cls, stickers):
+        '''
+        Inserts or updates Sticker rows from (sticker, file_id, set_name) tuples in one query per batch.
+        Blank file_ids and set_names never overwrite ones we already have.
+        '''
+        complete = {}
+        partial = {}
+        for sticker, file_id, set_name in stickers:
+            if file_id and set_name:
+                complete[sticker] = cls(sticker=sticker, file_id=file_id, set_name=set_name)
+            else:
+                partial[sticker] = cls(sticker=sticker, file_id=file_id or '', set_name=set_name or '')
+        if complete:
+            cls.objects.bulk_create(complete.values(), batch_size=500, update_conflicts=True,
+                                    unique_fields=['sticker'], update_fields=['file_id', 'set_name'])
+        partial = [info for sticker, info in partial.items()
+                   if sticker not in complete]
+        for info in partial:
+            # rare enough (only single entries saved without their file_id or set_name) to do one at a time
+            update_fields = [name for name in ('file_id', 'set_name') if getattr(info, name)]
+            if update_fields:
+                cls.objects.bulk_create([info], update_conflicts=True,
+                                        unique_fields=['sticker'], update_fields=update_fields)
+            else:
+                cls.objects.bulk_create([info], ignore_conflicts=True)
+
+
+class StickerUsage(models.Model):
+    '''
+    How much a user uses one of their stickers, so their favorites come first in the inline results.
+    score is a decayed count of the uses kept in log space, see records/usage.py for how it works.
+    '''
+    user = models.ForeignKey(
+        UserEntry, on_delete=models.CASCADE, related_name='sticker_usage', db_index=False)
+    sticker = models.CharField(max_length=128)  # the file_unique_id of the sticker
+    score = models.FloatField()
+    uses = models.PositiveIntegerField(default=0)  # every use ever, without any decay
+
+    class Meta:
+        constraints = [
+            # the index behind this is the only one the table needs, every lookup is by user and sticker
+            models.UniqueConstraint(
+                fields=['user', 'sticker'], name='unique_user_sticker_usage'),
+        ]
+
+
+class TagStat(models.Model):
+    '''
+    How many of a user's stickers have each of their tags, kept up to date by everything that writes sticker tag
+    entries (see records/tag_stats.py), so nothing has to count them when they're asked for.
+    The row with an empty tag (no real tag can be empty) counts the stickers that have any tag at all.
+    '''
+    user = models.ForeignKey(
+        UserEntry, on_delete=models.CASCADE, related_name='tag_stats', db_index=False)
+    tag = models.CharField(max_length=128, blank=True)
+    # not a PositiveIntegerField, a count that's off (see the rebuild_tag_stats command) mustn't make writes fail
+    stickers = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            # every lookup is by user, or by user and tag
+            models.UniqueConstraint(fields=['user', 'tag'], name='unique_user_tag_stat'),
+        ]
+
+
+class InlineSnapshot(models.Model):
+    '''
+    The inline results of a one-tag query, ready to be paged: every sticker of the user's with the tag, as JSON
+    [sticker, file_id, usage score] rows in the order filter-stickers returns them. The empty tag has all of their
+    stickers, for the query without any tags. Built when a query first needs one and thrown away whenever the user's
+    tags or usage change (see records/inline_snapshots.py).
+    '''
+    user = models.ForeignKey(
+        UserEntry, on_delete=models.CASCADE, related_name='inline_snapshots', db_index=False)
+    tag = models.CharField(max_length=128, blank=True)
+    results = models.TextField()
+    built = models.FloatField()  # unix time
+
+    class Meta:
+        constraints = [
+            # every lookup is one (user, tag), or all of a user's
+            models.UniqueConstraint(fields=['user', 'tag'], name='unique_user_inline_snapshot'),
+        ]
+
+
 class StickerTagEntry(models.Model):
     '''
     Sticker Tag Entry model represents 1 tag per user per sticker. tags are lower case and can't have certain special characters.
+    The sticker's file_id and set_name live in the Sticker table. They can still be read and written here as if they
+    were fields (they get saved to the Sticker table along with the entry), but querysets have to go through
+    sticker_info, e.g. filter(sticker_info__set_name=...)
     '''
     sticker = models.CharField(
         max_length=128)  # the file_unique_id of the sticker
+    # no index of its own, every index below starts with the user
     user = models.ForeignKey(
-        UserEntry, on_delete=models.CASCADE, related_name='stickers')
+        UserEntry, on_delete=models.CASCADE, related_name='stickers', db_index=False)
     tag = models.CharField(max_length=128)
-    # the set that the sticker belongs to (necessary for )
-    set_name = models.CharField(max_length=128)
-    file_id = models.CharField(max_length=128)  # the file_id of the sticker
+    # joins on the sticker column above, there's no extra column for this
+    sticker_info = models.ForeignObject(
+        Sticker, on_delete=models.DO_NOTHING, from_fields=['sticker'], to_fields=['sticker'], null=True,
+        related_name='tag_entries')
+    # the user's usage of the sticker, also joined on existing columns. null for stickers they never used
+    usage = models.ForeignObject(
+        StickerUsage, on_delete=models.DO_NOTHING, from_fields=['user', 'sticker'], to_fields=['user', 'sticker'],
+        null=True, related_name='+')
     special_chars = [' ', '\n', '\r', ',', '"']
+    duplicate_message = "Duplicate tags for the same sticker and user are not allowed."
+
+    # file_id and set_name that were given to this object but haven't been saved to the Sticker table yet
+    _file_id = None
+    _set_name = None
+    # the (user, sticker, tag) the entry has in the database, so saving a change can move it in the tag stats
+    _saved = None
 
     class Meta:
         ordering = ['tag', 'user', 'sticker']
+        constraints = [
+            # the index behind this also covers the (user, sticker) lookups
+            models.UniqueConstraint(
+                fields=['user', 'sticker', 'tag'], name='unique_user_sticker_tag'),
+        ]
+        indexes = [
+            # covers the inline queries (user + tags -> stickers) without touching the table
+            models.Index(fields=['user', 'tag', 'sticker'],
+                         name='ste_user_tag_sticker_idx'),
+            # paging through a user's entries in id order (see records/pagination.py)
+            models.Index(fields=['user', 'id'], name='ste_user_id_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        saved = tuple(instance.__dict__.get(name, DEFERRED) for name in ('user_id', 'sticker', 'tag'))
+        if DEFERRED not in saved:
+            instance._saved = saved
+        return instance
+
+    def _sticker_info_value(self, name):
+        info = self.sticker_info
+        return getattr(info, name) if info is not None else ''
+
+    @property
+    def file_id(self):
+        if self._file_id is not None:
+            return self._file_id
+        return self._sticker_info_value('file_id')
+
+    @file_id.setter
+    def file_id(self, value):
+        self._file_id = value
+
+    @property
+    def set_name(self):
+        if self._set_name is not None:
+            return self._set_name
+        return self._sticker_info_value('set_name')
+
+    @set_name.setter
+    def set_name(self, value):
+        self._set_name = value
 
     def clean(self):
         # Special characters to check
@@ -53,10 +217,10 @@ class StickerTagEntry(models.Model):
             self.sticker = self.sticker.strip()
         if self.tag:
             self.tag = self.tag.lower().strip()
-        if self.set_name:
-            self.set_name = self.set_name.strip()
-        if self.file_id:
-            self.file_id = self.file_id.strip()
+        if self._set_name:
+            self._set_name = self._set_name.strip()
+        if self._file_id:
+            self._file_id = self._file_id.strip()
 
             # Check for special characters in the tag
             for char in special_chars:
@@ -64,12 +228,74 @@ class StickerTagEntry(models.Model):
                     raise ValidationError(
                         f'Special characters {special_chars} are not allowed in the tag.')
 
-        # Check for duplicates
-        if StickerTagEntry.objects.filter(user=self.user, sticker=self.sticker, tag=self.tag).exists():
-            raise ValidationError(
-                "Duplicate tags for the same sticker and user are not allowed.")
+        # duplicates are left to the unique_user_sticker_tag constraint, see save()
+
+    def is_duplicate(self):
+        '''
+        whether another entry has this entry's (user, sticker, tag) already
+        '''
+        return StickerTagEntry.objects.filter(
+            user_id=self.user_id, sticker=self.sticker, tag=self.tag).exclude(pk=self.pk).exists()
 
     def save(self, *args, **kwargs):
+        from records import tag_stats
+        from records.signals import notify_tags_changed
         # Call the clean method to run validations
         self.clean()
-        super().save(*args, **kwargs)
+        adding = self._state.adding
+        previous = self._saved
+        try:
+            # the savepoint keeps a duplicate from breaking a surrounding transaction
+            with transaction.atomic():
+                # every entry needs its Sticker row, and new file_ids and set_names need to be saved there
+                if adding or self._file_id or self._set_name:
+                    Sticker.remember(
+                        [(self.sticker, self._file_id, self._set_name)])
+                super().save(*args, **kwargs)
+                saved = (self.user_id, self.sticker, self.tag)
+                if adding:
+                    tag_stats.entries_added(self.user_id, [(self.sticker, self.tag)])
+                elif self._saved is None:
+                    # loaded with some of its fields deferred, so we don't know what it was before
+                    tag_stats.rebuild([self.user_id])
+                elif self._saved != saved:
+                    old_user, old_sticker, old_tag = self._saved
+                    tag_stats.entries_removed(old_user, [(old_sticker, old_tag)])
+                    tag_stats.entries_added(self.user_id, [(self.sticker, self.tag)])
+        except IntegrityError:
+            # only the unique constraint is the caller's mistake, anything else (a missing user, ...) is re-raised.
+            # this only costs a query when the save failed
+            if self.is_duplicate():
+                raise ValidationError(self.duplicate_message)
+            raise
+        self._saved = saved
+        # sent once the savepoint is gone, so when nothing around the save has a transaction open it has committed,
+        # and the caches can add the new entry instead of throwing everything away (see records/signals.py)
+        if adding:
+            notify_tags_changed(self.user_id, entry=self, stickers=[self.sticker], tags=[self.tag])
+        elif previous is None:
+            notify_tags_changed(self.user_id)
+        elif previous != saved:
+            old_user, old_sticker, old_tag = previous
+            if old_user != self.user_id:
+                notify_tags_changed(old_user, stickers=[old_sticker], tags=[old_tag])
+                notify_tags_changed(self.user_id, stickers=[self.sticker], tags=[self.tag])
+            else:
+                notify_tags_changed(self.user_id, stickers={old_sticker, self.sticker}, tags={old_tag, self.tag})
+        elif self._file_id or self._set_name:
+            # only the sticker's file_id or set_name changed
+            notify_tags_changed(self.user_id, stickers=[self.sticker], tags=[])
+
+    def delete(self, *args, **kwargs):
+        # queryset .delete() calls don't come through here, whoever does those has to send the signal themselves
+        # (and use records.tag_stats.delete_entries() so the tag stats get updated).
+        # we don't listen to post_delete instead because that would stop django from doing fast bulk deletes
+        from records import tag_stats
+        from records.signals import notify_tags_changed
+        user, sticker, tag = self._saved or (self.user_id, self.sticker, self.tag)
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            tag_stats.entries_removed(user, [(sticker, tag)])
+        self._saved = None
+        notify_tags_changed(self.user_id, stickers=[sticker], tags=[tag])
+        return result
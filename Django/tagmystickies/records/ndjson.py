@@ -0,0 +1,198 @@
+import json
+from django.db import IntegrityError, connection, transaction
+from django.db.models.constants import OnConflict
+from records.aggregates import GroupConcat
+from records.bulk import INSERT_BATCH_SIZE, LOOKUP_BATCH_SIZE, MAX_LENGTH, clean_tags
+from records.models import Sticker, StickerTagEntry, UserEntry
+from records.signals import notify_tags_changed
+from records import tag_stats
+from records.streaming import ROW_CHUNK_SIZE, dumps
+
+'''
+Exporting and importing tag libraries as NDJSON (one JSON object per line), for backups and moving data around.
+
+Every user is a line, followed by a line per sticker of theirs:
+    {"user": 1234, "chat": 3845, "status": ""}
+    {"user": 1234, "sticker": "abc", "file_id": "xyz", "set_name": "cats", "tags": ["cat", "happy"]}
+
+Exports read the database with .iterator() so they use the same memory however big the library is.
+Imports read the lines a chunk at a time and write each chunk in its own transaction. They only ever
+add: users get created or updated, and tags the user already has on a sticker are skipped, so importing the same file
+twice changes nothing.
+'''
+
+CONTENT_TYPE = 'application/x-ndjson'
+# how many lines get written in one transaction
+IMPORT_CHUNK_SIZE = 10000
+# how many of the rejected line numbers the report lists
+MAX_REJECTED_LINES = 100
+
+
+def export_lines(user=None):
+    '''
+    The NDJSON lines of one user's library, or of every user's when user is None
+    '''
+    users = UserEntry.objects.order_by('user')
+    entries = StickerTagEntry.objects.order_by()
+    if user is not None:
+        users = users.filter(user=user)
+        entries = entries.filter(user=user)
+    for entry in users.values_list('user', 'chat', 'status').iterator(chunk_size=ROW_CHUNK_SIZE):
+        yield dumps(dict(zip(('user', 'chat', 'status'), entry))) + '\n'
+    # every user is written before any stickers, so an import never sees a sticker before its user
+    rows = entries.values('user', 'sticker', 'sticker_info__file_id', 'sticker_info__set_name').annotate(
+        tags=GroupConcat('tag')).order_by('user', 'sticker').values_list(
+        'user', 'sticker', 'sticker_info__file_id', 'sticker_info__set_name', 'tags')
+    for user, sticker, file_id, set_name, tags in rows.iterator(chunk_size=ROW_CHUNK_SIZE):
+        yield dumps({"user": user, "sticker": sticker, "file_id": file_id or '', "set_name": set_name or '',
+                     "tags": sorted(tags.split(','))}) + '\n'
+
+
+def parse_line(line):
+    '''
+    Returns ('user', (user, chat, status)) or ('sticker', (user, sticker, file_id, set_name, tags)) for a line,
+    None for a blank one. Raises ValueError when the line isn't valid.
+    '''
+    if isinstance(line, bytes):
+        line = line.decode()
+    if not line.strip():
+        return None
+    data = json.loads(line)
+    if not isinstance(data, dict) or type(data.get('user')) is not int:
+        raise ValueError('every line needs an integer "user".')
+    if 'sticker' not in data:
+        status = data.get('status') or ''
+        if type(data.get('chat')) is not int or not isinstance(status, str):
+            raise ValueError('a user line needs an integer "chat".')
+        return 'user', (data['user'], data['chat'], status.strip())
+    fields = [data.get(name) or '' for name in ('sticker', 'file_id', 'set_name')]
+    if not all(isinstance(field, str) and len(field.strip()) <= MAX_LENGTH for field in fields) or not fields[0].strip():
+        raise ValueError('a sticker line needs a "sticker".')
+    tags, invalid = clean_tags(data.get('tags') if isinstance(data.get('tags'), list) else None)
+    if invalid or not tags:
+        raise ValueError('a sticker line needs a list of valid "tags".')
+    return 'sticker', (data['user'], *(field.strip() for field in fields), tags)
+
+
+def insert_rows(model, names, rows, on_conflict, update_names=(), unique_names=()):
+    '''
+    Inserts rows (tuples of the fields in names) like bulk_create(ignore_conflicts=True) or bulk_create(
+    update_conflicts=True) would, but without building a model object and compiling the SQL for every row, which is
+    nearly all the time bulk_create takes for a big import. The statement comes from the database backend, so it's the
+    same SQL bulk_create would run. Returns how many rows got inserted or updated, conflicts that were ignored don't
+    count.
+    '''
+    if not rows:
+        return 0
+    ops = connection.ops
+    fields = [model._meta.get_field(name) for name in names]
+    columns = ', '.join(ops.quote_name(field.column) for field in fields)
+    placeholders = ', '.join(['%s'] * len(fields))
+    suffix = ops.on_conflict_suffix_sql(fields, on_conflict, [model._meta.get_field(name).column for name in update_names],
+                                        [model._meta.get_field(name).column for name in unique_names])
+    sql = (f'{ops.insert_statement(on_conflict=on_conflict)} {ops.quote_name(model._meta.db_table)} '
+           f'({columns}) VALUES ({placeholders}) {suffix}')
+    written = 0
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), INSERT_BATCH_SIZE * 10):
+            cursor.executemany(sql, rows[i:i + INSERT_BATCH_SIZE * 10])
+            written += cursor.rowcount
+    return written
+
+
+class Importer:
+    '''
+    Imports NDJSON lines a chunk at a time. Counts what it did in a report.
+    The tag stats of the users it added entries to get recounted once at the end, so until the import is done they
+    can be behind.
+    '''
+
+    def __init__(self, chunk_size=IMPORT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        # entries counts the tags that got added, the ones that were already there don't count
+        self.report = {"lines": 0, "users": 0, "stickers": 0, "entries": 0, "rejected": 0, "rejected_lines": []}
+        # the users with new entries, whose tag stats need recounting
+        self.touched = set()
+
+    def run(self, lines):
+        '''
+        Imports every line. Returns the report, with an "error" in it if a chunk couldn't be written, in which case
+        that chunk and everything after it weren't imported.
+        '''
+        try:
+            chunk = []
+            for number, line in enumerate(lines, start=1):
+                self.report["lines"] = number
+                try:
+                    parsed = parse_line(line)
+                except (ValueError, UnicodeDecodeError):
+                    self.reject(number)
+                    continue
+                if parsed is not None:
+                    chunk.append((number, *parsed))
+                if len(chunk) >= self.chunk_size:
+                    if not self.write(chunk):
+                        return self.report
+                    chunk = []
+            if chunk:
+                self.write(chunk)
+            return self.report
+        finally:
+            # recounting after every chunk would read a user's whole library again for each one. the chunks that
+            # were written before one that failed stay written, so they get recounted too
+            tag_stats.rebuild(self.touched)
+
+    def reject(self, number):
+        self.report["rejected"] += 1
+        if len(self.report["rejected_lines"]) < MAX_REJECTED_LINES:
+            self.report["rejected_lines"].append(number)
+
+    def write(self, chunk):
+        users = {values[0]: values for _, kind, values in chunk if kind == 'user'}
+        stickers = [(number, values) for number, kind, values in chunk if kind == 'sticker']
+        try:
+            with transaction.atomic():
+                if users:
+                    UserEntry.objects.bulk_create(
+                        [UserEntry(user=user, chat=chat, status=status) for user, chat, status in users.values()],
+                        batch_size=INSERT_BATCH_SIZE, update_conflicts=True, unique_fields=['user'],
+                        update_fields=['chat', 'status'])
+                known = self.existing_users({values[0] for _, values in stickers})
+                entries = []
+                infos = {}
+                imported = 0
+                for number, (user, sticker, file_id, set_name, tags) in stickers:
+                    if user not in known:
+                        self.reject(number)
+                        continue
+                    # a sticker seen with its file_id and set_name keeps them even if a later line leaves them out
+                    if file_id and set_name or sticker not in infos:
+                        infos[sticker] = (sticker, file_id, set_name)
+                    entries += [(user, sticker, tag) for tag in tags]
+                    imported += 1
+                complete = [info for info in infos.values() if info[1] and info[2]]
+                insert_rows(Sticker, ('sticker', 'file_id', 'set_name'), complete, OnConflict.UPDATE,
+                            update_names=('file_id', 'set_name'), unique_names=('sticker',))
+                # the few without a file_id or set_name must not blank out the ones we already have
+                Sticker.remember(info for info in infos.values() if not (info[1] and info[2]))
+                # tags they already have get skipped
+                added = insert_rows(StickerTagEntry, ('user', 'sticker', 'tag'), entries, OnConflict.IGNORE)
+        except IntegrityError as e:
+            # e.g. a chat that belongs to a different user already
+            self.report["error"] = f"lines {chunk[0][0]} to {chunk[-1][0]} could not be imported: {e}"
+            return False
+        self.report["users"] += len(users)
+        self.report["stickers"] += imported
+        self.report["entries"] += added
+        # which of the entries were already there isn't known, so run() recounts the users' tag stats at the end
+        self.touched.update(user for user, _, _ in entries)
+        for user in users.keys() | known:
+            notify_tags_changed(user)
+        return True
+
+    def existing_users(self, users):
+        users = list(users)
+        known = set()
+        for i in range(0, len(users), LOOKUP_BATCH_SIZE):
+            known.update(UserEntry.objects.filter(user__in=users[i:i + LOOKUP_BATCH_SIZE]).values_list('user', flat=True))
+        return known
@@ -0,0 +1,34 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+'''
+Keyset (cursor) paging for the list endpoints.
+
+Every page is fetched with "WHERE <ordering column> > <where the last page ended> ORDER BY <ordering column> LIMIT n",
+which walks an index, so a page costs the same no matter how deep into the table it is or how big the table gets.
+The cursor in the "next" and "previous" links is opaque, clients should just follow the links.
+
+Paging is opt in: a list request without "cursor" or "page_size" in the query parameters still gets the whole list
+as a plain array, which is what the bot expects. Pass ?page_size= to get the first page.
+'''
+
+
+class KeysetPagination(CursorPagination):
+    page_size = settings.LIST_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.LIST_MAX_PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params and self.page_size_query_param not in request.query_params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+
+class UserEntryPagination(KeysetPagination):
+    # the primary key
+    ordering = 'user'
+
+
+class StickerTagEntryPagination(KeysetPagination):
+    # the primary key, or the (user, id) index when the list is filtered by user
+    ordering = 'id'
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.dispatch import receiver
+from records.filtering import StickerQuery
+from records.signals import sticker_used, tags_changed
+
+'''
+A cache of whole FilterStickersView responses, so repeated inline queries (the user retyping the same tags, telegram
+retrying) get answered without going to the database at all, not even to look the user up.
+
+Responses are stored in django's cache under the user's current "generation". Every time one of the user's tags
+changes (anything that sends tags_changed, see records/signals.py) the generation is bumped, so the old responses can
+never be found again and just expire. Deleting the user bumps it too, so a cached response can't outlive the user.
+Recording a sticker use bumps it as well, since that changes the order the stickers come back in.
+
+Turn it off with FILTER_CACHE_ENABLED=False. The default cache is per process, like the tag index, so configure a
+shared CACHES backend when running more than one worker.
+'''
+
+
+class ResponseCache:
+    '''
+    Caches filter-stickers response bodies per (user, generation, query) and counts hits and misses.
+    '''
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def enabled(self):
+        return settings.FILTER_CACHE_ENABLED
+
+    def parse(self, data):
+        '''
+        the query a request body asks for, or None if it's not one we can cache (the view will report what's wrong)
+        '''
+        try:
+            return StickerQuery.from_data(int(data.get('user', None)), data)
+        except (TypeError, ValueError):
+            return None
+
+    def generation_key(self, user):
+        return f'{self.prefix}:generation:{user}'
+
+    def response_key(self, query, generation):
+        # tags are sorted so the same search typed in a different order is still a hit
+        parts = [sorted(query.tags), sorted(query.exclude_tags), query.match, query.prefix, query.fuzzy, query.ids,
+                 query.after, query.after_score, query.page if query.after is None else None, query.limit,
+                 query.expression.text if query.expression is not None else None]
+        digest = hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+        return f'{self.prefix}:{query.user}:{generation}:{digest}'
+
+    def key_for(self, data):
+        '''
+        Returns the cache key for a request body, or None if it can't be cached
+        '''
+        if not self.enabled():
+            return None
+        query = self.parse(data)
+        if query is None:
+            return None
+        return self.response_key(query, self.generation(query.user))
+
+    async def akey_for(self, data):
+        if not self.enabled():
+            return None
+        query = self.parse(data)
+        if query is None:
+            return None
+        return self.response_key(query, await self.ageneration(query.user))
+
+    def generation(self, user):
+        '''
+        Returns the user's current generation, it changes every time their tags do
+        '''
+        key = self.generation_key(user)
+        generation = cache.get(key)
+        if generation is None:
+            # starting from the clock instead of 0 means a generation that got evicted can't be reused
+            cache.add(key, time.time_ns(), timeout=None)
+            generation = cache.get(key)
+        return generation
+
+    async def ageneration(self, user):
+        key = self.generation_key(user)
+        generation = await cache.aget(key)
+        if generation is None:
+            await cache.aadd(key, time.time_ns(), timeout=None)
+            generation = await cache.aget(key)
+        return generation
+
+    def get(self, key):
+        if key is None:
+            return None
+        return self._count(cache.get(key))
+
+    async def aget(self, key):
+        if key is None:
+            return None
+        return self._count(await cache.aget(key))
+
+    def set(self, key, body):
+        if key is not None:
+            cache.set(key, body, timeout=settings.FILTER_CACHE_TIMEOUT)
+
+    async def aset(self, key, body):
+        if key is not None:
+            await cache.aset(key, body, timeout=settings.FILTER_CACHE_TIMEOUT)
+
+    def invalidate(self, user):
+        '''
+        Bumps the user's generation, which makes every response cached for them unreachable
+        '''
+        key = self.generation_key(user)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # nothing cached for them yet
+            cache.set(key, time.time_ns(), timeout=None)
+        with self._lock:
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.invalidations = 0
+
+    def _count(self, body):
+        with self._lock:
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return body
+
+
+filter_cache = ResponseCache(prefix='filter-stickers')
+
+
+@receiver(tags_changed)
+def invalidate_filter_cache(sender, user, entry=None, **kwargs):
+    filter_cache.invalidate(user)
+
+
+@receiver(sticker_used)
+def invalidate_filter_cache_on_use(sender, user, **kwargs):
+    filter_cache.invalidate(user)
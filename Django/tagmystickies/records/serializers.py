@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from records.models import UserEntry, StickerTagEntry
+from records.tag_query import parse_query
 from django.core.exceptions import ValidationError
 
 '''
@@ -36,45 +37,6 @@ class TagSerializer(serializers.ModelSerializer):
         fields = ['tag']
 
 
-class StickerSerializer(serializers.ModelSerializer):
-    '''
-    This serializer handles the serialization of stickers, including their associated tags.
-    It uses a custom method field to gather all tags associated with a given sticker and user.
-    This is meant for read-only operations (display only)
-    '''
-    # This field will be populated by a method rather than directly from the model.
-    tags = serializers.SerializerMethodField()
-
-    class Meta:
-        model = StickerTagEntry
-        # Specifies that the 'sticker' and 'tags' fields will be included in the serialized output.
-        fields = ['sticker', 'tags', "set_name", "file_id"]
-
-    # Custom method to get all tags associated with the sticker for the specific user.
-    # This ensures that only tags belonging to the specific user and sticker combination are retrieved.
-    def get_tags(self, obj):
-        tags = StickerTagEntry.objects.filter(
-            sticker=obj.sticker, user=obj.user).values_list('tag', flat=True)
-        return tags
-
-
-class UserStickerTagSerializer(serializers.ModelSerializer):
-    '''
-    This serializer is responsible for serializing a user and all their associated stickers.
-    It nests the StickerSerializer to include the sticker data and associated tags within the user serialization.
-    This is intended to be used as read-only
-    '''
-    # This field links to the 'stickers' related_name from the UserEntry model,
-    # allowing us to access all stickers associated with this user.
-    # 'many=True' indicates that this is a one-to-many relationship, so we expect multiple stickers.
-    stickers = StickerSerializer(source='stickers', many=True)
-
-    class Meta:
-        model = UserEntry
-        # Specifies that these fields will be included in the serialized output.
-        fields = ['user', 'chat', 'status', 'stickers']
-
-
 class UserEntrySerializer(serializers.ModelSerializer):
     '''
     this serializer is for serializing just user entry objects
@@ -123,6 +85,10 @@ class StickerTagEntrySerializer(serializers.ModelSerializer):
     # pulling the special characters list from the model
     special_chars = StickerTagEntry.special_chars
 
+    # these are stored in the Sticker table now, so they have to be declared by hand
+    file_id = serializers.CharField(max_length=128)
+    set_name = serializers.CharField(max_length=128)
+
     def validate_tag(self, value):
         """
         Custom validation for the 'tag' field to check for special characters.
@@ -152,33 +118,25 @@ class StickerTagEntrySerializer(serializers.ModelSerializer):
         """
         return value.strip()
 
-    def validate(self, data):
-        """
-        Cross-field validation for duplicates only if we're saving a new object (not updating an existing one).
-        """
-        user = data.get('user')
-        sticker = data.get('sticker')
-        tag = data.get('tag')
-        # file_id = data.get('file_id')
-        # set_name = data.get('set_name')
-
-        # Check for duplicates, but exclude the current instance if updating
-        queryset = StickerTagEntry.objects.filter(
-            user=user, sticker=sticker, tag=tag)
-
-        if self.instance:
-            # Exclude the current instance from the queryset if updating
-            queryset = queryset.exclude(id=self.instance.id)
-
-        if queryset.exists():
-            raise ValidationError(
-                "Duplicate tags for the same sticker and user are not allowed.")
+    # Duplicates aren't checked here, the database's unique constraint catches them when saving.
+    # The model turns that into a ValidationError, and these turn it into the usual 400 response.
+    def create(self, validated_data):
+        try:
+            return super().create(validated_data)
+        except ValidationError as e:
+            raise serializers.ValidationError(serializers.as_serializer_error(e))
 
-        return data
+    def update(self, instance, validated_data):
+        try:
+            return super().update(instance, validated_data)
+        except ValidationError as e:
+            raise serializers.ValidationError(serializers.as_serializer_error(e))
 
     class Meta:
         model = StickerTagEntry
         fields = ['id', 'sticker', 'user', 'tag', 'file_id', 'set_name']
+        # stops rest framework from adding its own duplicate check query for the unique constraint
+        validators = []
 
 
 class StickerFilterSerializer(serializers.Serializer):
@@ -189,15 +147,21 @@ class StickerFilterSerializer(serializers.Serializer):
     user = serializers.IntegerField()
     tags = serializers.ListField(child=serializers.CharField(
         max_length=128), required=False, allow_empty=True, allow_null=True)
+    query = serializers.CharField(required=False, allow_blank=True)
 
     def validate_tags(self, value):
-        new_array = [tag.strip().lower() for tag in value]
+        # tags with a character a tag can't have are dropped, as are blanks and duplicates
+        new_array = [tag.strip().lower() for tag in value or []]
         validated_list = []
         for item in new_array:
-            for char in StickerTagEntry.special_chars:
-                if char in item:
-                    pass
-                else:
-                    validated_list.append(item)
-
+            if item and item not in validated_list and not any(char in item for char in StickerTagEntry.special_chars):
+                validated_list.append(item)
         return validated_list
+
+    def validate_query(self, value):
+        # see records/tag_query.py
+        try:
+            parse_query(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return value
@@ -0,0 +1,63 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+from records.models import StickerTagEntry, StickerUsage, UserEntry
+
+'''
+Signals let the different caches in this app find out when a user's tags change without the views having to know
+about every one of them. Anything that writes sticker tag entries should call notify_tags_changed(user) afterwards.
+StickerTagEntry.save() and .delete() do it themselves, after their own savepoint is gone.
+
+Receivers get the user id as "user". "entry" is only supplied when a single, freshly created StickerTagEntry caused
+the change, so receivers can update themselves incrementally instead of throwing everything away.
+Writers that know what they changed also pass "stickers", the stickers whose tags changed, and "tags", the tags that
+were added to or removed from them. stickers is None when anything could have changed.
+"after_commit" is True when the signal is the one sent again after the transaction committed (see below).
+
+sticker_used is sent with "user", "sticker" and the sticker's new usage "score" whenever a use gets recorded
+(see records/usage.py). It changes the order of the user's results but never which stickers match.
+'''
+
+tags_changed = Signal()
+sticker_used = Signal()
+
+
+def notify_tags_changed(user, entry=None, stickers=None, tags=()):
+    '''
+    Tells every receiver that a user's tags changed.
+    If we're inside a transaction the signal is sent again once it commits, so a cache that got rebuilt from
+    the uncommitted state in the meantime gets thrown away too. The entry is dropped in that case because the
+    transaction could still roll back.
+    '''
+    user = getattr(user, 'user', user)  # accept a UserEntry or a plain user id
+    if stickers is not None:
+        stickers, tags = list(stickers), list(tags)
+    in_transaction = transaction.get_connection().in_atomic_block
+    if in_transaction:
+        entry = None
+    tags_changed.send(sender=StickerTagEntry, user=user, entry=entry, stickers=stickers, tags=tags,
+                      after_commit=False)
+    if in_transaction:
+        transaction.on_commit(lambda: tags_changed.send(
+            sender=StickerTagEntry, user=user, entry=None, stickers=stickers, tags=tags, after_commit=True))
+
+
+def notify_sticker_used(user, sticker, score):
+    '''
+    Tells every receiver that a sticker's usage score changed. It's only sent once the transaction commits, since
+    receivers apply the new score as it is and a rollback would leave them with one that was never saved.
+    '''
+    transaction.on_commit(lambda: sticker_used.send(
+        sender=StickerUsage, user=user, sticker=sticker, score=score))
+
+
+@receiver(post_save, sender=UserEntry)
+def user_entry_saved(sender, instance, created, **kwargs):
+    # a brand new user can't have anything cached yet unless an old user with the same id got deleted
+    if created:
+        notify_tags_changed(instance.user)
+
+
+@receiver(post_delete, sender=UserEntry)
+def user_entry_deleted(sender, instance, **kwargs):
+    notify_tags_changed(instance.user)
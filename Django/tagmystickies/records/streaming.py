@@ -0,0 +1,93 @@
+import json
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from records.aggregates import GroupConcat
+from records.models import StickerTagEntry
+from records.renderers import orjson_dumps, orjson_enabled
+
+'''
+Streamed responses, for the endpoints that can return more than we'd want to hold in memory at once.
+The response gets written out while the rows are still being read from the database.
+'''
+
+# the response is sent in pieces of about this many bytes
+CHUNK_SIZE = 64 * 1024
+# how many rows django fetches from the database cursor at a time
+ROW_CHUNK_SIZE = 2000
+
+
+def dumps(value):
+    # the same compact output as rest framework's JSONRenderer, made by orjson if it's on (see records/renderers.py)
+    if orjson_enabled():
+        return orjson_dumps(value).decode()
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def buffered(parts, size=CHUNK_SIZE):
+    '''
+    Joins lots of small strings into chunks of about size bytes, so we don't send a tiny write per row
+    '''
+    buffer = []
+    length = 0
+    for part in parts:
+        buffer.append(part)
+        length += len(part)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+async def iterate_in_thread(iterator):
+    '''
+    Runs a normal iterator one step at a time in django's sync thread, the same one the view ran in (so it's the same
+    database connection too)
+    '''
+    iterator = iter(iterator)
+    done = object()
+    while True:
+        chunk = await sync_to_async(next, thread_sensitive=True)(iterator, done)
+        if chunk is done:
+            break
+        yield chunk
+
+
+def streaming_response(request, parts, content_type='application/json'):
+    '''
+    Builds a StreamingHttpResponse out of a generator of strings.
+    Under ASGI (hypercorn) django would read a normal generator into a list before sending any of it,
+    so there it gets handed an async generator that pulls one chunk at a time instead.
+    '''
+    chunks = buffered(parts)
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        chunks = iterate_in_thread(chunks)
+    return StreamingHttpResponse(chunks, content_type=content_type)
+
+
+def library_rows(user):
+    '''
+    One row per sticker: (sticker, file_id, set_name, comma separated tags), all in a single grouped query
+    '''
+    return StickerTagEntry.objects.filter(user=user).order_by().values(
+        'sticker', 'sticker_info__file_id', 'sticker_info__set_name').annotate(
+        tags=GroupConcat('tag')).order_by('sticker').values_list(
+        'sticker', 'sticker_info__file_id', 'sticker_info__set_name', 'tags')
+
+
+def library_parts(user_entry):
+    '''
+    The JSON for a user and every one of their stickers, a piece at a time
+    '''
+    header = dumps({"user": user_entry.user, "chat": user_entry.chat,
+                   "status": user_entry.status})
+    # open up the user object again to put the stickers in
+    yield header[:-1] + ',"stickers":['
+    separator = ''
+    for sticker, file_id, set_name, tags in library_rows(user_entry.user).iterator(chunk_size=ROW_CHUNK_SIZE):
+        yield separator + dumps({"sticker": sticker, "tags": sorted(tags.split(',')),
+                                 "set_name": set_name or '', "file_id": file_id or ''})
+        separator = ','
+    yield ']}'
@@ -0,0 +1,505 @@
+import contextvars
+import heapq
+import threading
+from asgiref.sync import sync_to_async
+from bisect import bisect_left
+from collections import OrderedDict
+from django.conf import settings
+from django.db import transaction
+from django.dispatch import receiver
+from records.fuzzy import TrigramIndex
+from records.models import Sticker, StickerTagEntry
+from records.signals import sticker_used, tags_changed
+
+'''
+An in-memory inverted index of every user's tags, so the inline mode of the bot can be answered without going to the
+database on every keystroke.
+
+For each user we keep tag -> set of stickers, sticker -> file_id and sticker -> usage score (see records/usage.py).
+A user gets loaded with one query the first time they're looked up, and only one request loads them at a time: the
+others that miss meanwhile wait for that load instead of running their own. They stay cached until they're the least
+recently used user and the index needs the room.
+
+Writes update the cached user in place once they're committed (see records/signals.py): a single new entry just gets
+added, and writes that say which stickers and tags they touched get those read back with one indexed query. Only
+writes that could have changed anything (an import, deleting the user, ...) drop the user. Until the transaction of a
+write commits, the rest of the server keeps seeing the committed tags, like the database shows them, and lookups from
+inside that transaction (a batch that writes and then searches) read the database instead of the cache.
+
+The index lives inside the server process. If you run more than one worker, every worker keeps its own copy,
+and only sees the writes that it handled itself, so turn it off with TAG_INDEX_ENABLED=False in that case.
+'''
+
+
+class UserTags:
+    '''
+    The cached tags of a single user.
+    '''
+    __slots__ = ('tags', 'file_ids', 'scores', 'counts', 'size', '_sorted_tags', '_trigrams')
+
+    def __init__(self):
+        self.tags = {}  # tag -> set of stickers
+        self.file_ids = {}  # sticker -> file_id
+        self.scores = {}  # sticker -> usage score, only for the stickers they've used
+        self.counts = {}  # sticker -> how many tags it has, so a sticker that loses its last one can be dropped
+        self.size = 0  # number of (sticker, tag) pairs, this is what the memory cap counts
+        self._sorted_tags = None  # sorted list of the tags for prefix lookups, built when it's first needed
+        self._trigrams = None  # TrigramIndex of the tags for fuzzy lookups, built when it's first needed
+
+    def add(self, sticker, tag, file_id):
+        if tag not in self.tags:
+            self._sorted_tags = None
+            if self._trigrams is not None:
+                self._trigrams.add(tag)
+        stickers = self.tags.setdefault(tag, set())
+        if sticker not in stickers:
+            stickers.add(sticker)
+            self.counts[sticker] = self.counts.get(sticker, 0) + 1
+            self.size += 1
+        # an empty file_id should never hide one we already know about
+        if file_id or sticker not in self.file_ids:
+            self.file_ids[sticker] = file_id or ''
+
+    def discard(self, sticker, tag):
+        stickers = self.tags.get(tag)
+        if not stickers or sticker not in stickers:
+            return
+        stickers.remove(sticker)
+        self.size -= 1
+        if not stickers:
+            del self.tags[tag]
+            self._sorted_tags = None
+            if self._trigrams is not None:
+                self._trigrams.remove(tag)
+        self.counts[sticker] -= 1
+        if not self.counts[sticker]:
+            del self.counts[sticker]
+            del self.file_ids[sticker]
+            self.scores.pop(sticker, None)
+
+    def replace(self, stickers, tags, rows, file_ids):
+        '''
+        Swaps in what the database has now for the tags, on the stickers (on every sticker when stickers is empty).
+        rows are the (sticker, tag, file_id, score) entries in there and file_ids the stickers' current file_ids.
+        '''
+        for tag in tags:
+            current = self.tags.get(tag, set())
+            for sticker in (current & stickers if stickers else list(current)):
+                self.discard(sticker, tag)
+        for sticker, tag, file_id, score in rows:
+            self.add(sticker, tag, file_id)
+            if score is not None:
+                self.scores[sticker] = score
+        for sticker, file_id in file_ids.items():
+            if sticker in self.file_ids and file_id:
+                self.file_ids[sticker] = file_id
+
+    def tags_with_prefix(self, prefix):
+        '''
+        Returns every tag that starts with the prefix, in alphabetical order
+        '''
+        if self._sorted_tags is None:
+            self._sorted_tags = sorted(self.tags)
+        tags = []
+        # everything that starts with the prefix sits in one block of the sorted list, right where the prefix would go
+        for i in range(bisect_left(self._sorted_tags, prefix), len(self._sorted_tags)):
+            if not self._sorted_tags[i].startswith(prefix):
+                break
+            tags.append(self._sorted_tags[i])
+        return tags
+
+    def autocomplete(self, prefix, limit):
+        '''
+        Returns up to limit (tag, sticker count) pairs for the tags starting with the prefix, most used first
+        '''
+        counts = ((tag, len(self.tags[tag])) for tag in self.tags_with_prefix(prefix))
+        return heapq.nsmallest(limit, counts, key=lambda pair: (-pair[1], pair[0]))
+
+    def trigram_index(self):
+        if self._trigrams is None:
+            self._trigrams = TrigramIndex(self.tags)
+        return self._trigrams
+
+    def stickers_for(self, tag):
+        '''
+        the stickers with a tag, or with any of them if it's a tuple of alternative tags (like a fuzzy term's matches)
+        '''
+        if isinstance(tag, tuple):
+            stickers = set()
+            for alternative in tag:
+                stickers |= self.tags.get(alternative, set())
+            return stickers
+        return self.tags.get(tag, set())
+
+    def match(self, tags=None, exclude_tags=None, match_all=False, prefix=None, expression=None):
+        '''
+        Returns the set of stickers that have any of the tags (all of them if match_all is set),
+        or every sticker when no tags are given, and none of the exclude_tags.
+        A tag can also be a tuple of alternatives, any one of which will do.
+        A prefix counts like one more tag that any tag starting with it satisfies.
+        An expression (a records.tag_query.Plan) is used instead of the tags, prefix and match_all.
+        '''
+        if expression is not None:
+            stickers = expression.matches(self.stickers_for, self.file_ids)
+            for tag in exclude_tags or []:
+                stickers -= self.tags.get(tag, set())
+            return stickers
+
+        prefix_stickers = None
+        if prefix is not None:
+            prefix_stickers = set()
+            for tag in self.tags_with_prefix(prefix):
+                prefix_stickers |= self.tags[tag]
+
+        if tags and match_all:
+            # intersect starting from the rarest tag so the working set stays as small as possible
+            tag_sets = sorted((self.stickers_for(tag) for tag in tags), key=len)
+            stickers = set(tag_sets[0]).intersection(*tag_sets[1:])
+            if prefix_stickers is not None:
+                stickers &= prefix_stickers
+        elif tags:
+            stickers = set()
+            for tag in tags:
+                stickers |= self.stickers_for(tag)
+            if prefix_stickers is not None:
+                stickers |= prefix_stickers
+        elif prefix_stickers is not None:
+            stickers = prefix_stickers
+        else:
+            stickers = set(self.file_ids)
+        for tag in exclude_tags or []:
+            stickers -= self.tags.get(tag, set())
+        return stickers
+
+
+# how many stickers go into a single "sticker IN (...)" lookup when a write gets read back
+LOOKUP_BATCH_SIZE = 500
+
+# the users whose tags the transaction that's open in this context changed. the cache can't show that yet
+uncommitted = contextvars.ContextVar('uncommitted_tag_changes', default=None)
+
+
+class PendingLoad:
+    '''
+    A load of one user's tags that's under way. Requests that miss the cache while it runs wait for it.
+    '''
+    __slots__ = ('version', 'done', 'user_tags')
+
+    def __init__(self, version):
+        self.version = version  # the user's version when it started
+        self.done = threading.Event()
+        self.user_tags = None  # stays None if the load failed
+
+
+class TagIndex:
+    '''
+    LRU cache of UserTags objects, capped at max_entries (sticker, tag) pairs in total.
+    '''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._users = OrderedDict()  # user -> UserTags, least recently used first
+        self._versions = {}  # user -> number of times their tags changed
+        self._loading = {}  # user -> PendingLoad
+        self._size = 0
+        self._lock = threading.Lock()
+        # refreshes read the database one at a time, so the one that read last is always the one applied last
+        self._refresh_lock = threading.Lock()
+
+    def __contains__(self, user):
+        return user in self._users
+
+    @property
+    def size(self):
+        return self._size
+
+    def cached(self, user):
+        '''
+        Returns the UserTags for a user if they're cached, None otherwise. Never touches the database.
+        '''
+        with self._lock:
+            user_tags = self._users.get(user)
+            if user_tags is not None:
+                self._users.move_to_end(user)
+            return user_tags
+
+    def get(self, user):
+        '''
+        Returns the UserTags for a user, loading them from the database on a miss. Only one request loads a user at
+        a time, the others that miss meanwhile wait for it.
+        '''
+        if self.changed_here(user):
+            # only this transaction can see what it wrote, so it reads the database and nothing gets cached
+            return self.load(user)
+        while True:
+            with self._lock:
+                user_tags = self._users.get(user)
+                if user_tags is not None:
+                    self._users.move_to_end(user)
+                    return user_tags
+                version = self._versions.get(user, 0)
+                pending = self._loading.get(user)
+                loading = pending is None
+                if loading:
+                    pending = self._loading[user] = PendingLoad(version)
+            if loading:
+                return self._load_pending(user, pending)
+            pending.done.wait()
+            # a load that started before the user's tags last changed could have missed the change, and one that
+            # failed has nothing to give. we go around again then, and one of the waiters loads them
+            if pending.user_tags is not None and pending.version == version:
+                return pending.user_tags
+
+    def _load_pending(self, user, pending):
+        try:
+            pending.user_tags = self.load(user)
+        finally:
+            with self._lock:
+                del self._loading[user]
+                # if the user's tags changed while we were loading them, what we loaded may already be stale.
+                # it's still fine to answer the requests that waited for it, but it can't be cached
+                if (pending.user_tags is not None and self._versions.get(user, 0) == pending.version
+                        and user not in self._users):
+                    self._insert(user, pending.user_tags)
+            pending.done.set()
+        return pending.user_tags
+
+    def load(self, user):
+        user_tags = UserTags()
+        # order_by() drops the model's default ordering, we don't need the database to sort anything here
+        rows = StickerTagEntry.objects.filter(user=user).order_by().values_list(
+            'sticker', 'tag', 'sticker_info__file_id', 'usage__score')
+        for sticker, tag, file_id, score in rows:
+            user_tags.add(sticker, tag, file_id)
+            if score is not None:
+                user_tags.scores[sticker] = score
+        return user_tags
+
+    def changed_here(self, user):
+        '''
+        Whether the transaction that's open in this context changed the user's tags
+        '''
+        users = uncommitted.get()
+        if not users or user not in users:
+            return False
+        if transaction.get_connection().in_atomic_block:
+            return True
+        # that transaction is over. if it committed the cache has its changes by now, and if not there are none
+        users.clear()
+        return False
+
+    async def aget(self, user):
+        '''
+        Async version of get. Only goes to a thread when the user has to be loaded from the database.
+        '''
+        users = uncommitted.get()
+        # the transaction a batch runs the async views in is on the thread, get() looks at it there
+        user_tags = None if users and user in users else self.cached(user)
+        if user_tags is None:
+            user_tags = await sync_to_async(self.get)(user)
+        return user_tags
+
+    def match(self, user, tags=None, exclude_tags=None, match_all=False, prefix=None, expression=None):
+        '''
+        Returns a dictionary of sticker -> file_id for a user's stickers that match the tags (see UserTags.match)
+        '''
+        return self._match(self.get(user), tags, exclude_tags, match_all, prefix, expression)
+
+    async def amatch(self, user, tags=None, exclude_tags=None, match_all=False, prefix=None, expression=None):
+        return self._match(await self.aget(user), tags, exclude_tags, match_all, prefix, expression)
+
+    def scores(self, user):
+        '''
+        Returns the sticker -> usage score dictionary of a user, for ordering what match() returns
+        '''
+        return self._scores(self.get(user))
+
+    async def ascores(self, user):
+        return self._scores(await self.aget(user))
+
+    def autocomplete(self, user, prefix, limit):
+        return self._autocomplete(self.get(user), prefix, limit)
+
+    async def aautocomplete(self, user, prefix, limit):
+        return self._autocomplete(await self.aget(user), prefix, limit)
+
+    def expand(self, user, terms):
+        '''
+        Returns term -> the user's tags that are similar to it, for fuzzy matching (see records/fuzzy.py)
+        '''
+        return self._expand(self.get(user), terms)
+
+    async def aexpand(self, user, terms):
+        return self._expand(await self.aget(user), terms)
+
+    def add(self, user, sticker, tag, file_id):
+        '''
+        Adds a single new tag to a user who is already cached. Users who aren't cached are left alone.
+        '''
+        with self._lock:
+            # a load that's under way could have missed it
+            self._changed(user)
+            user_tags = self._users.get(user)
+            if user_tags is None:
+                return
+            before = user_tags.size
+            user_tags.add(sticker, tag, file_id)
+            self._size += user_tags.size - before
+            self._evict()
+
+    def changing(self, user):
+        '''
+        Remembers that the transaction that's open in this context changed a user's tags. The cache gets the changes
+        once it commits (with refresh() or invalidate()), until then only this transaction sees them.
+        '''
+        users = uncommitted.get()
+        if users is None:
+            users = set()
+            uncommitted.set(users)
+        users.add(user)
+
+    def refresh(self, user, stickers, tags):
+        '''
+        Reads the tags back from the database on the stickers (every sticker when stickers is empty) of a cached user,
+        along with the stickers' file_ids, after a write to them committed. Users who aren't cached are left alone.
+        '''
+        users = uncommitted.get()
+        if users:
+            users.discard(user)
+        with self._refresh_lock:
+            with self._lock:
+                version = self._changed(user)
+                if user not in self._users:
+                    return
+            stickers = set(stickers)
+            rows = self.rows(user, stickers, tags) if tags else []
+            found = {sticker for sticker, _, _, _ in rows}
+            file_ids = self.file_ids(stickers - found)
+            with self._lock:
+                user_tags = self._users.get(user)
+                if user_tags is None:
+                    return
+                if self._versions[user] != version:
+                    # a single entry got added or the user was dropped while we were reading, and there's no telling
+                    # whether what we read has it
+                    self._remove(user)
+                    return
+                before = user_tags.size
+                user_tags.replace(stickers, tags, rows, file_ids)
+                self._size += user_tags.size - before
+                self._evict()
+
+    def rows(self, user, stickers, tags):
+        '''
+        the user's (sticker, tag, file_id, score) entries with the tags, on the stickers if there are any
+        '''
+        entries = StickerTagEntry.objects.filter(user=user, tag__in=tags).order_by().values_list(
+            'sticker', 'tag', 'sticker_info__file_id', 'usage__score')
+        if not stickers:
+            return list(entries)
+        stickers = list(stickers)
+        rows = []
+        for i in range(0, len(stickers), LOOKUP_BATCH_SIZE):
+            rows.extend(entries.filter(sticker__in=stickers[i:i + LOOKUP_BATCH_SIZE]))
+        return rows
+
+    def file_ids(self, stickers):
+        stickers = list(stickers)
+        file_ids = {}
+        for i in range(0, len(stickers), LOOKUP_BATCH_SIZE):
+            file_ids.update(Sticker.objects.filter(sticker__in=stickers[i:i + LOOKUP_BATCH_SIZE]).values_list(
+                'sticker', 'file_id'))
+        return file_ids
+
+    def set_score(self, user, sticker, score):
+        '''
+        Updates the usage score of one of a cached user's stickers. Users who aren't cached are left alone.
+        '''
+        with self._lock:
+            user_tags = self._users.get(user)
+            if user_tags is not None and sticker in user_tags.file_ids:
+                user_tags.scores[sticker] = score
+
+    def invalidate(self, user):
+        users = uncommitted.get()
+        if users:
+            users.discard(user)
+        with self._lock:
+            self._remove(user)
+
+    def clear(self):
+        users = uncommitted.get()
+        if users:
+            users.clear()
+        with self._lock:
+            for user in self._users:
+                self._versions[user] = self._versions.get(user, 0) + 1
+            self._users.clear()
+            self._size = 0
+
+    def _match(self, user_tags, tags, exclude_tags, match_all, prefix, expression):
+        with self._lock:
+            stickers = user_tags.match(tags, exclude_tags, match_all, prefix, expression)
+            return {sticker: user_tags.file_ids[sticker] for sticker in stickers}
+
+    def _scores(self, user_tags):
+        # not copied, that would cost as much as the ranking itself. callers only look scores up in it, and set_score
+        # and refresh only ever add, replace or remove single values, which readers without the lock can't see half
+        # done
+        return user_tags.scores
+
+    def _autocomplete(self, user_tags, prefix, limit):
+        with self._lock:
+            return user_tags.autocomplete(prefix, limit)
+
+    def _expand(self, user_tags, terms):
+        with self._lock:
+            return user_tags.trigram_index().expand(terms)
+
+    def _changed(self, user):
+        self._versions[user] = version = self._versions.get(user, 0) + 1
+        return version
+
+    def _remove(self, user):
+        self._changed(user)
+        user_tags = self._users.pop(user, None)
+        if user_tags is not None:
+            self._size -= user_tags.size
+
+    def _insert(self, user, user_tags):
+        # a single user bigger than the whole cap would just evict everyone else and then itself
+        if user_tags.size > self.max_entries:
+            return
+        self._users[user] = user_tags
+        self._size += user_tags.size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_entries and self._users:
+            _, user_tags = self._users.popitem(last=False)
+            self._size -= user_tags.size
+
+
+tag_index = TagIndex(max_entries=settings.TAG_INDEX_MAX_ENTRIES)
+
+
+def tag_index_enabled():
+    return settings.TAG_INDEX_ENABLED
+
+
+@receiver(tags_changed)
+def update_tag_index(sender, user, entry=None, stickers=None, tags=(), after_commit=False, **kwargs):
+    if entry is not None:
+        tag_index.add(user, entry.sticker, entry.tag, entry.file_id)
+    elif not after_commit and transaction.get_connection().in_atomic_block:
+        # the signal comes again once the transaction commits, the cache gets the changes then
+        tag_index.changing(user)
+    elif stickers is None:
+        tag_index.invalidate(user)
+    else:
+        tag_index.refresh(user, stickers, tags)
+
+
+@receiver(sticker_used)
+def update_sticker_score(sender, user, sticker, score, **kwargs):
+    tag_index.set_score(user, sticker, score)
@@ -0,0 +1,293 @@
+import re
+from functools import lru_cache
+from django.db.models import Count, Q
+from records.bulk import MAX_LENGTH, SPECIAL_CHARS
+from records.models import StickerTagEntry
+
+'''
+A small query language over a user's tags, for filter-stickers' "query":
+    cat (happy | excited) -sad
+is the stickers tagged cat that are tagged happy or excited, and aren't tagged sad.
+
+- tags next to each other all have to be there (AND)
+- "|" between them means any of them will do (OR), and binds looser than AND, so "cat happy | dog" is
+  "(cat happy) | dog"
+- a "-" in front of a tag or a group means it must not be there (NOT)
+- parentheses group
+- a tag with one of "()|-" where it would be read as an operator goes in double quotes: "t-rex" works as it is,
+  but "-_-" and ":)" need quoting
+
+A query is parsed into a Plan, which is cached (the bot sends the same few queries over and over while people type).
+The Plan turns into one SQL query: the user's entries are grouped per sticker, every tag in the query becomes a count
+of the sticker's entries with that tag, and the HAVING clause is the query itself over those counts. A query without
+NOT only needs the entries with its tags, so those get picked out with the (user, tag) index first. One with a NOT
+needs every entry of the stickers it looks at, but if it can only match stickers with some of its tags (like
+"cat -sad"), a "sticker IN (...)" subquery on those tags keeps it to them. With the tag index on, the same Plan runs
+over the in-memory tag sets instead (see records/tag_index.py).
+
+Queries are limited before anything runs, so a pathological one can't make an inline query slow for everyone: the
+text can be at most MAX_QUERY_LENGTH characters, groups can be nested MAX_QUERY_DEPTH deep, and the plan can have at
+most MAX_QUERY_TAGS different tags (each one is a count computed for every entry the query reads) and cost at most
+MAX_QUERY_COST (every tag and operator in the plan is a step of the HAVING clause, or a set operation in memory).
+'''
+
+MAX_QUERY_LENGTH = 500
+MAX_QUERY_DEPTH = 8
+MAX_QUERY_TAGS = 16
+MAX_QUERY_COST = 64
+# how many parsed queries are kept
+PLAN_CACHE_SIZE = 1024
+
+# the nodes of a plan are tuples, ('tag', tag), ('not', node), and ('and', nodes) or ('or', nodes)
+TAG, NOT, AND, OR = 'tag', 'not', 'and', 'or'
+
+TOKENS = re.compile(r'\s*(?:(?P<op>[()|-])|"(?P<quoted>[^"]*)"|(?P<tag>[^\s()|"]+))')
+# characters that have to be quoted for a tag to be read as a tag, for render()
+NEEDS_QUOTES = re.compile(r'^-|[()|]')
+
+
+def tokenize(text):
+    '''
+    Returns the (kind, value) tokens of a query, kind is "op" or "tag". Raises ValueError when it can't.
+    '''
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKENS.match(text, position)
+        if match is None:
+            raise ValueError(f'query has an unexpected {text[position:].lstrip()[0]!r} in it.')
+        position = match.end()
+        if match.group('op') is not None:
+            tokens.append(('op', match.group('op')))
+        else:
+            tag = match.group('tag')
+            tokens.append(('tag', clean_tag(tag if tag is not None else match.group('quoted'))))
+    return tokens
+
+
+def clean_tag(tag):
+    cleaned = tag.strip().lower()
+    if not cleaned or len(cleaned) > MAX_LENGTH or SPECIAL_CHARS.search(cleaned):
+        raise ValueError(f'query has "{tag}" in it, which is not a valid tag.')
+    return cleaned
+
+
+class Parser:
+    '''
+    Recursive descent over the tokens:
+        or  := and ("|" and)*
+        and := not not*
+        not := "-" not | "(" or ")" | tag
+    '''
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+        self.depth = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError('query is empty.')
+        node = self.parse_or()
+        if self.position < len(self.tokens):
+            raise ValueError(f'query has an unexpected "{self.peek()[1]}" in it.')
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == ('op', '|'):
+            self.position += 1
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else (OR, tuple(nodes))
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.peek()[0] == 'tag' or self.peek()[1] in ('(', '-'):
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else (AND, tuple(nodes))
+
+    def parse_not(self):
+        kind, value = self.peek()
+        if kind == 'tag':
+            self.position += 1
+            return TAG, value
+        if value not in ('-', '('):
+            raise ValueError('query is missing a tag at the end.' if kind is None else
+                             f'query has a "{value}" where a tag should be.')
+        self.depth += 1
+        if self.depth > MAX_QUERY_DEPTH:
+            raise ValueError(f'query can nest at most {MAX_QUERY_DEPTH} groups and "-"s deep.')
+        self.position += 1
+        if value == '-':
+            node = NOT, self.parse_not()
+        else:
+            node = self.parse_or()
+            if self.peek() != ('op', ')'):
+                raise ValueError('query has a "(" that is never closed.')
+            self.position += 1
+        self.depth -= 1
+        return node
+
+
+def simplify(node):
+    '''
+    Flattens nested ANDs and ORs, drops double negation and repeated terms, and puts terms in a fixed order, so queries
+    that mean the same thing get the same plan
+    '''
+    kind = node[0]
+    if kind == TAG:
+        return node
+    if kind == NOT:
+        child = simplify(node[1])
+        return child[1] if child[0] == NOT else (NOT, child)
+    children = {}
+    for child in (simplify(child) for child in node[1]):
+        for term in (child[1] if child[0] == kind else (child,)):
+            children[render(term)] = term
+    if len(children) == 1:
+        return next(iter(children.values()))
+    # tags first and NOTs last, which reads the most like what people type
+    order = sorted(children, key=lambda key: (children[key][0] != TAG, children[key][0] == NOT, key))
+    return kind, tuple(children[key] for key in order)
+
+
+def render(node):
+    '''
+    the query text for a node, in the form parse_query() reads
+    '''
+    kind = node[0]
+    if kind == TAG:
+        return f'"{node[1]}"' if NEEDS_QUOTES.search(node[1]) else node[1]
+    if kind == NOT:
+        return '-' + (f'({render(node[1])})' if node[1][0] in (AND, OR) else render(node[1]))
+    if kind == AND:
+        return ' '.join(f'({render(child)})' if child[0] == OR else render(child) for child in node[1])
+    return ' | '.join(render(child) for child in node[1])
+
+
+def required_tags(node):
+    '''
+    tags a sticker needs at least one of to match the node, or None if it can match stickers without any of its tags
+    '''
+    kind = node[0]
+    if kind == TAG:
+        return {node[1]}
+    if kind == NOT:
+        return None
+    children = [required_tags(child) for child in node[1]]
+    if kind == AND:
+        # any one of them will do, the fewer tags the fewer stickers
+        children = [tags for tags in children if tags is not None]
+        return min(children, key=len) if children else None
+    if any(tags is None for tags in children):
+        return None
+    return set().union(*children)
+
+
+def walk(node):
+    yield node
+    if node[0] == NOT:
+        yield from walk(node[1])
+    elif node[0] in (AND, OR):
+        for child in node[1]:
+            yield from walk(child)
+
+
+class Plan:
+    '''
+    A parsed query. "text" is the query written the same way every time (for cache keys), "tags" the tags it has
+    in it and "monotone" whether it has no NOT in it, in which case only stickers with one of its tags can match.
+    "required" are tags a sticker needs one of to match, when there are any.
+    '''
+    __slots__ = ('tree', 'text', 'tags', 'monotone', 'required', 'cost', 'single_tag')
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.text = render(tree)
+        nodes = list(walk(tree))
+        self.tags = list(dict.fromkeys(node[1] for node in nodes if node[0] == TAG))
+        self.monotone = all(node[0] != NOT for node in nodes)
+        required = required_tags(tree)
+        self.required = sorted(required) if required is not None else None
+        self.cost = len(nodes)
+        # a query that's just one tag, which is what "tags" does already
+        self.single_tag = tree[1] if tree[0] == TAG else None
+
+    def filter(self, user, entries):
+        '''
+        the WHERE part, for a queryset of one user's sticker tag entries
+        '''
+        if self.monotone:
+            return entries.filter(tag__in=self.tags)
+        if self.required is not None:
+            return entries.filter(sticker__in=StickerTagEntry.objects.filter(
+                user=user, tag__in=self.required).values('sticker'))
+        return entries
+
+    def having(self, stickers):
+        '''
+        the GROUP BY and HAVING part, for the entries grouped per sticker with .values()
+        '''
+        counts = {f'has_{i}': Count('tag', filter=Q(tag=tag)) for i, tag in enumerate(self.tags)}
+        return stickers.annotate(**counts).filter(self.condition(self.tree))
+
+    def condition(self, node):
+        kind = node[0]
+        if kind == TAG:
+            return Q(**{f'has_{self.tags.index(node[1])}__gt': 0})
+        if kind == NOT:
+            return ~self.condition(node[1])
+        conditions = [self.condition(child) for child in node[1]]
+        combined = conditions[0]
+        for condition in conditions[1:]:
+            combined = combined & condition if kind == AND else combined | condition
+        return combined
+
+    def matches(self, stickers_for, everything):
+        '''
+        Runs the query over sets in memory. stickers_for(tag) gives the set of stickers with a tag (it's only read),
+        everything is every sticker there is. Returns a new set.
+        '''
+        stickers = self.evaluate(self.tree, stickers_for, everything)
+        return set(stickers) if self.tree[0] == TAG else stickers
+
+    def evaluate(self, node, stickers_for, everything):
+        kind = node[0]
+        if kind == TAG:
+            return stickers_for(node[1])
+        if kind == NOT:
+            return set(everything) - self.evaluate(node[1], stickers_for, everything)
+        if kind == OR:
+            stickers = set()
+            for child in node[1]:
+                stickers |= self.evaluate(child, stickers_for, everything)
+            return stickers
+        # "a -b" is a minus b, not a and (everything minus b). the smallest set goes first to keep the work down
+        wanted = sorted((self.evaluate(child, stickers_for, everything) for child in node[1] if child[0] != NOT),
+                        key=len)
+        stickers = set(wanted[0]).intersection(*wanted[1:]) if wanted else set(everything)
+        for child in node[1]:
+            if child[0] == NOT:
+                stickers -= self.evaluate(child[1], stickers_for, everything)
+        return stickers
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def parse_query(text):
+    '''
+    Returns the Plan for a query, None for a blank one. Raises ValueError when the query isn't valid or costs too much.
+    '''
+    if len(text) > MAX_QUERY_LENGTH:
+        raise ValueError(f'query can be at most {MAX_QUERY_LENGTH} characters long.')
+    if not text.strip():
+        return None
+    plan = Plan(simplify(Parser(tokenize(text)).parse()))
+    if len(plan.tags) > MAX_QUERY_TAGS:
+        raise ValueError(f'query can have at most {MAX_QUERY_TAGS} different tags.')
+    if plan.cost > MAX_QUERY_COST:
+        raise ValueError('query is too complex, try one with fewer tags and operators.')
+    return plan
@@ -0,0 +1,173 @@
+from collections import Counter, defaultdict
+from django.db import connection, transaction
+from django.db.models import Count, Value
+from records.models import StickerTagEntry, TagStat
+
+'''
+Per user tag statistics: how many stickers have each tag, and how many stickers have any tag (the TagStat row with
+an empty tag), so the bot's menus can show them without pulling every entry.
+
+Everything that inserts or deletes sticker tag entries updates TagStat in the same transaction:
+- StickerTagEntry.save() and .delete() do it themselves
+- queryset deletes go through delete_entries() instead of .delete()
+- bulk inserts call entries_added() with the entries they inserted, apply() when they know the counts already, or
+  rebuild() when they can't tell which of their entries were inserted by someone else in the meantime
+- imports recount the users they touched with rebuild() once they're done
+
+If the stats ever drift anyway (a write that went around all of this, say), python manage.py rebuild_tag_stats finds
+the users that are off and recounts them.
+'''
+
+# the tag of the row that counts the stickers with any tag
+ALL_TAGS = ''
+# how many users get recounted, or stickers looked up, in one query (records/bulk.py imports this module, so it can't
+# use the batch sizes from there)
+BATCH_SIZE = 500
+
+
+def apply(user, tags, stickers=0):
+    '''
+    Adds changes to a user's stats: tags maps a tag to how many more (or fewer) stickers have it now, stickers is how
+    many more stickers have any tag. Rows that get down to zero are removed.
+    '''
+    changes = {tag: change for tag, change in tags.items() if change}
+    if stickers:
+        changes[ALL_TAGS] = stickers
+    if not changes:
+        return
+    ops = connection.ops
+    meta = TagStat._meta
+    table = ops.quote_name(meta.db_table)
+    user_column, tag_column, stickers_column = (ops.quote_name(meta.get_field(name).column)
+                                                for name in ('user', 'tag', 'stickers'))
+    rows = [(user, tag, change) for tag, change in changes.items()]
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), BATCH_SIZE):
+            batch = rows[i:i + BATCH_SIZE]
+            # one upsert that adds to the rows that are there and inserts the rest. sqlite and postgresql (the
+            # databases settings.py can be set up with) both spell it like this
+            cursor.execute(f'INSERT INTO {table} ({user_column}, {tag_column}, {stickers_column}) '
+                           f'VALUES {", ".join(["(%s, %s, %s)"] * len(batch))} '
+                           f'ON CONFLICT ({user_column}, {tag_column}) '
+                           f'DO UPDATE SET {stickers_column} = {table}.{stickers_column} + EXCLUDED.{stickers_column}',
+                           [value for row in batch for value in row])
+    lowered = [tag for tag, change in changes.items() if change < 0]
+    if lowered:
+        TagStat.objects.filter(user=user, tag__in=lowered, stickers__lte=0).delete()
+
+
+def entry_counts(user, stickers):
+    '''
+    sticker -> how many entries the user has on it, for the stickers that have any
+    '''
+    stickers = list(stickers)
+    counts = {}
+    for i in range(0, len(stickers), BATCH_SIZE):
+        entries = StickerTagEntry.objects.filter(user=user, sticker__in=stickers[i:i + BATCH_SIZE]).order_by()
+        counts.update(entries.values('sticker').annotate(entries=Count('id')).values_list('sticker', 'entries'))
+    return counts
+
+
+def entries_changed(user, pairs, added):
+    pairs = list(pairs)
+    if not pairs:
+        return
+    tags = Counter()
+    per_sticker = Counter()
+    for sticker, tag in pairs:
+        tags[tag] += 1 if added else -1
+        per_sticker[sticker] += 1
+    # the changes are written already. a sticker whose entries are all ones that were just added is newly tagged,
+    # and one with no entries left isn't tagged anymore
+    remaining = entry_counts(user, per_sticker)
+    if added:
+        stickers = sum(1 for sticker, count in per_sticker.items() if remaining.get(sticker, 0) == count)
+    else:
+        stickers = -sum(1 for sticker in per_sticker if not remaining.get(sticker, 0))
+    apply(user, tags, stickers)
+
+
+def entries_added(user, pairs):
+    '''
+    Counts (sticker, tag) entries that were just inserted for the user. Only pass the ones that were really inserted.
+    '''
+    entries_changed(user, pairs, added=True)
+
+
+def entries_removed(user, pairs):
+    '''
+    Counts (sticker, tag) entries that were just deleted for the user.
+    '''
+    entries_changed(user, pairs, added=False)
+
+
+def delete_entries(queryset):
+    '''
+    queryset.delete() for sticker tag entries, which keeps the stats up to date. Returns how many entries it deleted
+    and the tags they had (for notify_tags_changed), like queryset.delete() returns a count and what it deleted.
+    '''
+    with transaction.atomic():
+        removed = defaultdict(list)
+        for user, sticker, tag in queryset.order_by().values_list('user', 'sticker', 'tag'):
+            removed[user].append((sticker, tag))
+        deleted, _ = queryset.delete()
+        for user, pairs in removed.items():
+            entries_removed(user, pairs)
+    return deleted, {tag for pairs in removed.values() for _, tag in pairs}
+
+
+def user_stats(user):
+    '''
+    Returns how many stickers the user has tagged, and their tags with how many stickers have each one, the most
+    common first. One indexed read of a row per tag.
+    '''
+    rows = dict(TagStat.objects.filter(user=user).values_list('tag', 'stickers'))
+    stickers = rows.pop(ALL_TAGS, 0)
+    return stickers, sorted(rows.items(), key=lambda item: (-item[1], item[0]))
+
+
+def counted(users):
+    '''
+    The stats the users should have, counted from their entries: two aggregate queries, returned as
+    (user, tag, stickers) querysets that can be inserted straight into TagStat
+    '''
+    entries = StickerTagEntry.objects.filter(user__in=users).order_by()
+    per_tag = entries.values('user', 'tag').annotate(stickers=Count('id'))
+    totals = entries.values('user').annotate(all_tags=Value(ALL_TAGS), stickers=Count('sticker', distinct=True))
+    return per_tag, totals
+
+
+def insert_from(queryset):
+    '''
+    INSERT INTO TagStat (user, tag, stickers) the rows of a queryset that selects them in that order
+    '''
+    select, params = queryset.query.sql_with_params()
+    ops = connection.ops
+    meta = TagStat._meta
+    columns = ', '.join(ops.quote_name(meta.get_field(name).column) for name in ('user', 'tag', 'stickers'))
+    with connection.cursor() as cursor:
+        cursor.execute(f'INSERT INTO {ops.quote_name(meta.db_table)} ({columns}) {select}', params)
+
+
+def rebuild(users):
+    '''
+    Recounts the users' stats from their entries, without the rows ever leaving the database
+    '''
+    users = list(users)
+    with transaction.atomic():
+        for i in range(0, len(users), BATCH_SIZE):
+            batch = users[i:i + BATCH_SIZE]
+            TagStat.objects.filter(user__in=batch).delete()
+            for queryset in counted(batch):
+                insert_from(queryset)
+
+
+def out_of_date(users):
+    '''
+    The users whose stats don't match their entries
+    '''
+    expected = set()
+    for queryset in counted(users):
+        expected.update(tuple(row.values()) for row in queryset)
+    stored = set(TagStat.objects.filter(user__in=users).values_list('user', 'tag', 'stickers'))
+    return {user for user, _, _ in expected ^ stored}
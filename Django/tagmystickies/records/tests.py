@@ -1,15 +1,45 @@
 
 # Create your tests here.
+import asyncio
+import io
 import json
-from django.core.exceptions import ValidationError
-from django.db import IntegrityError
-from rest_framework import status
-from rest_framework.test import APITestCase, APIClient
-from django.test import TestCase
-from records.models import UserEntry, StickerTagEntry
-from rest_framework.test import APITestCase
-from records.serializers import UserEntrySerializer, StickerTagEntrySerializer
-from records.models import UserEntry, StickerTagEntry
+import os
+import tempfile
+import threading
+import time
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from records import metrics as metrics_module
+from records import renderers, tag_stats
+from records.benchmarks import seed_dataset
+from records.bulk import bulk_tag
+from records.fuzzy import IndexCache, TrigramIndex, index_cache
+from records.management.commands.bench import Command as BenchCommand, Endpoints
+from records.metrics import Metrics, RequestStats, metrics, render
+from records.models import InlineSnapshot, Sticker, StickerTagEntry, StickerUsage, TagStat, UserEntry
+from records.ndjson import Importer
+from records.pagination import StickerTagEntryPagination
+from records.response_cache import filter_cache
+from records.serializers import StickerFilterSerializer, StickerTagEntrySerializer, UserEntrySerializer
+from records.signals import notify_tags_changed
+from records.storage import apply_sqlite_pragmas
+from records.tag_index import TagIndex, UserTags, tag_index
+from records.tag_query import parse_query
+from records.tag_stats import out_of_date, user_stats
+from records.throttling import bucket_key, limiter, parse_rate, take
+from records.urls import urlpatterns
+from records.usage import add_use, recent_uses, record_use, use_weight
+from records.write_behind import write_behind
+from rest_framework import serializers, status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APITestCase
+from tagmystickies.settings import api_formats
+from unittest import mock, skipUnless
 
 '''
 Rather than starting a server and dirtying up a database, these tests allow us to automatically confirm that all our views and models are
@@ -183,9 +213,13 @@ class StickerTagEntrySerializerTest(APITestCase):
         self.assertFalse(bad_serializer.is_valid(),
                          msg=f"Errors: {bad_serializer.errors}")
 
-        # check if the duplicate data is invalid
-        self.assertFalse(duplicate_Serializer.is_valid(),
-                         msg=f"Errors: {duplicate_Serializer.errors}")
+        # duplicates are caught by the database's unique constraint when saving, not while validating
+        self.assertTrue(duplicate_Serializer.is_valid(),
+                        msg=f"Errors: {duplicate_Serializer.errors}")
+        with self.assertRaises(serializers.ValidationError):
+            duplicate_Serializer.save()
+        self.assertEqual(StickerTagEntry.objects.filter(
+            user=user, sticker='sticker1', tag='funny').count(), 1)
 
 
 class UserEntryListTest(APITestCase):
@@ -659,3 +693,1807 @@ class MassTagReplaceViewTest(APITestCase):
             user=self.userEntry, sticker="sticker2", tag="tag3").exists())
         self.assertTrue(StickerTagEntry.objects.filter(
             user=self.userEntry, sticker="sticker2", tag="tag4").exists())
+
+
+class TagRenameTest(APITestCase):
+    '''
+    This is for testing renaming and merging tags
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        self.userEntry = UserEntry.objects.create(user=72020, chat=990299)
+        self.otherEntry = UserEntry.objects.create(user=72021, chat=990300)
+        for sticker, tag in [("sticker1", "kitty"), ("sticker2", "kitty"), ("sticker2", "cat"), ("sticker3", "cat")]:
+            StickerTagEntry.objects.create(sticker=sticker, user=self.userEntry, tag=tag)
+        StickerTagEntry.objects.create(sticker="sticker1", user=self.otherEntry, tag="kitty")
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def rename(self, data, user=None):
+        return self.client.post(f'/records/tags/rename/{user or self.userEntry.user}/', data, format='json')
+
+    def tags(self, user):
+        return sorted(StickerTagEntry.objects.filter(user=user).values_list('sticker', 'tag'))
+
+    def test_rename_and_merge(self):
+        tag_index.get(self.userEntry.user)
+        response = self.rename({"old_tag": " Kitty", "new_tag": "CAT "})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"renamed": 1, "merged": 1})
+        self.assertEqual(self.tags(self.userEntry), [("sticker1", "cat"), ("sticker2", "cat"), ("sticker3", "cat")])
+        # other users keep their tags
+        self.assertEqual(self.tags(self.otherEntry), [("sticker1", "kitty")])
+        response = self.client.post('/records/filter-stickers/', {"user": self.userEntry.user, "tags": ["kitty"]},
+                                    format='json')
+        self.assertEqual(response.data["stickers"], [])
+
+    def test_bad_renames(self):
+        self.assertEqual(self.rename({"old_tag": "kitty", "new_tag": " KITTY"}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.rename({"old_tag": "kitty", "new_tag": "bad tag"}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.rename({"old_tag": "kitty"}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.rename({"old_tag": "kitty", "new_tag": "cat"}, user=1).status_code,
+                         status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.rename({"old_tag": "nope", "new_tag": "cat"}).data, {"renamed": 0, "merged": 0})
+
+
+class StickerSetTagsTest(APITestCase):
+    '''
+    This is for testing tagging and untagging a whole sticker set at once
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        self.userEntry = UserEntry.objects.create(user=72030, chat=990310)
+        self.otherEntry = UserEntry.objects.create(user=72031, chat=990311)
+        for sticker, set_name in [("cat1", "cats"), ("cat2", "cats"), ("cat3", "cats"), ("dog1", "dogs")]:
+            Sticker.objects.create(sticker=sticker, file_id=f"file_{sticker}", set_name=set_name)
+        for sticker, tag in [("cat1", "cat"), ("cat1", "cute"), ("cat2", "cat"), ("dog1", "dog")]:
+            StickerTagEntry.objects.create(sticker=sticker, user=self.userEntry, tag=tag)
+        StickerTagEntry.objects.create(sticker="cat3", user=self.otherEntry, tag="cat")
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def url(self, set_name="cats", user=None):
+        return f'/records/sets/{user or self.userEntry.user}/{set_name}/tags/'
+
+    def tags(self, user):
+        return sorted(StickerTagEntry.objects.filter(user=user).values_list('sticker', 'tag'))
+
+    def test_list(self):
+        response = self.client.get(self.url())
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # cat3 is in the set, but the user never tagged it
+        self.assertEqual(response.data, {"set_name": "cats", "stickers": 2,
+                                         "tags": [{"tag": "cat", "count": 2}, {"tag": "cute", "count": 1}]})
+        self.assertEqual(self.client.get(self.url("birds")).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(self.url(user=72039)).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_add(self):
+        tag_index.get(self.userEntry.user)
+        response = self.client.post(self.url(), {"tags": ["Cute", "kitty", "bad tag"]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"set_name": "cats", "stickers": 2, "created": 3, "skipped": 1,
+                                         "invalid_tags": ["bad tag"]})
+        self.assertEqual(self.tags(self.userEntry), [
+            ("cat1", "cat"), ("cat1", "cute"), ("cat1", "kitty"), ("cat2", "cat"), ("cat2", "cute"), ("cat2", "kitty"),
+            ("dog1", "dog")])
+        self.assertEqual(self.tags(self.otherEntry), [("cat3", "cat")])
+        # the tag index hears about it
+        response = self.client.post('/records/filter-stickers/', {"user": self.userEntry.user, "tags": ["kitty"]},
+                                    format='json')
+        self.assertEqual(sorted(response.data["stickers"]), ["file_cat1", "file_cat2"])
+        # doing it again changes nothing
+        response = self.client.post(self.url(), {"tags": ["kitty"]}, format='json')
+        self.assertEqual((response.data["created"], response.data["skipped"]), (0, 2))
+
+    def test_remove(self):
+        tag_index.get(self.userEntry.user)
+        response = self.client.delete(self.url(), {"tags": ["CAT", "dog"]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"set_name": "cats", "removed": 2})
+        self.assertEqual(self.tags(self.userEntry), [("cat1", "cute"), ("dog1", "dog")])
+        self.assertEqual(self.tags(self.otherEntry), [("cat3", "cat")])
+        response = self.client.post('/records/filter-stickers/', {"user": self.userEntry.user, "tags": ["cat"]},
+                                    format='json')
+        self.assertEqual(response.data["stickers"], [])
+
+    def test_bad_requests(self):
+        for method in (self.client.post, self.client.delete):
+            self.assertEqual(method(self.url(), {"tags": []}, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(method(self.url(), {"tags": "cat"}, format='json').status_code,
+                             status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(method(self.url(user=72039), {"tags": ["cat"]}, format='json').status_code,
+                             status.HTTP_404_NOT_FOUND)
+        response = self.client.post(self.url("birds"), {"tags": ["bird"]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(StickerTagEntry.objects.filter(tag="bird").exists())
+
+
+class TagStatsTest(APITestCase):
+    '''
+    This is for testing the tag stats table and that every way of writing tags keeps it up to date
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        self.userEntry = UserEntry.objects.create(user=72040, chat=990320)
+        self.user = self.userEntry.user
+        for sticker, tag in [("sticker1", "cat"), ("sticker1", "cute"), ("sticker2", "cat")]:
+            StickerTagEntry.objects.create(sticker=sticker, user=self.userEntry, tag=tag, file_id=f"file_{sticker}",
+                                           set_name="cats")
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def sticker(self, sticker):
+        return {"sticker": sticker, "file_id": f"file_{sticker}", "set_name": "cats"}
+
+    def assertConsistent(self):
+        self.assertEqual(out_of_date([self.user]), set())
+
+    def test_stats_endpoint(self):
+        response = self.client.get(f'/records/tags/stats/{self.user}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"user": self.user, "stickers": 2,
+                                         "tags": [{"tag": "cat", "count": 2}, {"tag": "cute", "count": 1}]})
+        self.assertEqual(self.client.get('/records/tags/stats/72049/').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_every_write_path(self):
+        user = self.user
+        requests = [
+            ('post', '/records/ste/', {"user": user, "tag": "new", **self.sticker("sticker3")}),
+            ('post', f'/records/stickers/{user}/', {"stickers": [self.sticker("sticker3"), self.sticker("sticker4")],
+                                                     "tags": ["new", "bulk"]}),
+            ('post', f'/records/stickers/{user}/sticker5/', {"tags_to_add": ["one", "two"], **self.sticker("sticker5")}),
+            ('patch', f'/records/stickers/{user}/sticker5/', {"tags_to_remove": ["one"], "tags_to_add": ["three"],
+                                                              **self.sticker("sticker5")}),
+            ('delete', f'/records/stickers/tags/{user}/sticker5/', {"tags_to_remove": ["two"]}),
+            ('delete', f'/records/stickers/tags/multi/{user}/', {"tags_to_remove": ["bulk"],
+                                                                 "stickers": ["sticker3", "sticker4"]}),
+            ('patch', f'/records/stickers/tags/mass-replace/{user}/', {
+                "stickers": [self.sticker("sticker1"), self.sticker("sticker4")], "tags_to_remove": ["cute", "new"],
+                "tags_to_add": ["mass"]}),
+            ('post', f'/records/tags/rename/{user}/', {"old_tag": "mass", "new_tag": "cat"}),
+            ('post', f'/records/sets/{user}/cats/tags/', {"tags": ["pack"]}),
+            ('delete', f'/records/sets/{user}/cats/tags/', {"tags": ["cat"]}),
+            ('delete', f'/records/stickers/{user}/sticker5/', None),
+            ('delete', f'/records/stickers/{user}/', {"stickers": ["sticker1"]}),
+        ]
+        for method, path, data in requests:
+            response = getattr(self.client, method)(path, data, format='json')
+            self.assertLess(response.status_code, 400, (method, path, response.content))
+            self.assertConsistent()
+        self.assertEqual(user_stats(user), (3, [("pack", 3), ("new", 1)]))
+
+        # single entries, through the ste endpoints
+        entry = StickerTagEntry.objects.get(user=user, sticker="sticker3", tag="new")
+        self.client.patch(f'/records/ste/{entry.id}/', {"tag": "renamed"}, format='json')
+        self.assertConsistent()
+        self.client.patch(f'/records/ste/{entry.id}/', {"sticker": "sticker9"}, format='json')
+        self.assertConsistent()
+        self.assertEqual(user_stats(user)[0], 4)
+        self.client.delete(f'/records/ste/{entry.id}/')
+        self.assertConsistent()
+        self.assertEqual(user_stats(user), (3, [("pack", 3)]))
+
+        # imports and deleting the user
+        Importer().run([json.dumps({"user": user, "sticker": "sticker6", "tags": ["pack", "imported"]})])
+        self.assertConsistent()
+        self.client.delete(f'/records/user-entries/{user}/')
+        self.assertFalse(TagStat.objects.filter(user=user).exists())
+
+    def test_retagging_existing_pairs(self):
+        before = user_stats(self.user)
+        response = self.client.post(f'/records/stickers/{self.user}/', {
+            "stickers": [self.sticker("sticker1"), self.sticker("sticker2")], "tags": ["cat"]}, format='json')
+        self.assertEqual((response.data["created"], response.data["skipped"]), (0, 2))
+        self.assertEqual(user_stats(self.user), before)
+        # pairs another request inserted after they were looked up don't get counted twice either
+        with mock.patch('records.bulk.existing_pairs', return_value=set()):
+            report = bulk_tag(self.user, [self.sticker("sticker1"), self.sticker("sticker2")], ["cat", "dog"])
+        self.assertEqual((report["created"], report["skipped"]), (2, 2))
+        self.assertConsistent()
+        self.assertEqual(user_stats(self.user), (2, [("cat", 2), ("dog", 2), ("cute", 1)]))
+
+    def test_rebuild_command(self):
+        TagStat.objects.filter(user=self.user, tag="cat").update(stickers=99)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_tag_stats', check=True, stdout=io.StringIO())
+        output = io.StringIO()
+        call_command('rebuild_tag_stats', user=[self.user], stdout=output)
+        self.assertEqual(json.loads(output.getvalue())["out_of_date_users"], [self.user])
+        self.assertConsistent()
+        self.assertEqual(user_stats(self.user), (2, [("cat", 2), ("cute", 1)]))
+
+
+class TagIndexTest(APITestCase):
+    '''
+    This is for testing the in-memory tag index that FilterStickersView is served from
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        # committed, like the tag index sees writes outside of tests
+        with self.captureOnCommitCallbacks(execute=True):
+            self.userEntry = UserEntry.objects.create(user=73000, chat=730000)
+            StickerTagEntry.objects.create(
+                user=self.userEntry, sticker="sticker1", tag="hug", file_id="file_id_1", set_name="set_name")
+            StickerTagEntry.objects.create(
+                user=self.userEntry, sticker="sticker1", tag="sad", file_id="file_id_1", set_name="set_name")
+            StickerTagEntry.objects.create(
+                user=self.userEntry, sticker="sticker2", tag="hug", file_id="file_id_2", set_name="set_name")
+
+    def filter(self, **data):
+        response = self.client.post(
+            '/records/filter-stickers/', {'user': self.userEntry.user, **data}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return set(response.data['stickers'])
+
+    def test_exclude_tags(self):
+        self.assertEqual(self.filter(tags=["hug"], exclude_tags=["sad"]), {
+                         "file_id_2"})
+        # the same answer has to come out of the database
+        with override_settings(TAG_INDEX_ENABLED=False):
+            self.assertEqual(self.filter(tags=["hug"], exclude_tags=["sad"]), {
+                             "file_id_2"})
+
+    def test_hit_does_not_query(self):
+        self.filter(tags=["hug"])
+        self.assertIn(self.userEntry.user, tag_index)
+        # 1 query left for looking up the user entry (the response cache would answer without any)
+        with override_settings(FILTER_CACHE_ENABLED=False), self.assertNumQueries(1):
+            self.assertEqual(self.filter(tags=["hug"]),
+                             {"file_id_1", "file_id_2"})
+
+    def test_writes_update_index(self):
+        self.assertEqual(self.filter(tags=["cool"]), set())
+        self.client.post(f'/records/stickers/{self.userEntry.user}/sticker2/', data=json.dumps(
+            {"tags_to_add": ["cool"], "file_id": "file_id_2", "set_name": "set_name"}), content_type="application/json")
+        self.assertEqual(self.filter(tags=["cool"]), {"file_id_2"})
+        self.client.delete(f'/records/stickers/tags/{self.userEntry.user}/sticker2/', data=json.dumps(
+            {"tags_to_remove": ["cool"]}), content_type="application/json")
+        self.assertEqual(self.filter(tags=["cool"]), set())
+        self.client.delete(f'/records/stickers/{self.userEntry.user}/sticker1/')
+        self.assertEqual(self.filter(), {"file_id_2"})
+
+    def test_writes_update_cached_user_in_place(self):
+        self.filter(tags=["hug"])
+        with mock.patch.object(tag_index, 'load', wraps=tag_index.load) as load:
+            for method, path, data in [
+                    ('post', f'/records/stickers/{self.userEntry.user}/', {"stickers": [
+                        {"sticker": "sticker3", "file_id": "file_id_3", "set_name": "set_name"}], "tags": ["cool"]}),
+                    ('delete', f'/records/stickers/tags/{self.userEntry.user}/sticker1/', {"tags_to_remove": ["sad"]}),
+                    ('post', f'/records/tags/rename/{self.userEntry.user}/', {"old_tag": "hug", "new_tag": "cool"})]:
+                with self.captureOnCommitCallbacks(execute=True):
+                    getattr(self.client, method)(path, data, format='json')
+                self.assertIn(self.userEntry.user, tag_index)
+            self.assertEqual(self.filter(tags=["cool"]), {"file_id_1", "file_id_2", "file_id_3"})
+            self.assertEqual(self.filter(tags=["sad"]), set())
+            self.assertEqual(self.filter(tags=["hug"]), set())
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.delete(f'/records/stickers/{self.userEntry.user}/sticker1/')
+            self.assertEqual(self.filter(), {"file_id_2", "file_id_3"})
+            load.assert_not_called()
+
+    def test_one_load_per_user(self):
+        index = TagIndex(max_entries=100)
+        started = threading.Event()
+
+        def load(user):
+            started.set()
+            time.sleep(0.05)
+            return UserTags()
+        with mock.patch.object(index, 'load', side_effect=load) as mocked:
+            threads = [threading.Thread(target=index.get, args=(1,)) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            started.wait()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(mocked.call_count, 1)
+        self.assertIn(1, index)
+
+    def test_lru_eviction(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            other = UserEntry.objects.create(user=73001, chat=730001)
+            StickerTagEntry.objects.create(
+                user=other, sticker="sticker1", tag="hug", file_id="file_id_1", set_name="set_name")
+            StickerTagEntry.objects.create(
+                user=other, sticker="sticker3", tag="hug", file_id="file_id_3", set_name="set_name")
+        index = TagIndex(max_entries=4)
+        index.get(self.userEntry.user)
+        index.get(other.user)
+        # 3 + 2 entries is over the cap, so the least recently used user goes
+        self.assertNotIn(self.userEntry.user, index)
+        self.assertIn(other.user, index)
+        self.assertEqual(index.size, 2)
+        self.assertEqual(index.match(self.userEntry.user, ["hug"]), {
+                         "sticker1": "file_id_1", "sticker2": "file_id_2"})
+
+
+class FilterStickersPagingTest(APITestCase):
+    '''
+    This is for testing the "all" match mode and cursor paging of FilterStickersView,
+    both out of the tag index and out of the database
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.userEntry = UserEntry.objects.create(user=74000, chat=740000)
+        for i in range(120):
+            sticker = f"sticker{i:03}"
+            StickerTagEntry.objects.create(
+                user=self.userEntry, sticker=sticker, tag="cat", file_id=f"file_id_{i:03}", set_name="set_name")
+            if i % 2 == 0:
+                StickerTagEntry.objects.create(
+                    user=self.userEntry, sticker=sticker, tag="happy", file_id=f"file_id_{i:03}", set_name="set_name")
+            if i % 4 == 0:
+                StickerTagEntry.objects.create(
+                    user=self.userEntry, sticker=sticker, tag="sad", file_id=f"file_id_{i:03}", set_name="set_name")
+
+    def filter(self, **data):
+        response = self.client.post(
+            '/records/filter-stickers/', {'user': self.userEntry.user, **data}, format='json')
+        self.assertEqual(response.status_code,
+                         status.HTTP_200_OK, msg=response.data)
+        return response.data
+
+    def test_match_all(self):
+        for index_enabled in [True, False]:
+            with override_settings(TAG_INDEX_ENABLED=index_enabled):
+                data = self.filter(tags=["cat", "happy"],
+                                   match="all", exclude_tags=["sad"])
+                self.assertEqual(data["stickers"], [
+                                 f"file_id_{i:03}" for i in range(2, 120, 4)])
+                self.assertEqual(data["next_offset"], "")
+                data = self.filter(tags=["happy", "nonexistent"], match="all")
+                self.assertEqual(data["stickers"], [])
+
+    def test_cursor_paging(self):
+        for index_enabled in [True, False]:
+            with override_settings(TAG_INDEX_ENABLED=index_enabled):
+                stickers = []
+                offset = ""
+                pages = 0
+                while True:
+                    data = self.filter(tags=["cat"], offset=offset)
+                    stickers += data["stickers"]
+                    pages += 1
+                    offset = data["next_offset"]
+                    if not offset:
+                        break
+                self.assertEqual(pages, 3)
+                self.assertEqual(
+                    stickers, [f"file_id_{i:03}" for i in range(120)])
+                # page numbers still work, and line up with the cursor pages
+                self.assertEqual(self.filter(tags=["cat"], page=3)[
+                                 "stickers"], stickers[100:])
+
+    def test_bad_input(self):
+        response = self.client.post(
+            '/records/filter-stickers/', {'user': self.userEntry.user, 'match': 'some'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(
+            '/records/filter-stickers/', {'user': self.userEntry.user, 'offset': '!!!'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class StickerTagEntryConstraintTest(APITestCase):
+    '''
+    This is for testing that duplicates are left to the unique constraint instead of extra queries
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.userEntry = UserEntry.objects.create(user=75000, chat=750000)
+        StickerTagEntry.objects.create(
+            user=self.userEntry, sticker="sticker1", tag="hug", file_id="file_id_1", set_name="set_name")
+
+    def test_duplicate_response(self):
+        data = {"user": self.userEntry.user, "sticker": "sticker1",
+                "tag": " HUG ", "file_id": "file_id_1", "set_name": "set_name"}
+        response = self.client.post('/records/ste/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {"non_field_errors": [
+                         StickerTagEntry.duplicate_message]})
+        # the transaction still works after the failed insert
+        self.assertEqual(StickerTagEntry.objects.filter(
+            user=self.userEntry).count(), 1)
+
+    def test_updating_into_a_duplicate(self):
+        other = StickerTagEntry.objects.create(
+            user=self.userEntry, sticker="sticker1", tag="sad", file_id="file_id_1", set_name="set_name")
+        response = self.client.patch(
+            f'/records/ste/{other.pk}/', {"tag": "hug"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        other.refresh_from_db()
+        self.assertEqual(other.tag, "sad")
+
+    def test_other_integrity_errors(self):
+        # only a duplicate becomes the duplicate message, anything else the database refuses gets through as it is
+        entry = StickerTagEntry(user=self.userEntry, sticker="sticker2", tag="hug")
+        with mock.patch('django.db.models.Model.save', side_effect=IntegrityError('NOT NULL constraint failed')):
+            with self.assertRaises(IntegrityError):
+                entry.save()
+        duplicate = StickerTagEntry(user=self.userEntry, sticker="sticker1", tag="hug")
+        with self.assertRaises(ValidationError):
+            duplicate.save()
+
+    def test_no_duplicate_precheck(self):
+        entry = StickerTagEntry(
+            user=self.userEntry, sticker="sticker2", tag="hug", file_id="file_id_2", set_name="set_name")
+        # just the sticker upsert, the insert and the tag stats (is the sticker new, then one upsert), wrapped in a
+        # savepoint. the tag index is on, so there are no inline snapshots to drop
+        with self.assertNumQueries(6):
+            entry.save()
+
+
+class StickerTagEntrySaveSignalTest(TransactionTestCase):
+    '''
+    This is for testing that saving one entry outside of a transaction updates the tag index instead of throwing the
+    user out of it (TestCase runs everything in a transaction, which always drops the entry)
+    '''
+
+    def setUp(self):
+        tag_index.clear()
+        self.userEntry = UserEntry.objects.create(user=75500, chat=755000)
+        StickerTagEntry.objects.create(
+            user=self.userEntry, sticker="sticker1", tag="hug", file_id="file_id_1", set_name="set_name")
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def test_index_stays_warm(self):
+        tag_index.get(self.userEntry.user)
+        StickerTagEntry(user=self.userEntry, sticker="sticker2", tag="cat", file_id="file_id_2",
+                        set_name="set_name").save()
+        self.assertIn(self.userEntry.user, tag_index)
+        self.assertEqual(tag_index.match(self.userEntry.user, ["cat"]), {"sticker2": "file_id_2"})
+        self.assertEqual(tag_index.match(self.userEntry.user, ["hug", "cat"]),
+                         {"sticker1": "file_id_1", "sticker2": "file_id_2"})
+
+
+class BulkTaggingTest(APITestCase):
+    '''
+    This is for testing the bulk tagging behind MultiStickerView and MassTagReplaceView
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.userEntry = UserEntry.objects.create(user=76000, chat=760000)
+        StickerTagEntry.objects.create(
+            user=self.userEntry, sticker="sticker0", tag="cool", file_id="file_id_0", set_name="set_name")
+        self.stickers = [{"sticker": f"sticker{i}", "file_id": f"file_id_{i}",
+                          "set_name": "set_name"} for i in range(40)]
+
+    def test_report(self):
+        data = {"stickers": self.stickers + [{"sticker": "no_file_id"}],
+                "tags": ["Cool", "awesome", "bad, tag", "COOL"]}
+        response = self.client.post(
+            f'/records/stickers/{self.userEntry.user}/', data=json.dumps(data), content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["created"], 79)
+        self.assertEqual(response.data["skipped"], 1)
+        self.assertEqual(response.data["stickers"][0], {
+                         "sticker": "sticker0", "created": 1, "skipped": 1})
+        self.assertEqual(response.data["invalid_tags"], ["bad, tag"])
+        self.assertEqual(response.data["invalid_stickers"], [
+                         {"sticker": "no_file_id"}])
+        self.assertEqual(StickerTagEntry.objects.filter(
+            user=self.userEntry).count(), 80)
+
+    def test_query_count_does_not_grow(self):
+        data = {"stickers": self.stickers[:30],
+                "tags": ["a", "b", "c", "d", "e"]}
+        # user lookup, then existing pairs, the sticker upsert, the insert and the tag stats (counting the stickers'
+        # entries and one upsert) inside a transaction. the tag index is on, so there are no inline snapshots to drop
+        with self.assertNumQueries(8):
+            self.client.post(
+                f'/records/stickers/{self.userEntry.user}/', data=json.dumps(data), content_type="application/json")
+        self.assertEqual(StickerTagEntry.objects.filter(
+            user=self.userEntry).count(), 151)
+
+    def test_mass_replace_report(self):
+        data = {"stickers": self.stickers[:2],
+                "tags_to_remove": ["cool"], "tags_to_add": ["new"]}
+        response = self.client.patch(
+            f'/records/stickers/tags/mass-replace/{self.userEntry.user}/', data=json.dumps(data), content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["removed"], 1)
+        self.assertEqual(response.data["created"], 2)
+        self.assertEqual(set(StickerTagEntry.objects.filter(
+            user=self.userEntry).values_list('tag', flat=True)), {"new"})
+
+
+class TagAutocompleteTest(APITestCase):
+    '''
+    This is for testing TagAutocompleteView and prefix matching in FilterStickersView
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.userEntry = UserEntry.objects.create(user=77000, chat=770000)
+        tags = {"sticker1": ["happy", "hat", "cat"],
+                "sticker2": ["happy", "cat"],
+                "sticker3": ["hug", "sad"]}
+        for sticker, sticker_tags in tags.items():
+            for tag in sticker_tags:
+                StickerTagEntry.objects.create(
+                    user=self.userEntry, sticker=sticker, tag=tag, file_id=f"file_id_{sticker[-1]}", set_name="set_name")
+
+    def test_autocomplete(self):
+        for index_enabled in [True, False]:
+            with override_settings(TAG_INDEX_ENABLED=index_enabled):
+                response = self.client.get(
+                    f'/records/tags/autocomplete/{self.userEntry.user}/?prefix=H')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data["tags"], [{"tag": "happy", "count": 2}, {
+                                 "tag": "hat", "count": 1}, {"tag": "hug", "count": 1}])
+                response = self.client.get(
+                    f'/records/tags/autocomplete/{self.userEntry.user}/?prefix=ha&limit=1')
+                self.assertEqual(response.data["tags"], [
+                                 {"tag": "happy", "count": 2}])
+
+    def test_autocomplete_sees_new_tags(self):
+        self.client.get(
+            f'/records/tags/autocomplete/{self.userEntry.user}/?prefix=h')
+        StickerTagEntry.objects.create(
+            user=self.userEntry, sticker="sticker3", tag="hop", file_id="file_id_3", set_name="set_name")
+        response = self.client.get(
+            f'/records/tags/autocomplete/{self.userEntry.user}/?prefix=ho')
+        self.assertEqual(response.data["tags"], [{"tag": "hop", "count": 1}])
+
+    def test_filter_prefix(self):
+        for index_enabled in [True, False]:
+            with override_settings(TAG_INDEX_ENABLED=index_enabled):
+                response = self.client.post('/records/filter-stickers/', {
+                    'user': self.userEntry.user, 'tags': ['ha'], 'prefix': True}, format='json')
+                self.assertEqual(response.data["stickers"], [
+                                 "file_id_1", "file_id_2"])
+                response = self.client.post('/records/filter-stickers/', {
+                    'user': self.userEntry.user, 'tags': ['cat', 'hu'], 'prefix': True}, format='json')
+                self.assertEqual(response.data["stickers"], [
+                                 "file_id_1", "file_id_2", "file_id_3"])
+                response = self.client.post('/records/filter-stickers/', {
+                    'user': self.userEntry.user, 'tags': ['cat', 'hat'], 'prefix': True, 'match': 'all'}, format='json')
+                self.assertEqual(response.data["stickers"], ["file_id_1"])
+
+
+class StickerTableTest(APITestCase):
+    '''
+    This is for testing that file_ids and set_names are kept once per sticker in the Sticker table
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.userEntry = UserEntry.objects.create(user=78000, chat=780000)
+        for tag in ["hug", "happy", "cat"]:
+            StickerTagEntry.objects.create(
+                user=self.userEntry, sticker="sticker1", tag=tag, file_id="file_id_1", set_name="set_name")
+
+    def test_stored_once(self):
+        self.assertEqual(list(Sticker.objects.values_list()), [
+                         ("sticker1", "file_id_1", "set_name")])
+        entry = StickerTagEntry.objects.get(
+            user=self.userEntry, sticker="sticker1", tag="hug")
+        self.assertEqual(entry.file_id, "file_id_1")
+        self.assertEqual(entry.set_name, "set_name")
+
+    def test_file_id_refresh(self):
+        # a blank file_id doesn't overwrite the one we have
+        StickerTagEntry.objects.create(
+            user=self.userEntry, sticker="sticker1", tag="sad")
+        self.client.post(f'/records/stickers/{self.userEntry.user}/sticker1/', data=json.dumps(
+            {"tags_to_add": ["hug"], "file_id": "file_id_new", "set_name": "set_name"}), content_type="application/json")
+        response = self.client.get(
+            '/records/ste/', {"user": self.userEntry.user, "file_id": "new"})
+        self.assertEqual(len(response.data), 4)
+        self.assertEqual({entry["file_id"]
+                         for entry in response.data}, {"file_id_new"})
+
+    def test_response_shape(self):
+        entry = StickerTagEntry.objects.get(
+            user=self.userEntry, sticker="sticker1", tag="cat")
+        response = self.client.get(f'/records/ste/{entry.pk}/')
+        self.assertEqual(response.data, {"id": entry.pk, "sticker": "sticker1", "user": self.userEntry.user,
+                         "tag": "cat", "file_id": "file_id_1", "set_name": "set_name"})
+        response = self.client.patch(
+            f'/records/ste/{entry.pk}/', {"set_name": " other_set "}, format='json')
+        self.assertEqual(response.data["set_name"], "other_set")
+        self.assertEqual(Sticker.objects.get(
+            sticker="sticker1").set_name, "other_set")
+
+
+class UserStickerTagListTest(APITestCase):
+    '''
+    This is for testing the streamed UserStickerTagList view
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.userEntry = UserEntry.objects.create(
+            user=79000, chat=790000, status="active")
+        for i in range(30):
+            for tag in ["hug", "cat", f"tag{i}"]:
+                StickerTagEntry.objects.create(
+                    user=self.userEntry, sticker=f"sticker{i:02}", tag=tag, file_id=f"file_id_{i:02}", set_name="set_name")
+
+    def test_each_sticker_once(self):
+        # user lookup and one grouped query, no matter how many stickers there are
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                f'/records/user-sticker-tag-list/{self.userEntry.user}/')
+            data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(data["user"], self.userEntry.user)
+        self.assertEqual(data["status"], "active")
+        self.assertEqual(len(data["stickers"]), 30)
+        self.assertEqual(data["stickers"][3], {"sticker": "sticker03", "tags": [
+                         "cat", "hug", "tag3"], "set_name": "set_name", "file_id": "file_id_03"})
+
+    def test_missing_user(self):
+        response = self.client.get('/records/user-sticker-tag-list/1/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class AsyncViewsTest(APITestCase):
+    '''
+    The async views in records/async_views.py have to give the same responses as the sync ones
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        # committed, like the tag index sees writes outside of tests
+        with self.captureOnCommitCallbacks(execute=True):
+            self.userEntry = UserEntry.objects.create(
+                user=80000, chat=800000, status="active")
+            for i in range(60):
+                tags = ["cat"] if i % 2 else ["cat", "happy"]
+                for tag in tags:
+                    StickerTagEntry.objects.create(
+                        user=self.userEntry, sticker=f"sticker{i:02}", tag=tag, file_id=f"file_id_{i:02}", set_name="set_name")
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def compare(self, method, sync_url, async_url, data=None):
+        sync_response = getattr(self.client, method)(sync_url, data, format='json')
+        async_response = getattr(self.client, method)(async_url, data, format='json')
+        self.assertEqual(sync_response.status_code, async_response.status_code)
+        self.assertEqual(sync_response.json(), async_response.json())
+        return async_response
+
+    def test_filter_stickers(self):
+        for index_enabled in [True, False]:
+            with override_settings(TAG_INDEX_ENABLED=index_enabled):
+                for data in [{"user": self.userEntry.user, "tags": ["happy"]},
+                             {"user": self.userEntry.user, "tags": ["cat", "ha"], "match": "all", "prefix": True},
+                             {"user": self.userEntry.user, "tags": ["cat"], "exclude_tags": ["happy"], "offset": ""},
+                             {"user": self.userEntry.user, "tags": ["cat"], "match": "neither"},
+                             {"user": 1, "tags": ["cat"]}]:
+                    self.compare('post', '/records/filter-stickers/',
+                                 '/records/async/filter-stickers/', data)
+
+        response = self.compare('post', '/records/filter-stickers/', '/records/async/filter-stickers/',
+                                {"user": self.userEntry.user, "tags": ["cat"]})
+        self.assertEqual(len(response.json()["stickers"]), 50)
+        # the next page, from the cursor
+        response = self.client.post('/records/async/filter-stickers/', {
+            "user": self.userEntry.user, "tags": ["cat"], "offset": response.json()["next_offset"]}, format='json')
+        self.assertEqual(response.json()["stickers"], [f"file_id_{i}" for i in range(50, 60)])
+
+    def test_cached_user_skips_database(self):
+        self.client.post('/records/async/filter-stickers/',
+                         {"user": self.userEntry.user, "tags": ["cat"]}, format='json')
+        with self.assertNumQueries(0):
+            response = self.client.post('/records/async/filter-stickers/',
+                                        {"user": self.userEntry.user, "tags": ["happy"]}, format='json')
+        self.assertEqual(len(response.json()["stickers"]), 30)
+
+    def test_autocomplete(self):
+        for index_enabled in [True, False]:
+            with override_settings(TAG_INDEX_ENABLED=index_enabled):
+                for query in ['?prefix=ha', '?prefix=', '?prefix=c&limit=1', '?limit=0']:
+                    self.compare('get', f'/records/tags/autocomplete/{self.userEntry.user}/{query}',
+                                 f'/records/async/tags/autocomplete/{self.userEntry.user}/{query}')
+        self.compare('get', '/records/tags/autocomplete/1/',
+                     '/records/async/tags/autocomplete/1/')
+
+    def test_user_entry_detail(self):
+        response = self.compare('get', f'/records/user-entries/{self.userEntry.user}/',
+                                f'/records/async/user-entries/{self.userEntry.user}/')
+        self.assertEqual(response.json()["status"], "active")
+        self.compare('get', '/records/user-entries/1/',
+                     '/records/async/user-entries/1/')
+
+
+class FilterCacheTest(APITestCase):
+    '''
+    This is for testing the filter-stickers response cache
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        filter_cache.reset_stats()
+        self.userEntry = UserEntry.objects.create(user=81000, chat=810000)
+        StickerTagEntry.objects.create(
+            user=self.userEntry, sticker="sticker1", tag="hug", file_id="file_id_1", set_name="set_name")
+        StickerTagEntry.objects.create(
+            user=self.userEntry, sticker="sticker2", tag="sad", file_id="file_id_2", set_name="set_name")
+
+    def filter(self, url='/records/filter-stickers/', **data):
+        response = self.client.post(
+            url, {'user': self.userEntry.user, **data}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()['stickers']
+
+    @override_settings(TAG_INDEX_ENABLED=False)
+    def test_hit_skips_database(self):
+        self.assertEqual(self.filter(tags=["hug", "sad"]), ["file_id_1", "file_id_2"])
+        # same tags in another order
+        with self.assertNumQueries(0):
+            self.assertEqual(self.filter(tags=["sad", "hug"]), ["file_id_1", "file_id_2"])
+        # a different query is a miss
+        self.assertEqual(self.filter(tags=["hug"]), ["file_id_1"])
+        response = self.client.get('/records/filter-stickers/cache/')
+        self.assertEqual(response.data["hits"], 1)
+        self.assertEqual(response.data["misses"], 2)
+
+    @override_settings(TAG_INDEX_ENABLED=False)
+    def test_writes_invalidate(self):
+        self.assertEqual(self.filter(tags=["hug"]), ["file_id_1"])
+        # through a view
+        self.client.post(f'/records/stickers/{self.userEntry.user}/sticker2/', data=json.dumps(
+            {"tags_to_add": ["hug"], "file_id": "file_id_2", "set_name": "set_name"}), content_type="application/json")
+        self.assertEqual(self.filter(tags=["hug"]), ["file_id_1", "file_id_2"])
+        # through the model
+        StickerTagEntry.objects.get(sticker="sticker1", tag="hug").delete()
+        self.assertEqual(self.filter(tags=["hug"]), ["file_id_2"])
+        # the async view shares the cache
+        self.assertEqual(self.filter('/records/async/filter-stickers/', tags=["hug"]), ["file_id_2"])
+        StickerTagEntry.objects.create(
+            user=self.userEntry, sticker="sticker3", tag="hug", file_id="file_id_3", set_name="set_name")
+        self.assertEqual(self.filter('/records/async/filter-stickers/', tags=["hug"]), ["file_id_2", "file_id_3"])
+        self.assertEqual(filter_cache.stats()["hits"], 1)
+
+    def test_deleted_user(self):
+        self.filter(tags=["hug"])
+        self.userEntry.delete()
+        response = self.client.post(
+            '/records/filter-stickers/', {'user': self.userEntry.user, "tags": ["hug"]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_disabled(self):
+        with override_settings(FILTER_CACHE_ENABLED=False):
+            self.filter(tags=["hug"])
+            self.filter(tags=["hug"])
+        self.assertEqual(filter_cache.stats()["hits"] + filter_cache.stats()["misses"], 0)
+
+
+class BenchTest(APITestCase):
+    '''
+    This is for testing the pieces of python manage.py bench
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        self.dataset = seed_dataset(3, 20, 50, 4, seed=1)
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def test_seed_dataset(self):
+        self.assertEqual(UserEntry.objects.count(), 3)
+        for user in self.dataset.users:
+            self.assertEqual(StickerTagEntry.objects.filter(user=user).values(
+                'sticker').distinct().count(), 20)
+        # the most popular tag is on more stickers than a tag from the tail
+        self.assertGreater(StickerTagEntry.objects.filter(tag="tag0").count(),
+                           StickerTagEntry.objects.filter(tag="tag40").count())
+
+    def test_every_endpoint_is_benchmarked(self):
+        endpoints = Endpoints(self.dataset)
+        command = BenchCommand()
+        for pattern in urlpatterns:
+            request = getattr(endpoints, pattern.name.replace('-', '_'), None)
+            self.assertIsNotNone(request, pattern.name)
+            for i in range(3):
+                method, path, body = request(i)
+                self.assertLess(command.send(self.client, method, path, body), 400, f"{method} {path}")
+
+
+class StoragePragmaTest(TestCase):
+    '''
+    This is for testing that new sqlite connections get the pragmas from SQLITE_PRAGMAS
+    '''
+
+    def busy_timeout(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            return cursor.fetchone()[0]
+
+    def test_pragmas_applied(self):
+        before = self.busy_timeout()
+        try:
+            with override_settings(SQLITE_PRAGMAS={'busy_timeout': 1234}):
+                apply_sqlite_pragmas(sender=None, connection=connection)
+                self.assertEqual(self.busy_timeout(), 1234)
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute(f'PRAGMA busy_timeout = {before}')
+
+    def test_plain_profile(self):
+        before = self.busy_timeout()
+        with override_settings(SQLITE_PRAGMAS={}):
+            apply_sqlite_pragmas(sender=None, connection=connection)
+        self.assertEqual(self.busy_timeout(), before)
+
+
+class SqliteTransactionModeTest(TransactionTestCase):
+    '''
+    This is for testing that sqlite-tuned transactions take the write lock when they start
+    '''
+
+    def test_immediate_transactions(self):
+        with CaptureQueriesContext(connection) as queries, transaction.atomic():
+            UserEntry.objects.create(user=96000, chat=960000)
+        self.assertEqual(queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+
+class FuzzyMatchingTest(APITestCase):
+    '''
+    This is for testing the "fuzzy" mode of the filter endpoint and the trigram index behind it
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        index_cache.clear()
+        # committed, like the tag index sees writes outside of tests
+        with self.captureOnCommitCallbacks(execute=True):
+            self.userEntry = UserEntry.objects.create(user=82000, chat=820000)
+            for sticker, tags in [("sticker1", ["happy", "cat"]), ("sticker2", ["hug"]), ("sticker3", ["hugs", "cat"]),
+                                  ("sticker4", ["sad"])]:
+                for tag in tags:
+                    StickerTagEntry.objects.create(
+                        user=self.userEntry, sticker=sticker, tag=tag, file_id=f"file_{sticker}", set_name="set_name")
+
+    def tearDown(self):
+        tag_index.clear()
+        index_cache.clear()
+
+    def filter(self, url='/records/filter-stickers/', **data):
+        response = self.client.post(
+            url, {'user': self.userEntry.user, 'fuzzy': True, **data}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    def test_trigram_index(self):
+        index = TrigramIndex(["happy", "hug", "hugs", "cat", "sad"])
+        self.assertEqual(index.similar("hapy"), ["happy"])
+        self.assertEqual(index.similar("hugg"), ["hug", "hugs"])
+        # typed right, so nothing else gets pulled in
+        self.assertEqual(index.similar("hug"), ["hug"])
+        self.assertEqual(index.similar("zebra"), [])
+
+    def test_fuzzy_filter(self):
+        for index_enabled in [True, False]:
+            with override_settings(TAG_INDEX_ENABLED=index_enabled, FILTER_CACHE_ENABLED=False):
+                response = self.filter(tags=["hapy"])
+                self.assertEqual(response["stickers"], ["file_sticker1"])
+                self.assertEqual(response["matched_tags"], {"hapy": ["happy"]})
+                self.assertEqual(self.filter(tags=["hugg"])["stickers"], ["file_sticker2", "file_sticker3"])
+                self.assertEqual(self.filter(tags=["hugg", "catt"], match="all")["stickers"], ["file_sticker3"])
+                self.assertEqual(self.filter(tags=["hugg", "zebra"], match="all")["stickers"], [])
+                self.assertEqual(self.filter(tags=["hugg", "zebra"])["stickers"], ["file_sticker2", "file_sticker3"])
+                # the async view agrees
+                self.assertEqual(self.filter('/records/async/filter-stickers/', tags=["hugg", "catt"], match="all"),
+                                 self.filter(tags=["hugg", "catt"], match="all"))
+        # without fuzzy the typo finds nothing
+        response = self.client.post('/records/filter-stickers/',
+                                    {'user': self.userEntry.user, 'tags': ["hapy"]}, format='json')
+        self.assertEqual(response.json(), {"stickers": [], "next_offset": ""})
+
+    @override_settings(FILTER_CACHE_ENABLED=False)
+    def test_new_tags_are_found(self):
+        self.assertEqual(self.filter(tags=["slepy"])["stickers"], [])
+        # this is what a tag saved outside of a transaction does to the index (tests always run inside one)
+        tag_index.add(self.userEntry.user, "sticker4", "sleepy", "file_sticker4")
+        self.assertIn(self.userEntry.user, tag_index)
+        self.assertEqual(self.filter(tags=["slepy"])["stickers"], ["file_sticker4"])
+
+    @override_settings(TAG_INDEX_ENABLED=False, FILTER_CACHE_ENABLED=False)
+    def test_database_index_is_reused(self):
+        user = self.userEntry.user
+        self.assertEqual(self.filter(tags=["hapy"])["stickers"], ["file_sticker1"])
+        index = index_cache.get(user, filter_cache.generation(user))
+        self.assertIsNotNone(index)
+        # built once, then reused by both views until the user's tags change
+        self.filter(tags=["hugg"])
+        self.filter('/records/async/filter-stickers/', tags=["catt"])
+        self.assertIs(index_cache.get(user, filter_cache.generation(user)), index)
+        StickerTagEntry.objects.create(
+            user=self.userEntry, sticker="sticker4", tag="sleepy", file_id="file_sticker4", set_name="set_name")
+        notify_tags_changed(user)
+        self.assertIsNone(index_cache.get(user, filter_cache.generation(user)))
+        self.assertEqual(self.filter(tags=["slepy"])["stickers"], ["file_sticker4"])
+
+    def test_index_cache_cap(self):
+        cache = IndexCache(max_tags=3)
+        cache.put(1, 0, TrigramIndex(["cat", "dog"]))
+        cache.put(2, 0, TrigramIndex(["hug"]))
+        cache.get(1, 0)
+        cache.put(3, 0, TrigramIndex(["sad"]))
+        # the least recently used user goes first
+        self.assertIsNone(cache.get(2, 0))
+        self.assertIsNotNone(cache.get(1, 0))
+        self.assertIsNotNone(cache.get(3, 0))
+        # an old generation doesn't count
+        self.assertIsNone(cache.get(1, 1))
+
+
+class KeysetPaginationTest(APITestCase):
+    '''
+    This is for testing the opt in cursor paging of the list endpoints
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        for i in range(12):
+            UserEntry.objects.create(user=83000 + i, chat=830000 + i)
+        self.userEntry = UserEntry.objects.get(user=83000)
+        for i in range(25):
+            StickerTagEntry.objects.create(
+                user=self.userEntry, sticker=f"sticker{i:02}", tag="cat", file_id=f"file_id_{i:02}", set_name="set_name")
+        StickerTagEntry.objects.create(
+            user=UserEntry.objects.get(user=83001), sticker="sticker00", tag="cat", file_id="file_id_00", set_name="set_name")
+
+    def collect(self, url):
+        results = []
+        pages = 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            results += response.data["results"]
+            url = response.data["next"]
+            pages += 1
+        return results, pages
+
+    def test_sticker_tag_entries(self):
+        results, pages = self.collect(f'/records/ste/?user={self.userEntry.user}&page_size=10')
+        self.assertEqual(pages, 3)
+        self.assertEqual([entry["sticker"] for entry in results], [f"sticker{i:02}" for i in range(25)])
+        # filters still apply
+        results, _ = self.collect('/records/ste/?sticker=sticker00&page_size=10')
+        self.assertEqual(len(results), 2)
+
+    def test_user_entries(self):
+        results, pages = self.collect('/records/user-entries/?page_size=5')
+        self.assertEqual(pages, 3)
+        self.assertEqual([entry["user"] for entry in results], list(range(83000, 83012)))
+
+    def test_page_size_cap(self):
+        with mock.patch.object(StickerTagEntryPagination, 'max_page_size', 10):
+            response = self.client.get('/records/ste/?page_size=100000')
+        self.assertEqual(len(response.data["results"]), 10)
+
+    def test_page_query(self):
+        # one page is a single query, however deep into the table it is
+        response = self.client.get(f'/records/ste/?user={self.userEntry.user}&page_size=10')
+        with self.assertNumQueries(1):
+            self.client.get(response.data["next"])
+
+    def test_unpaged_by_default(self):
+        response = self.client.get(f'/records/ste/?user={self.userEntry.user}')
+        self.assertIsInstance(response.data, list)
+        self.assertEqual(len(response.data), 25)
+        self.assertIsInstance(self.client.get('/records/user-entries/').data, list)
+
+
+class MetricsTest(APITestCase):
+    '''
+    This is for testing the metrics middleware and the /metrics endpoint
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        metrics.reset()
+        self.userEntry = UserEntry.objects.create(user=84000, chat=840000)
+
+    def scrape(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        return response.content.decode()
+
+    def test_requests_are_recorded(self):
+        self.client.get(f'/records/user-entries/{self.userEntry.user}/')
+        self.client.get(f'/records/user-entries/{self.userEntry.user}/')
+        self.client.get('/records/user-entries/1/')
+        text = self.scrape()
+        route = 'route="records/user-entries/<int:pk>/",method="GET"'
+        self.assertIn(f'tagmystickies_http_requests_total{{{route},status="200"}} 2', text)
+        self.assertIn(f'tagmystickies_http_requests_total{{{route},status="404"}} 1', text)
+        self.assertIn(f'tagmystickies_http_request_duration_seconds_count{{{route}}} 3', text)
+        self.assertIn(f'tagmystickies_http_request_duration_seconds_bucket{{{route},le="+Inf"}} 3', text)
+        # one query per request
+        self.assertIn(f'tagmystickies_db_queries_total{{{route}}} 3', text)
+        self.assertIn(f'tagmystickies_http_response_bytes_total{{{route}}}', text)
+
+    def test_workers_add_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            other_worker = Metrics(directory, worker=1)
+            other_worker.observe('records/ste/', 'GET', 200, 0.02, RequestStats(), 100)
+            this_worker = Metrics(directory, worker=2)
+            this_worker.observe('records/ste/', 'GET', 200, 0.5, RequestStats(), 50)
+            this_worker.observe('records/ste/', 'GET', 500, 0.5, RequestStats(), 50)
+            text = render(this_worker.collect())
+        self.assertIn('tagmystickies_http_requests_total{route="records/ste/",method="GET",status="200"} 2', text)
+        self.assertIn('tagmystickies_http_requests_total{route="records/ste/",method="GET",status="500"} 1', text)
+        self.assertIn('tagmystickies_http_request_duration_seconds_bucket{route="records/ste/",method="GET",le="0.025"} 1', text)
+        self.assertIn('tagmystickies_http_response_bytes_total{route="records/ste/",method="GET"} 200', text)
+
+
+    @skipUnless(metrics_module.fcntl is not None, "merging needs fcntl")
+    def test_exited_workers_are_merged(self):
+        with tempfile.TemporaryDirectory() as directory:
+            exited = Metrics(directory)
+            exited.observe('records/ste/', 'GET', 200, 0.02, RequestStats(), 100)
+            exited.flush()
+            this_worker = Metrics(directory)
+            this_worker.observe('records/ste/', 'GET', 200, 0.5, RequestStats(), 50)
+            before = render(this_worker.collect())
+            self.assertIn('method="GET",status="200"} 2', before)
+            # what the operating system does when a worker exits
+            exited._running.close()
+            after = render(this_worker.collect())
+            self.assertEqual(after, before)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted(['metrics-base.json', f'metrics-{this_worker.worker}.json',
+                                     f'metrics-{this_worker.worker}.lock', 'metrics.lock']))
+            # a new worker, even in a process with the same pid, adds to the totals instead of replacing them
+            restarted = Metrics(directory)
+            self.assertNotEqual(restarted.worker, exited.worker)
+            restarted.observe('records/ste/', 'GET', 200, 0.5, RequestStats(), 50)
+            self.assertIn('method="GET",status="200"} 3', render(restarted.collect()))
+
+
+class BatchTest(APITestCase):
+    '''
+    This is for testing the batch endpoint
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        self.userEntry = UserEntry.objects.create(user=85000, chat=850000)
+        self.sticker = {"file_id": "file85", "set_name": "set85"}
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def batch(self, operations):
+        return self.client.post('/records/batch/', {"operations": operations}, format='json')
+
+    def test_operations_run_in_order(self):
+        response = self.batch([
+            {"method": "GET", "path": f"/records/user-entries/{self.userEntry.user}/"},
+            {"method": "PATCH", "path": f"/records/user-entries/{self.userEntry.user}/", "body": {"status": "tagging"}},
+            {"method": "POST", "path": f"/records/stickers/{self.userEntry.user}/s85/",
+             "body": {"tags_to_add": ["cat", "happy"], **self.sticker}},
+            {"method": "POST", "path": "/records/async/filter-stickers/",
+             "body": {"user": self.userEntry.user, "tags": ["cat"]}},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data["committed"])
+        results = response.data["results"]
+        self.assertEqual([result["status"] for result in results], [200, 200, 200, 200])
+        self.assertEqual(results[0]["body"]["status"], "")
+        self.assertEqual(results[1]["body"]["status"], "tagging")
+        # the async view sees the tags the operation before it added
+        self.assertEqual(results[3]["body"]["stickers"], ["file85"])
+        self.userEntry.refresh_from_db()
+        self.assertEqual(self.userEntry.status, "tagging")
+
+    def test_failure_rolls_everything_back(self):
+        response = self.batch([
+            {"method": "PATCH", "path": f"/records/user-entries/{self.userEntry.user}/", "body": {"status": "tagging"}},
+            {"method": "POST", "path": f"/records/stickers/{self.userEntry.user}/s85/",
+             "body": {"tags_to_add": ["cat"], **self.sticker}},
+            {"method": "GET", "path": "/records/user-entries/1/"},
+            {"method": "DELETE", "path": f"/records/user-entries/{self.userEntry.user}/"},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(response.data["committed"])
+        self.assertEqual(response.data["failed"], 2)
+        # the operation after the failed one never ran
+        self.assertEqual(len(response.data["results"]), 3)
+        self.userEntry.refresh_from_db()
+        self.assertEqual(self.userEntry.status, "")
+        self.assertFalse(StickerTagEntry.objects.filter(user=self.userEntry).exists())
+
+    def test_streamed_response(self):
+        StickerTagEntry.objects.create(user=self.userEntry, sticker="s85", tag="cat", **self.sticker)
+        response = self.batch([{"method": "GET", "path": f"/records/user-sticker-tag-list/{self.userEntry.user}/"}])
+        body = response.data["results"][0]["body"]
+        self.assertEqual(body["stickers"][0]["tags"], ["cat"])
+
+    def test_bad_batches(self):
+        for operations in ([], "nope", [{"method": "GET"}], [{"method": "TRACE", "path": "/records/ste/"}],
+                           [{"method": "GET", "path": "/admin/"}],
+                           [{"method": "GET", "path": "/records/ste/"}] * 51):
+            response = self.batch(operations)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, operations)
+        response = self.batch([{"method": "POST", "path": "/records/batch/", "body": {"operations": []}}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(response.data["committed"])
+        response = self.batch([{"method": "GET", "path": "/records/nothing-here/"}])
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class UsageRankingTest(APITestCase):
+    '''
+    This is for testing the sticker usage scores and the filter-stickers ranking that uses them
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        self.userEntry = UserEntry.objects.create(user=86000, chat=860000)
+        for i in range(120):
+            StickerTagEntry.objects.create(user=self.userEntry, sticker=f"sticker{i:03}", tag="cat",
+                                           file_id=f"file_id_{i:03}", set_name="set_name")
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def use(self, sticker, times=1):
+        # the tag index and the response cache only hear about a use once it's committed
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(times):
+                response = self.client.post(f'/records/stickers/{self.userEntry.user}/{sticker}/used/')
+        return response
+
+    def filter(self, url='/records/filter-stickers/', **data):
+        response = self.client.post(url, {'user': self.userEntry.user, 'tags': ['cat'], **data}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    def test_scores_decay(self):
+        now = use_weight(1800000000)
+        # two uses at the same time are worth twice as much
+        self.assertAlmostEqual(add_use(now, now), now + 1)
+        # a use one half life ago counts half
+        self.assertAlmostEqual(recent_uses(add_use(now, now - 1), 1800000000), 1.5)
+        # a lot of old uses lose to a few new ones
+        old = None
+        for _ in range(8):
+            old = add_use(old, now - 4)
+        new = add_use(now, now)
+        self.assertGreater(new, old)
+
+    def test_record_use(self):
+        response = self.use("sticker005", times=3)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["uses"], 3)
+        self.assertAlmostEqual(response.data["recent_uses"], 3, places=2)
+        self.assertEqual(StickerUsage.objects.get(user=self.userEntry, sticker="sticker005").uses, 3)
+        self.assertEqual(self.use("nope").status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.post('/records/stickers/1/sticker005/used/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_used_stickers_come_first(self):
+        # used twice, but long enough ago that one use today beats it
+        record_use(self.userEntry.user, "sticker010", when=time.time() - 86400 * 60)
+        record_use(self.userEntry.user, "sticker010", when=time.time() - 86400 * 60)
+        for index_enabled in [True, False]:
+            with override_settings(TAG_INDEX_ENABLED=index_enabled):
+                # fill the tag index and the response cache before the uses, they have to notice them
+                self.filter()
+                self.use("sticker100", times=2)
+                self.use("sticker050")
+                for url in ['/records/filter-stickers/', '/records/async/filter-stickers/']:
+                    stickers = []
+                    offset = ""
+                    while True:
+                        data = self.filter(url, offset=offset)
+                        stickers += data["stickers"]
+                        offset = data["next_offset"]
+                        if not offset:
+                            break
+                    ranked = ["file_id_100", "file_id_050", "file_id_010"]
+                    self.assertEqual(stickers, ranked + [f"file_id_{i:03}" for i in range(120)
+                                                         if f"file_id_{i:03}" not in ranked], (index_enabled, url))
+                    self.assertEqual(self.filter(url, page=3)["stickers"], stickers[100:])
+                    data = self.filter(url, ids=True)
+                    self.assertEqual(data["ids"][:3], ["sticker100", "sticker050", "sticker010"])
+                    self.assertEqual(len(data["ids"]), len(data["stickers"]))
+                StickerUsage.objects.filter(sticker__in=["sticker100", "sticker050"]).delete()
+                tag_index.clear()
+                filter_cache.invalidate(self.userEntry.user)
+
+    def test_cursor_inside_the_ranked_stickers(self):
+        for i in range(60):
+            record_use(self.userEntry.user, f"sticker{i:03}", when=1800000000 + i)
+        for index_enabled in [True, False]:
+            with override_settings(TAG_INDEX_ENABLED=index_enabled):
+                first = self.filter()
+                second = self.filter(offset=first["next_offset"])
+                self.assertEqual(first["stickers"], [f"file_id_{i:03}" for i in range(59, 9, -1)])
+                self.assertEqual(second["stickers"], [f"file_id_{i:03}" for i in [*range(9, -1, -1), *range(60, 100)]])
+
+
+class LibraryImportExportTest(APITestCase):
+    '''
+    This is for testing the NDJSON export and import endpoints and commands
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        self.userEntry = UserEntry.objects.create(user=87000, chat=870000, status="hi")
+        self.otherEntry = UserEntry.objects.create(user=87001, chat=870001)
+        for i in range(5):
+            for tag in ["cat", f"tag{i}"]:
+                StickerTagEntry.objects.create(user=self.userEntry, sticker=f"sticker{i}", tag=tag,
+                                               file_id=f"file{i}", set_name="set")
+        StickerTagEntry.objects.create(user=self.otherEntry, sticker="sticker0", tag="dog", file_id="file0",
+                                       set_name="set")
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def export(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return b''.join(response.streaming_content).decode()
+
+    def import_(self, body):
+        return self.client.generic('POST', '/records/import/', body, content_type='application/x-ndjson')
+
+    def test_export(self):
+        lines = [json.loads(line) for line in self.export(f'/records/export/{self.userEntry.user}/').splitlines()]
+        self.assertEqual(lines[0], {"user": 87000, "chat": 870000, "status": "hi"})
+        self.assertEqual(lines[1], {"user": 87000, "sticker": "sticker0", "file_id": "file0", "set_name": "set",
+                                    "tags": ["cat", "tag0"]})
+        self.assertEqual(len(lines), 6)
+        everything = self.export('/records/export/').splitlines()
+        self.assertEqual(len(everything), 8)
+        # every user comes before the stickers
+        self.assertNotIn('"sticker"', everything[1])
+        self.assertEqual(self.client.get('/records/export/1/').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_round_trip(self):
+        exported = self.export('/records/export/')
+        UserEntry.objects.all().delete()
+        response = self.import_(exported)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(response.data["users"], 2)
+        self.assertEqual(response.data["stickers"], 6)
+        self.assertEqual(response.data["entries"], 11)
+        self.assertEqual(self.export('/records/export/'), exported)
+        # importing it again changes nothing
+        self.assertEqual(self.import_(exported).data["entries"], 0)
+        self.assertEqual(StickerTagEntry.objects.count(), 11)
+        self.assertEqual(self.export('/records/export/'), exported)
+
+    def test_import_merges_and_updates_caches(self):
+        tag_index.get(self.userEntry.user)
+        response = self.import_(
+            '{"user": 87000, "sticker": "sticker9", "file_id": "file9", "set_name": "set", "tags": ["New "]}\n')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post('/records/filter-stickers/', {"user": 87000, "tags": ["new"]}, format='json')
+        self.assertEqual(response.data["stickers"], ["file9"])
+
+    def test_bad_lines(self):
+        body = '\n'.join([
+            'not json',
+            '{"user": 87000, "chat": "x"}',
+            '{"user": 1, "sticker": "s", "tags": ["cat"]}',  # no such user
+            '{"user": 87000, "sticker": "s", "tags": ["bad,tag"]}',
+            '',
+            '{"user": 87000, "sticker": "s", "tags": ["fine"]}',
+        ])
+        response = self.import_(body)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["rejected"], 4)
+        self.assertEqual(sorted(response.data["rejected_lines"]), [1, 2, 3, 4])
+        self.assertEqual(response.data["stickers"], 1)
+        self.assertEqual(self.import_('').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_failed_chunk_is_rolled_back(self):
+        # the second user takes the first one's chat, which can't be written
+        report = Importer(chunk_size=2).run([
+            '{"user": 87002, "chat": 870002}',
+            '{"user": 87002, "sticker": "s", "tags": ["cat"]}',
+            '{"user": 87003, "chat": 870000}',
+            '{"user": 87003, "sticker": "s", "tags": ["cat"]}',
+        ])
+        self.assertIn("error", report)
+        self.assertTrue(UserEntry.objects.filter(user=87002).exists())
+        self.assertFalse(UserEntry.objects.filter(user=87003).exists())
+
+    def test_stats_are_recounted_once(self):
+        lines = [json.dumps({"user": 87000, "sticker": f"new{i}", "tags": ["cat", f"tag{i}"]}) for i in range(6)]
+        with mock.patch('records.tag_stats.rebuild', wraps=tag_stats.rebuild) as rebuild:
+            report = Importer(chunk_size=2).run(lines + lines[:1])
+        rebuild.assert_called_once_with({87000})
+        self.assertEqual(report["entries"], 12)
+        self.assertEqual(out_of_date([87000]), set())
+
+    def test_commands(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'library.ndjson')
+            call_command('export_library', output=path, stderr=io.StringIO())
+            UserEntry.objects.all().delete()
+            output = io.StringIO()
+            call_command('import_library', path, stdout=output)
+            self.assertEqual(json.loads(output.getvalue())["entries"], 11)
+            output = io.StringIO()
+            call_command('export_library', user=87001, stdout=output)
+            self.assertEqual(len(output.getvalue().splitlines()), 2)
+
+
+@skipUnless(renderers.orjson and renderers.msgpack, 'needs orjson and msgpack installed')
+class RenderersTest(APITestCase):
+    '''
+    This is for testing the orjson and MessagePack renderers on the hot endpoints
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        filter_cache.reset_stats()
+        self.userEntry = UserEntry.objects.create(user=88000, chat=880000)
+        Sticker.objects.create(sticker="sticker1", file_id="file1", set_name="cats")
+        for tag in ["cat", "ünïcode"]:
+            StickerTagEntry.objects.create(sticker="sticker1", user=self.userEntry, tag=tag)
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def test_orjson_matches_json(self):
+        data = {"user": 88000, "tags": ["ünïcode", "a\"b"], "none": None, "nested": [{"x": 1.5}], 3: True}
+        self.assertEqual(renderers.ORJSONRenderer().render(data), JSONRenderer().render(data))
+        # the serializers hand back ordered dicts of their own
+        data = StickerTagEntrySerializer(StickerTagEntry.objects.all(), many=True).data
+        self.assertEqual(renderers.ORJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_msgpack_response(self):
+        response = self.client.post('/records/filter-stickers/', {"user": 88000, "tags": ["cat"]}, format='json',
+                                    HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        json_response = self.client.post('/records/filter-stickers/', {"user": 88000, "tags": ["cat"]}, format='json')
+        self.assertEqual(renderers.msgpack.unpackb(response.content), json.loads(json_response.content))
+        response = self.client.get('/records/user-entries/88000/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(renderers.msgpack.unpackb(response.content)["chat"], 880000)
+
+    def test_msgpack_request(self):
+        response = self.client.post('/records/filter-stickers/', renderers.msgpack.packb({"user": 88000, "tags": ["ünïcode"]}),
+                                    content_type='application/msgpack')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["stickers"], ["file1"])
+        response = self.client.post('/records/filter-stickers/', b'\xc1', content_type='application/msgpack')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_json_is_the_default(self):
+        response = self.client.get('/records/user-entries/88000/')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.json()["chat"], 880000)
+        response = self.client.get('/records/async/user-entries/88000/')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.json()["chat"], 880000)
+
+    def test_json_fallback(self):
+        # without orjson on, everything still answers with the standard library's JSON
+        with override_settings(FAST_API_RENDERER_CLASSES=['rest_framework.renderers.JSONRenderer']):
+            self.assertFalse(renderers.orjson_enabled())
+            response = self.client.get('/records/async/user-entries/88000/')
+            self.assertEqual(response.json()["chat"], 880000)
+
+    def test_api_formats(self):
+        renderer_classes, parser_classes = api_formats(['orjson', 'browsable'], 'API_RENDERERS')
+        self.assertEqual(renderer_classes, ['records.renderers.ORJSONRenderer',
+                                            'rest_framework.renderers.BrowsableAPIRenderer'])
+        self.assertEqual(parser_classes[0], 'records.renderers.ORJSONParser')
+        with self.assertRaises(ImproperlyConfigured):
+            api_formats(['yaml'], 'API_RENDERERS')
+        # formats whose package isn't installed are left out
+        with mock.patch('tagmystickies.settings.find_spec', return_value=None):
+            self.assertEqual(api_formats(['msgpack', 'json'], 'API_RENDERERS')[0],
+                             ['rest_framework.renderers.JSONRenderer'])
+            with self.assertRaises(ImproperlyConfigured):
+                api_formats(['msgpack'], 'API_RENDERERS')
+
+    def test_render_bench(self):
+        output = io.StringIO()
+        call_command('render_bench', stickers=20, repeat=2, json=True, stdout=output)
+        results = json.loads(output.getvalue())
+        self.assertEqual(set(results["user library"]), {"json", "orjson", "msgpack"})
+        self.assertEqual(results["user library"]["json"]["bytes"], results["user library"]["orjson"]["bytes"])
+
+
+@override_settings(WRITE_BEHIND_ENABLED=True)
+class WriteBehindTest(APITestCase):
+    '''
+    This is for testing the write-behind queue for tag writes
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        # the writes get flushed by the tests instead of a background thread
+        write_behind.background = False
+        self.userEntry = UserEntry.objects.create(user=89000, chat=890000)
+        self.stickers = [{"sticker": f"s{n}", "file_id": f"file{n}", "set_name": "cats"} for n in range(3)]
+
+    def tearDown(self):
+        write_behind.flush()
+        write_behind.background = True
+        tag_index.clear()
+
+    def queue(self, method, path, body):
+        return getattr(self.client, method)(path, body, format='json', HTTP_PREFER='respond-async')
+
+    def test_queued_write(self):
+        response = self.queue('post', '/records/stickers/89000/', {"stickers": self.stickers, "tags": ["cat"]})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data["status"], "pending")
+        self.assertEqual(response['Location'], response.data["url"])
+        self.assertFalse(StickerTagEntry.objects.filter(user=89000).exists())
+        self.assertEqual(self.client.get(response['Location']).data["status"], "pending")
+        # waiting writes it
+        report = self.client.get(response['Location'] + '?wait=true').data
+        self.assertEqual(report["status"], "applied")
+        self.assertEqual(report["result"]["status"], status.HTTP_201_CREATED)
+        self.assertEqual(StickerTagEntry.objects.filter(user=89000, tag="cat").count(), 3)
+
+    def test_reads_see_queued_writes(self):
+        self.queue('post', '/records/stickers/89000/', {"stickers": self.stickers, "tags": ["cat"]})
+        self.queue('delete', '/records/stickers/89000/s0/', None)
+        response = self.client.post('/records/filter-stickers/', {"user": 89000, "tags": ["cat"]}, format='json')
+        self.assertEqual(sorted(response.data["stickers"]), ["file1", "file2"])
+        self.assertTrue(write_behind.is_empty())
+        self.queue('post', '/records/stickers/89000/s0/', {"tags_to_add": ["dog"], **self.stickers[0]})
+        response = self.client.post('/records/async/filter-stickers/', {"user": 89000, "tags": ["dog"]}, format='json')
+        self.assertEqual(response.json()["stickers"], ["file0"])
+
+    def test_failed_operation(self):
+        missing = self.queue('delete', '/records/stickers/89000/missing/', None)
+        added = self.queue('patch', '/records/stickers/tags/mass-replace/89000/',
+                           {"stickers": self.stickers, "tags_to_add": ["cat"]})
+        write_behind.flush([89000])
+        report = self.client.get(missing['Location']).data
+        self.assertEqual(report["status"], "failed")
+        self.assertEqual(report["result"]["status"], status.HTTP_404_NOT_FOUND)
+        # it doesn't take the rest of the batch with it
+        self.assertEqual(self.client.get(added['Location']).data["status"], "applied")
+        self.assertEqual(user_stats(89000), (3, [("cat", 3)]))
+
+    def test_runs_now(self):
+        # without the header, or with write-behind off, writes happen right away
+        response = self.client.post('/records/stickers/89000/', {"stickers": self.stickers, "tags": ["cat"]},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with override_settings(WRITE_BEHIND_ENABLED=False):
+            response = self.queue('delete', '/records/stickers/tags/89000/s0/', {"tags_to_remove": ["cat"]})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(StickerTagEntry.objects.filter(user=89000).count(), 2)
+
+    @override_settings(WRITE_BEHIND_MAX_PENDING=1)
+    def test_full_queue(self):
+        queued = self.queue('post', '/records/stickers/89000/', {"stickers": self.stickers, "tags": ["cat"]})
+        self.assertEqual(queued.status_code, status.HTTP_202_ACCEPTED)
+        # this one runs now, after the one that's queued
+        response = self.queue('delete', '/records/stickers/tags/multi/89000/',
+                              {"stickers": ["s0", "s1"], "tags_to_remove": ["cat"]})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(queued['Location']).data["status"], "applied")
+        self.assertEqual(list(StickerTagEntry.objects.filter(user=89000).values_list('sticker', flat=True)), ["s2"])
+
+    def test_batch_writes_queue_first(self):
+        self.queue('post', '/records/stickers/89000/s0/', {"tags_to_add": ["cat"], **self.stickers[0]})
+        response = self.client.post('/records/batch/', {"operations": [
+            {"method": "GET", "path": "/records/user-sticker-tag-list/89000/"}]}, format='json')
+        self.assertEqual(response.data["results"][0]["body"]["stickers"][0]["tags"], ["cat"])
+
+    def test_reads_only_write_their_users_queue(self):
+        self.client.post('/records/stickers/89000/', {"stickers": self.stickers, "tags": ["cat"]}, format='json')
+        UserEntry.objects.create(user=89001, chat=890010)
+        self.queue('delete', '/records/stickers/89000/s0/', None)
+        # reads that aren't about 89000 leave their queued writes alone
+        self.assertEqual(self.client.get('/records/user-entries/89001/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/records/ste/').status_code, status.HTTP_200_OK)
+        self.assertTrue(write_behind.has_pending(89000))
+        # one of 89000's entries is about them though, even with only its pk in the url
+        entry = StickerTagEntry.objects.get(user=89000, sticker="s0")
+        self.assertEqual(self.client.get(f'/records/ste/{entry.pk}/').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(write_behind.has_pending(89000))
+
+    def test_unknown_operation(self):
+        response = self.client.get('/records/operations/nope/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(THROTTLE_ENABLED=True, THROTTLE_RATES={'filter': '3/s', 'write': '2/min', 'bulk': '', 'default': '2/s'})
+class ThrottleTest(APITestCase):
+    '''
+    This is for testing the per-user rate limiting
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        limiter.clear()
+        metrics.reset()
+        for user in (90000, 90001):
+            UserEntry.objects.create(user=user, chat=user * 10)
+            StickerTagEntry.objects.create(user_id=user, sticker="s1", tag="cat")
+
+    def tearDown(self):
+        limiter.clear()
+        tag_index.clear()
+
+    def filter(self, user, path='/records/filter-stickers/'):
+        return self.client.post(path, {"user": user, "tags": ["cat"]}, format='json')
+
+    def test_burst_then_429(self):
+        for _ in range(3):
+            self.assertEqual(self.filter(90000).status_code, status.HTTP_200_OK)
+        response = self.filter(90000)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '1')
+        # the async views take from the same bucket
+        response = self.filter(90000, '/records/async/filter-stickers/')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(self.client.get('/records/async/tags/autocomplete/90000/?prefix=c').status_code,
+                         status.HTTP_429_TOO_MANY_REQUESTS)
+        # other users and other scopes have their own buckets
+        self.assertEqual(self.filter(90001).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/records/user-sticker-tag-list/90000/').status_code, status.HTTP_200_OK)
+        text = self.client.get('/metrics').content.decode()
+        self.assertIn('tagmystickies_throttled_requests_total{scope="filter"} 3', text)
+
+    def test_refill(self):
+        rate = parse_rate('2/s')
+        full_at, wait = take(None, 100.0, rate)
+        full_at, wait = take(full_at, 100.0, rate)
+        self.assertEqual((full_at, wait), (101.0, None))
+        self.assertEqual(take(full_at, 100.0, rate), (None, 0.5))
+        # half a second later there's a token again
+        self.assertEqual(take(full_at, 100.5, rate), (101.5, None))
+        # and a bucket that's been left alone is full
+        self.assertEqual(take(full_at, 200.0, rate), (200.5, None))
+
+    def test_concurrent_async_checks(self):
+        async def burst():
+            return await asyncio.gather(*(limiter.atake('filter', 'user:90000') for _ in range(10)))
+        # every coroutine reads the bucket before any of them writes it back, unless they wait for its lock
+        self.assertEqual(sum(wait is None for wait in asyncio.run(burst())), 3)
+
+    def test_clear_leaves_other_caches_alone(self):
+        caches['default'].set('something', 1)
+        limiter.take('filter', 'user:90000')
+        limiter.clear()
+        self.assertEqual(caches['default'].get('something'), 1)
+        self.assertIsNone(limiter.cache().get(bucket_key('filter', 'user:90000')))
+
+    def test_requests_without_a_user(self):
+        # counted by address instead
+        for _ in range(2):
+            self.assertEqual(self.client.get('/records/filter-stickers/cache/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get('/records/filter-stickers/cache/').status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_batch_operations_are_not_counted(self):
+        operations = [{"method": "POST", "path": f"/records/stickers/90000/s{n}/", "body": {"tags_to_add": ["dog"]}}
+                      for n in range(3)]
+        response = self.client.post('/records/batch/', {"operations": operations}, format='json')
+        self.assertTrue(response.data["committed"])
+        self.assertEqual(self.client.post('/records/stickers/90000/s9/', {"tags_to_add": ["dog"]}, format='json')
+                         .status_code, status.HTTP_200_OK)
+
+    def test_off(self):
+        with override_settings(THROTTLE_ENABLED=False):
+            for _ in range(5):
+                self.assertEqual(self.filter(90000).status_code, status.HTTP_200_OK)
+
+    def test_rates(self):
+        self.assertEqual(parse_rate('100/min'), (100, 60))
+        self.assertEqual(parse_rate('1000/hour'), (1000, 3600))
+        for rate in ('fast', '0/s', '10/fortnight'):
+            with self.assertRaises(ImproperlyConfigured):
+                parse_rate(rate)
+
+
+@override_settings(TAG_INDEX_ENABLED=False, FILTER_CACHE_ENABLED=False)
+class InlineSnapshotTest(APITestCase):
+    '''
+    This is for testing the inline snapshots filter-stickers answers one-tag queries from
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.userEntry = UserEntry.objects.create(user=91000, chat=910000)
+        Sticker.objects.bulk_create([Sticker(sticker=f"s{n:03}", file_id=f"file{n:03}", set_name="cats")
+                                     for n in range(120)])
+        StickerTagEntry.objects.bulk_create(
+            [StickerTagEntry(user=self.userEntry, sticker=f"s{n:03}", tag="cat") for n in range(120)] +
+            [StickerTagEntry(user=self.userEntry, sticker=f"s{n:03}", tag="dog") for n in range(0, 120, 3)])
+        for n in (5, 70, 70, 100):
+            record_use(91000, f"s{n:03}")
+
+    def pages(self, path='/records/filter-stickers/', **body):
+        # every page, following next_offset
+        stickers, offset = [], ''
+        while True:
+            response = self.client.post(path, {"user": 91000, "offset": offset, **body}, format='json').json()
+            stickers += response["stickers"]
+            offset = response["next_offset"]
+            if not offset:
+                return stickers
+
+    def test_same_results(self):
+        for body in ({"tags": ["cat"]}, {"tags": ["dog"]}, {}, {"tags": ["cat"], "match": "all"}, {"tags": ["nope"]}):
+            with override_settings(INLINE_SNAPSHOTS_ENABLED=False):
+                expected = self.pages(**body)
+            self.assertEqual(self.pages(**body), expected)
+            self.assertEqual(self.pages('/records/async/filter-stickers/', **body), expected)
+            self.assertEqual(self.client.post('/records/filter-stickers/', {"user": 91000, "page": 2, **body},
+                                              format='json').json()["stickers"], expected[50:100])
+        self.assertEqual(self.pages(tags=["cat"])[:3], ["file070", "file100", "file005"])
+        self.assertEqual(set(InlineSnapshot.objects.values_list('tag', flat=True)), {"cat", "dog", "", "nope"})
+
+    def test_one_lookup(self):
+        self.pages(tags=["cat"])
+        # the user and the snapshot
+        with self.assertNumQueries(2):
+            self.client.post('/records/filter-stickers/', {"user": 91000, "tags": ["cat"]}, format='json')
+
+    def test_changes_drop_snapshots(self):
+        self.pages(tags=["dog"])
+        self.pages()
+        self.client.post('/records/stickers/91000/s001/',
+                         {"tags_to_add": ["dog"], "file_id": "file001", "set_name": "cats"}, format='json')
+        self.assertFalse(InlineSnapshot.objects.exists())
+        self.assertIn("file001", self.pages(tags=["dog"]))
+        self.pages()
+        # a use only drops the snapshots the sticker is in
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/records/stickers/91000/s002/used/')
+        self.assertEqual(list(InlineSnapshot.objects.values_list('tag', flat=True)), ["dog"])
+        # the newest use counts the most, only the sticker used twice stays ahead of it
+        self.assertEqual(self.pages()[:2], ["file070", "file002"])
+
+    def snapshot_tags(self):
+        return set(InlineSnapshot.objects.values_list('tag', flat=True))
+
+    def test_changes_only_drop_their_snapshots(self):
+        for tags in (["cat"], ["dog"], ["nope"], []):
+            self.pages(tags=tags)
+        # a new sticker with a new tag is only in the snapshot with all the stickers
+        self.client.post('/records/stickers/91000/s500/',
+                         {"tags_to_add": ["bird"], "file_id": "file500", "set_name": "birds"}, format='json')
+        self.assertEqual(self.snapshot_tags(), {"cat", "dog", "nope"})
+        self.pages()
+        # s003 has cat too, so that one goes as well
+        self.client.delete('/records/stickers/tags/91000/s003/', {"tags_to_remove": ["dog"]}, format='json')
+        self.assertEqual(self.snapshot_tags(), {"nope"})
+        self.assertNotIn("file003", self.pages(tags=["dog"]))
+
+    def test_dropped_once(self):
+        self.pages(tags=["dog"])
+        # dropped in the writer's transaction, the signal sent after it commits doesn't delete them again
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/records/stickers/91000/s001/',
+                             {"tags_to_add": ["dog"], "file_id": "file001", "set_name": "cats"}, format='json')
+        deletes = [query for query in queries.captured_queries
+                   if query['sql'].startswith('DELETE') and 'inlinesnapshot' in query['sql']]
+        self.assertEqual(len(deletes), 1)
+        self.assertFalse(InlineSnapshot.objects.exists())
+
+    def test_not_used_with_the_tag_index(self):
+        self.pages(tags=["dog"])
+        with override_settings(TAG_INDEX_ENABLED=True):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.post('/records/stickers/91000/s001/',
+                                 {"tags_to_add": ["dog"], "file_id": "file001", "set_name": "cats"}, format='json')
+            self.assertFalse([query for query in queries.captured_queries if 'inlinesnapshot' in query['sql']])
+        self.assertEqual(self.snapshot_tags(), {"dog"})
+
+    def test_rebuild_command(self):
+        self.pages(tags=["cat"])
+        InlineSnapshot.objects.filter(tag="cat").update(results='[]')
+        with self.assertRaises(CommandError):
+            call_command('rebuild_inline_snapshots', check=True, stdout=io.StringIO())
+        output = io.StringIO()
+        call_command('rebuild_inline_snapshots', all_tags=True, stdout=output)
+        report = json.loads(output.getvalue())
+        self.assertEqual(report["out_of_date_snapshots"], [{"user": 91000, "tag": "cat"}])
+        self.assertEqual(report["built"], 3)
+        call_command('rebuild_inline_snapshots', check=True, stdout=io.StringIO())
+        self.assertEqual(len(json.loads(InlineSnapshot.objects.get(tag="cat").results)), 120)
+
+
+class TagQueryTest(APITestCase):
+    '''
+    This is for testing the boolean "query" of the filter endpoint (records/tag_query.py)
+    '''
+
+    def setUp(self):
+        self.client = APIClient()
+        tag_index.clear()
+        self.userEntry = UserEntry.objects.create(user=92000, chat=920000)
+        for sticker, tags in [("sticker1", ["cat", "happy"]), ("sticker2", ["cat", "excited", "sad"]),
+                              ("sticker3", ["cat", "excited"]), ("sticker4", ["dog", "happy"]),
+                              ("sticker5", ["t-rex", "-_-"])]:
+            for tag in tags:
+                StickerTagEntry.objects.create(
+                    user=self.userEntry, sticker=sticker, tag=tag, file_id=f"file_{sticker}", set_name="set_name")
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def filter(self, query, url='/records/filter-stickers/', **data):
+        response = self.client.post(url, {'user': self.userEntry.user, 'query': query, **data}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()["stickers"]
+
+    def test_parse(self):
+        self.assertEqual(parse_query("Cat (happy|excited)  -sad").text, "cat (excited | happy) -sad")
+        # the same query written differently is the same plan
+        self.assertIs(parse_query("cat (happy|excited)  -sad"), parse_query("cat (happy|excited)  -sad"))
+        self.assertEqual(parse_query("(excited | happy) --cat -sad cat").text, "cat (excited | happy) -sad")
+        self.assertEqual(parse_query('t-rex "-_-"').tags, ["-_-", "t-rex"])
+        self.assertIsNone(parse_query("  "))
+        for query in ["(cat", "cat)", "cat |", "-", '"cat', "cat,dog", "a" * 501, "(" * 9 + "cat" + ")" * 9,
+                      " ".join(f"tag{i}" for i in range(17)), " ".join(f"-(t{i} t{j})" for i in range(8) for j in range(i + 1, 8))]:
+            with self.assertRaises(ValueError):
+                parse_query(query)
+
+    def test_query_filter(self):
+        for index_enabled in [True, False]:
+            with override_settings(TAG_INDEX_ENABLED=index_enabled, FILTER_CACHE_ENABLED=False):
+                self.assertEqual(self.filter("cat (happy | excited) -sad"), ["file_sticker1", "file_sticker3"])
+                self.assertEqual(self.filter("cat happy | dog"), ["file_sticker1", "file_sticker4"])
+                self.assertEqual(self.filter("-cat"), ["file_sticker4", "file_sticker5"])
+                self.assertEqual(self.filter("-(cat | dog)"), ["file_sticker5"])
+                self.assertEqual(self.filter('"-_-"'), ["file_sticker5"])
+                self.assertEqual(self.filter("happy", exclude_tags=["dog"]), ["file_sticker1"])
+                self.assertEqual(self.filter("cat", ids=True, page=2), [])
+                # the async view agrees
+                self.assertEqual(self.filter("cat -(sad | happy)", url='/records/async/filter-stickers/'),
+                                 ["file_sticker3"])
+
+    @override_settings(TAG_INDEX_ENABLED=False, FILTER_CACHE_ENABLED=False)
+    def test_one_sql_query(self):
+        # the user, then the stickers
+        with self.assertNumQueries(2):
+            self.assertEqual(self.filter("cat (happy | excited) -sad"), ["file_sticker1", "file_sticker3"])
+
+    def test_bad_queries(self):
+        for body in [{"query": "cat ("}, {"query": "cat", "tags": ["dog"]}, {"query": 5},
+                     {"query": " ".join(f"tag{i}" for i in range(17))}]:
+            response = self.client.post('/records/filter-stickers/', {'user': self.userEntry.user, **body},
+                                        format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("query", response.json()["error"])
+
+    def test_filter_serializer(self):
+        serializer = StickerFilterSerializer(data={"user": 1, "tags": [" Cat", "happy cat", "cat", "dog"]})
+        self.assertTrue(serializer.is_valid())
+        self.assertEqual(serializer.validated_data["tags"], ["cat", "dog"])
+        self.assertFalse(StickerFilterSerializer(data={"user": 1, "query": "cat |"}).is_valid())
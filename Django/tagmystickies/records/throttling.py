@@ -0,0 +1,219 @@
+import asyncio
+import math
+import threading
+import time
+from functools import lru_cache
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import status
+from rest_framework.throttling import BaseThrottle
+from records.metrics import metrics
+from records.renderers import json_response
+from records.write_behind import request_user
+
+'''
+Per-user rate limiting, so one runaway client can't take the whole server for itself.
+
+Every user gets a token bucket per scope. A request takes a token, and the bucket refills at a steady rate up to
+its size. A rate of "20/s" means a bucket of 20 tokens that refills 20 tokens a second, so bursts of up to 20 go
+through right away and anything faster than 20 a second after that gets a 429 with a Retry-After header.
+
+Views pick their scope with throttle_scope (see THROTTLE_RATES in settings.py):
+- filter: the inline query endpoints
+- write: the endpoints that change tags
+- bulk: whole-library endpoints (export, import, the streamed tag list) and batches
+- default: everything else
+
+The user is the one in the url, or the "user" in the body or query string. Requests that don't name a user are
+counted by client address instead.
+
+A bucket is stored as one number: the time it will be full again. A check reads it and writes it back while it
+holds the bucket's lock, a key that cache.add() only sets when it isn't there yet. add() is atomic in every cache
+backend, so two threads, two of the async views' coroutines or two workers can't spend the same token. A lock whose
+holder died runs out after LOCK_TIMEOUT, and a check that can't get the lock within LOCK_WAIT goes ahead without it.
+
+The buckets live in the THROTTLE_CACHE cache, a per process cache of their own by default (see CACHES in
+settings.py). To share the limits between workers, point THROTTLE_CACHE at a shared cache (redis, memcached, ...)
+that's only used for them, limiter.clear() empties the whole cache.
+
+The operations of a batch and the queued writes of write-behind aren't counted again, the request that brought them
+in already was.
+'''
+
+DEFAULT_SCOPE = 'default'
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+# seconds a bucket's lock is kept if whoever took it never lets it go
+LOCK_TIMEOUT = 1
+# seconds a check waits for the lock, and between tries
+LOCK_WAIT = 0.05
+LOCK_RETRY = 0.001
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    '''
+    Returns (tokens, seconds) for a rate like "20/s", "100/min" or "1000/hour", the same format rest framework uses
+    '''
+    try:
+        tokens, period = rate.split('/')
+        tokens, seconds = int(tokens), PERIODS[period.strip()[0]]
+    except (ValueError, KeyError, IndexError):
+        raise ImproperlyConfigured(f'"{rate}" is not a rate, use something like "20/s", "100/min" or "1000/hour".')
+    if tokens < 1:
+        raise ImproperlyConfigured(f'"{rate}" has to allow at least one request.')
+    return tokens, seconds
+
+
+def rate_for(scope):
+    '''
+    (tokens, seconds) for the scope, or None if it isn't limited
+    '''
+    rate = settings.THROTTLE_RATES.get(scope, settings.THROTTLE_RATES.get(DEFAULT_SCOPE))
+    return parse_rate(rate) if rate else None
+
+
+def bucket_key(scope, ident):
+    return f'throttle:{scope}:{ident}'
+
+
+def lock_key(key):
+    return f'{key}:lock'
+
+
+def take(full_at, now, rate):
+    '''
+    Takes a token from a bucket that's full at full_at. Returns (the new full_at, None) if there was a token, or
+    (None, how many seconds until there is one).
+    '''
+    tokens, seconds = rate
+    full_at = max(full_at or now, now) + seconds / tokens
+    # the bucket holds "seconds" worth of tokens, so it's empty once it's that far from being full
+    if full_at - now > seconds:
+        return None, full_at - now - seconds
+    return full_at, None
+
+
+class TokenBucketLimiter:
+    '''
+    Token buckets kept in the THROTTLE_CACHE cache
+    '''
+
+    def __init__(self):
+        # the threads of this process queue up here instead of all polling the cache for the bucket's lock
+        self._lock = threading.Lock()
+
+    def cache(self):
+        return caches[settings.THROTTLE_CACHE]
+
+    def take(self, scope, ident):
+        '''
+        Takes a token. Returns None if there was one, or how many seconds until there is.
+        '''
+        rate = rate_for(scope)
+        if rate is None:
+            return None
+        cache = self.cache()
+        key = bucket_key(scope, ident)
+        with self._lock:
+            locked = self.lock(cache, key)
+            try:
+                now = time.time()
+                full_at, wait = take(cache.get(key), now, rate)
+                if full_at is not None:
+                    # a bucket that's full again is the same as no bucket
+                    cache.set(key, full_at, timeout=math.ceil(full_at - now) + 1)
+            finally:
+                if locked:
+                    cache.delete(lock_key(key))
+        return wait
+
+    async def atake(self, scope, ident):
+        rate = rate_for(scope)
+        if rate is None:
+            return None
+        cache = self.cache()
+        key = bucket_key(scope, ident)
+        locked = await self.alock(cache, key)
+        try:
+            now = time.time()
+            full_at, wait = take(await cache.aget(key), now, rate)
+            if full_at is not None:
+                await cache.aset(key, full_at, timeout=math.ceil(full_at - now) + 1)
+        finally:
+            if locked:
+                await cache.adelete(lock_key(key))
+        return wait
+
+    def lock(self, cache, key):
+        '''
+        Takes the bucket's lock. Returns whether it got it within LOCK_WAIT.
+        '''
+        deadline = time.monotonic() + LOCK_WAIT
+        while not cache.add(lock_key(key), True, timeout=LOCK_TIMEOUT):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(LOCK_RETRY)
+        return True
+
+    async def alock(self, cache, key):
+        deadline = time.monotonic() + LOCK_WAIT
+        while not await cache.aadd(lock_key(key), True, timeout=LOCK_TIMEOUT):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(LOCK_RETRY)
+        return True
+
+    def clear(self):
+        self.cache().clear()
+
+
+limiter = TokenBucketLimiter()
+
+
+def is_internal(request):
+    # batch.run_operation marks the requests it makes, they were counted as the batch or the queued write
+    return getattr(request, 'internal', False)
+
+
+class TokenBucketThrottle(BaseThrottle):
+    '''
+    Rest framework's side of the limiter. It's in DEFAULT_THROTTLE_CLASSES, so every APIView uses it with the scope
+    in its throttle_scope. Rest framework turns a refusal into a 429 with Retry-After.
+    '''
+
+    def __init__(self):
+        self.retry_after = None
+
+    def allow_request(self, request, view):
+        if not settings.THROTTLE_ENABLED or is_internal(request._request):
+            return True
+        scope = getattr(view, 'throttle_scope', DEFAULT_SCOPE)
+        # views that read their body as a stream themselves say so, and can't have it parsed here
+        user = request_user(request, view.kwargs, body=not getattr(view, 'streams_body', False))
+        ident = f'user:{user}' if user is not None else f'address:{self.get_ident(request)}'
+        self.retry_after = limiter.take(scope, ident)
+        if self.retry_after is None:
+            return True
+        metrics.count_throttled(scope)
+        return False
+
+    def wait(self):
+        return self.retry_after
+
+
+async def athrottle(request, scope, user):
+    '''
+    TokenBucketThrottle for the async views. Returns the 429 response, or None if the request can go ahead.
+    '''
+    if not settings.THROTTLE_ENABLED or is_internal(request):
+        return None
+    ident = f'user:{user}' if user is not None else f'address:{TokenBucketThrottle().get_ident(request)}'
+    wait = await limiter.atake(scope, ident)
+    if wait is None:
+        return None
+    metrics.count_throttled(scope)
+    response = json_response({"detail": f"Request was throttled. Expected available in {math.ceil(wait)} seconds."},
+                             status=status.HTTP_429_TOO_MANY_REQUESTS)
+    response['Retry-After'] = str(math.ceil(wait))
+    return response
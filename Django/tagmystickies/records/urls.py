@@ -1,5 +1,5 @@
 from django.urls import path
-from records import views
+from records import async_views, views
 
 
 '''
@@ -17,10 +17,14 @@ urlpatterns = [
          name="sticker-tag-entry-detail"),
     path('records/filter-stickers/',
          views.FilterStickersView.as_view(), name="filter-stickers"),
+    path('records/filter-stickers/cache/',
+         views.FilterCacheStatsView.as_view(), name="filter-cache-stats"),
     path('records/user-sticker-tag-list/<int:user>/',
          views.UserStickerTagList.as_view(), name="user-sticker-tag-list"),
     path('records/stickers/<int:user>/<str:sticker>/',
          views.ManipulateMultiStickerView.as_view(), name="manipulate-multi-sticker"),
+    path('records/stickers/<int:user>/<str:sticker>/used/',
+         views.StickerUsedView.as_view(), name="sticker-used"),
     path('records/stickers/<int:user>/',
          views.MultiStickerView.as_view(), name="sticker-multi"),
     path('records/stickers/tags/<int:user>/<str:sticker>/',
@@ -28,5 +32,26 @@ urlpatterns = [
     path('records/stickers/tags/multi/<int:user>/',
          views.DeleteMultiTagSetView.as_view(), name="delete-multi-tag-set"),
     path('records/stickers/tags/mass-replace/<int:user>/',
-         views.MassTagReplaceView.as_view(), name="mass-tag-replace")
+         views.MassTagReplaceView.as_view(), name="mass-tag-replace"),
+    path('records/tags/autocomplete/<int:user>/',
+         views.TagAutocompleteView.as_view(), name="tag-autocomplete"),
+    path('records/tags/stats/<int:user>/',
+         views.TagStatsView.as_view(), name="tag-stats"),
+    path('records/tags/rename/<int:user>/',
+         views.TagRenameView.as_view(), name="tag-rename"),
+    path('records/sets/<int:user>/<str:set_name>/tags/',
+         views.StickerSetTagsView.as_view(), name="sticker-set-tags"),
+    path('records/batch/', views.BatchView.as_view(), name="batch"),
+    path('records/operations/<str:operation>/',
+         views.WriteOperationView.as_view(), name="write-operation"),
+    path('records/export/', views.LibraryExportView.as_view(), name="library-export-all"),
+    path('records/export/<int:user>/', views.LibraryExportView.as_view(), name="library-export"),
+    path('records/import/', views.LibraryImportView.as_view(), name="library-import"),
+    # async versions of the read endpoints above, see records/async_views.py
+    path('records/async/user-entries/<int:pk>/',
+         async_views.AsyncUserEntryDetail.as_view(), name="async-user-entry-detail"),
+    path('records/async/filter-stickers/',
+         async_views.AsyncFilterStickersView.as_view(), name="async-filter-stickers"),
+    path('records/async/tags/autocomplete/<int:user>/',
+         async_views.AsyncTagAutocompleteView.as_view(), name="async-tag-autocomplete")
 ]
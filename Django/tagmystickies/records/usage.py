@@ -0,0 +1,66 @@
+import math
+import time
+from django.conf import settings
+from django.db import transaction
+from records.models import StickerUsage
+from records.signals import notify_sticker_used
+
+'''
+Usage ranking for the inline results. When a user sends one of their stickers through the bot's inline mode
+(telegram's chosen_inline_result), the bot tells us at /records/stickers/<user>/<sticker>/used/, and filter-stickers
+returns the stickers they use the most first.
+
+A use counts 1 when it happens and half as much every USAGE_HALF_LIFE_DAYS after that, so a sticker that got used a
+lot last year drops below one that got used a few times this week. Decaying every counter as time goes by would mean
+rewriting all of them all the time, so instead the score is kept in log space from a fixed epoch:
+
+    score = log2(sum of 2^(time of the use / half life) over every use)
+
+Time makes every score decay at the same rate, so it never changes their order, only a new use moves a sticker up.
+Recording a use is an update of that one row (score = log2(2^score + 2^now)), and ranking is a plain ORDER BY score.
+The decayed number of uses at any time t is 2^(score - t / half life).
+'''
+
+# 2024-01-01 UTC. scores are in half lives since then, which keeps them small numbers
+EPOCH = 1704067200
+SECONDS_PER_DAY = 86400
+
+
+def use_weight(when):
+    '''
+    the log2 weight of a use at a unix time
+    '''
+    return (when - EPOCH) / (settings.USAGE_HALF_LIFE_DAYS * SECONDS_PER_DAY)
+
+
+def add_use(score, weight):
+    '''
+    log2(2^score + 2^weight) without ever computing the powers, which would overflow after enough half lives
+    '''
+    if score is None:
+        return weight
+    high, low = max(score, weight), min(score, weight)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def recent_uses(score, when=None):
+    '''
+    the decayed number of uses a score stands for at a unix time (now by default)
+    '''
+    return 2 ** (score - use_weight(time.time() if when is None else when))
+
+
+def record_use(user, sticker, when=None):
+    '''
+    Adds one use of a sticker to its score and returns the StickerUsage
+    '''
+    weight = use_weight(time.time() if when is None else when)
+    with transaction.atomic():
+        usage, created = StickerUsage.objects.select_for_update().get_or_create(
+            user_id=user, sticker=sticker, defaults={'score': weight, 'uses': 1})
+        if not created:
+            usage.score = add_use(usage.score, weight)
+            usage.uses += 1
+            usage.save(update_fields=['score', 'uses'])
+    notify_sticker_used(user, sticker, usage.score)
+    return usage
@@ -1,9 +1,25 @@
 from django.shortcuts import render, get_object_or_404
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .serializers import StickerSerializer, StickerTagEntrySerializer, TagSerializer, UserEntrySerializer, UserStickerTagSerializer, StickerFilterSerializer
+from .serializers import StickerTagEntrySerializer, TagSerializer, UserEntrySerializer, StickerFilterSerializer
 from .models import StickerTagEntry, UserEntry
+from .signals import notify_tags_changed
+from .tag_index import tag_index, tag_index_enabled
+from .response_cache import filter_cache
+from .inline_snapshots import snapshot_page, snapshot_tag
+from .bulk import bulk_tag, clean_tags, rename_tag, set_tags, tag_set, untag_set
+from .batch import clean_operations, run_batch
+from .write_behind import SeesPendingWrites, defer, write_behind
+from .usage import recent_uses, record_use
+from .tag_stats import delete_entries, user_stats
+from .renderers import fast_parsers, fast_renderers
+from .ndjson import CONTENT_TYPE as NDJSON, Importer, export_lines
+from .pagination import StickerTagEntryPagination, UserEntryPagination
+from .fuzzy import expand_from_database
+from .streaming import library_parts, streaming_response
+from .filtering import AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_MAX_LIMIT, MATCH_ALL, StickerQuery, autocomplete_queryset, page_from_matches, page_response, sticker_queryset
 from rest_framework import generics, mixins, status, request
 
 '''
@@ -14,9 +30,10 @@ Others are more manual, like the ones using APIView.
 '''
 
 
-class UserEntryList(generics.ListCreateAPIView):
+class UserEntryList(SeesPendingWrites, generics.ListCreateAPIView):
     '''
     lists all user entries or creates a new one (GET and POST). Accepts "user" and "chat" query parameters in the URL for filtering. e.g. ?user=93648736&chat=39463847.
+    Add ?page_size= to get the list a page at a time, and follow the "next" link to the next page.
 
     Supply an object with user field, chat field, and an optional status field when POSTing.
     Example: {"user":1234,"chat":3845,"status":"This is my status".}
@@ -27,6 +44,11 @@ class UserEntryList(generics.ListCreateAPIView):
 
     # this is defined in a specific way so that the generic view can use it
     serializer_class = UserEntrySerializer
+    # the bot looks users up all the time, so these get the fast formats (see records/renderers.py)
+    renderer_classes = fast_renderers()
+    parser_classes = fast_parsers()
+    # ?page_size= pages through the list with a cursor, see records/pagination.py
+    pagination_class = UserEntryPagination
 
     def get_queryset(self):
         '''
@@ -46,19 +68,25 @@ class UserEntryList(generics.ListCreateAPIView):
         return queryset
 
 
-class UserEntryDetail(generics.RetrieveUpdateDestroyAPIView):
+class UserEntryDetail(SeesPendingWrites, generics.RetrieveUpdateDestroyAPIView):
     '''
     Deletes, updates, patches, or displays a single, specific user entry
     '''
     queryset = UserEntry.objects.all()
     serializer_class = UserEntrySerializer
+    renderer_classes = fast_renderers()
+    parser_classes = fast_parsers()
 
 
-class StickerTagEntryList(generics.ListCreateAPIView):
+class StickerTagEntryList(SeesPendingWrites, generics.ListCreateAPIView):
     '''
     lists all the sticker tag entries or creates a new one. Filterable with "tag", "user", "id", and "sticker" query parameters. 
+    Add ?page_size= to get the list a page at a time, and follow the "next" link to the next page.
     '''
     serializer_class = StickerTagEntrySerializer
+    pagination_class = StickerTagEntryPagination
+    renderer_classes = fast_renderers()
+    parser_classes = fast_parsers()
 
     def get_queryset(self):
         '''
@@ -70,7 +98,7 @@ class StickerTagEntryList(generics.ListCreateAPIView):
         id = self.request.query_params.get('id', None)
         file_id = self.request.query_params.get('file_id', None)
         set_name = self.request.query_params.get('set_name', None)
-        queryset = StickerTagEntry.objects.all()
+        queryset = StickerTagEntry.objects.select_related('sticker_info')
         if id is not None:
             queryset = queryset.filter(id=id)
         if sticker is not None:
@@ -78,9 +106,11 @@ class StickerTagEntryList(generics.ListCreateAPIView):
         if tag is not None:
             queryset = queryset.filter(tag__icontains=tag)
         if file_id is not None:
-            queryset = queryset.filter(file_id__icontains=file_id)
+            queryset = queryset.filter(
+                sticker_info__file_id__icontains=file_id)
         if set_name is not None:
-            queryset = queryset.filter(set_name__icontains=set_name)
+            queryset = queryset.filter(
+                sticker_info__set_name__icontains=set_name)
         if user is not None:
             try:
                 user = int(user)  # Convert user ID to integer
@@ -104,52 +134,65 @@ class StickerTagEntryList(generics.ListCreateAPIView):
             return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
-class StickerTagEntryDetail(generics.RetrieveUpdateDestroyAPIView):
+class StickerTagEntryDetail(SeesPendingWrites, generics.RetrieveUpdateDestroyAPIView):
     '''
     Displays, updates, patches, and deletes a specific Sticker tag entry. Just one at a time.
     '''
-    queryset = StickerTagEntry.objects.all()
+    queryset = StickerTagEntry.objects.select_related('sticker_info')
     serializer_class = StickerTagEntrySerializer
 
 
-class FilterStickersView(APIView):
+class FilterStickersView(SeesPendingWrites, APIView):
     '''
     Returns a list of unique stickers belonging to a user, filtered by tags.
     This view is best for the inline part of the telegram bot.
     Note that POST is used instead of GET.
+
+    Stickers come back in a stable order, the ones the user uses the most first (see StickerUsedView). "match" picks between stickers with any of the tags (the default) and
+    stickers with all of them. Pass "offset" (telegram's inline query offset, empty for the first page) instead of
+    "page" to page with the "next_offset" cursor that every response includes.
+    With "fuzzy" set, misspelled tags match the user's closest tags and "matched_tags" says which ones they matched.
+    "query" takes a boolean query instead of "tags", like "cat (happy | excited) -sad" (see records/tag_query.py).
+    Example: {"user": 1234, "tags": ["cat", "happy"], "match": "all", "offset": ""}
     '''
+    # how many of these a user can make, see records/throttling.py
+    throttle_scope = 'filter'
+    renderer_classes = fast_renderers()
+    parser_classes = fast_parsers()
 
     def post(self, request):
-        user_entry = get_object_or_404(
-            UserEntry, user=request.data.get("user", None))
         data = request.data
+        # repeated queries are answered straight from the cache, see records/response_cache.py
+        cache_key = filter_cache.key_for(data)
+        body = filter_cache.get(cache_key)
+        if body is not None:
+            return Response(body, status=status.HTTP_200_OK)
 
-        try:
-            tags = data.get('tags', [])
-            exclude_tags = data.get('exclude_tags', [])
-            page = data.get('page', 1)
-
-            if tags and len(tags) > 0:
-                tags = [tag.lower().strip() for tag in tags]
-            if exclude_tags and len(exclude_tags) > 0:
-                exclude_tags = [tag.lower().strip() for tag in exclude_tags]
-
-            stickers = StickerTagEntry.objects.filter(user=user_entry.user)
-
-            if tags:
-                stickers = stickers.filter(tag__in=tags)
-            if exclude_tags:
-                stickers = stickers.exclude(tag__in=exclude_tags)
-
-            unique_stickers = list(
-                set(sticker.file_id for sticker in stickers))
+        user_entry = get_object_or_404(
+            UserEntry, user=data.get("user", None))
 
-            # paginate unique_stickers with a max of 50 entries per page
-            start = (page - 1) * 50
-            end = start + 50
-            unique_stickers = unique_stickers[start:end]
+        try:
+            query = StickerQuery.from_data(user_entry.user, data)
+            if query.fuzzy:
+                # see records/fuzzy.py
+                query.matched_tags = tag_index.expand(query.user, query.tags) if tag_index_enabled() \
+                    else expand_from_database(query.user, query.tags)
+
+            if tag_index_enabled():
+                # served from memory, see records/tag_index.py
+                matches = tag_index.match(
+                    query.user, query.terms, query.exclude_tags, match_all=query.match == MATCH_ALL, prefix=query.prefix,
+                    expression=query.expression)
+                rows = page_from_matches(query, matches, tag_index.scores(query.user))
+            elif (tag := snapshot_tag(query)) is not None:
+                # one tag or none: a slice of a stored list, see records/inline_snapshots.py
+                rows = snapshot_page(query, tag)
+            else:
+                rows = sticker_queryset(query)
 
-            return Response({"stickers": unique_stickers}, status=status.HTTP_200_OK)
+            body = page_response(query, rows)
+            filter_cache.set(cache_key, body)
+            return Response(body, status=status.HTTP_200_OK)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -178,6 +221,11 @@ class FilterStickersView(APIView):
                             "required": False,
                             "description": "List of tags to filter stickers"
                         },
+                        "query": {
+                            "type": "string",
+                            "required": False,
+                            "description": "Boolean query used instead of tags, e.g. 'cat (happy | excited) -sad'"
+                        },
                         "exclude_tags": {
                             "type": "array",
                             "required": False,
@@ -187,6 +235,31 @@ class FilterStickersView(APIView):
                             "type": "integer",
                             "required": False,
                             "description": "Page number for pagination (default: 1)"
+                        },
+                        "offset": {
+                            "type": "string",
+                            "required": False,
+                            "description": "Cursor from a previous response's next_offset, empty for the first page. Used instead of page."
+                        },
+                        "match": {
+                            "type": "string",
+                            "required": False,
+                            "description": "'any' to match stickers with any of the tags (default), 'all' to match stickers with all of them"
+                        },
+                        "prefix": {
+                            "type": "boolean",
+                            "required": False,
+                            "description": "Treat the last tag as an unfinished tag that any tag starting with it satisfies"
+                        },
+                        "fuzzy": {
+                            "type": "boolean",
+                            "required": False,
+                            "description": "Match every tag to the user's most similar tags, so typos still find stickers"
+                        },
+                        "ids": {
+                            "type": "boolean",
+                            "required": False,
+                            "description": "Also list the file_unique_id of every sticker in \"ids\", to report uses with"
                         }
                     }
                 }
@@ -195,50 +268,215 @@ class FilterStickersView(APIView):
         )
 
 
-class UserStickerTagList(generics.RetrieveAPIView):
+class TagAutocompleteView(SeesPendingWrites, APIView):
     '''
-    view a user's complete list of stickers and tags
+    Lists a user's tags that start with the "prefix" query parameter, the ones on the most stickers first.
+    Up to "limit" tags are returned (10 by default, 50 at most).
+    e.g. records/tags/autocomplete/1234/?prefix=ha gives {"tags": [{"tag": "happy", "count": 12}, {"tag": "hat", "count": 3}]}
     '''
-    serializer_class = UserStickerTagSerializer
-    queryset = UserEntry.objects.all().prefetch_related('stickers__tags')
+    throttle_scope = 'filter'
+
+    def get(self, request, user):
+        usr = get_object_or_404(UserEntry, user=user)
+        prefix = request.query_params.get('prefix', '').lower().strip()
+        try:
+            limit = min(int(request.query_params.get(
+                'limit', AUTOCOMPLETE_LIMIT)), AUTOCOMPLETE_MAX_LIMIT)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return Response({"error": "limit must be a positive integer."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if tag_index_enabled():
+            # a binary search in the user's sorted tags, see records/tag_index.py
+            tags = tag_index.autocomplete(usr.user, prefix, limit)
+        else:
+            tags = autocomplete_queryset(usr.user, prefix, limit)
+        return Response({"tags": [{"tag": tag, "count": count} for tag, count in tags]}, status=status.HTTP_200_OK)
 
 
-class ManipulateMultiStickerView(APIView):
+class TagStatsView(SeesPendingWrites, APIView):
+    '''
+    How many stickers a user has tagged, and how many have each of their tags, the most common first.
+    These are kept counted as the tags change (see records/tag_stats.py), so this reads one row per tag.
+    e.g. {"user": 1234, "stickers": 40, "tags": [{"tag": "cat", "count": 12}, {"tag": "happy", "count": 3}]}
+    '''
+
+    def get(self, request, user):
+        usr = get_object_or_404(UserEntry, user=user)
+        stickers, tags = user_stats(usr.user)
+        return Response({"user": usr.user, "stickers": stickers,
+                         "tags": [{"tag": tag, "count": count} for tag, count in tags]}, status=status.HTTP_200_OK)
+
+
+class TagRenameView(SeesPendingWrites, APIView):
+    '''
+    Renames one of a user's tags on all of their stickers (POST). If a sticker already has the new tag, the old one
+    is just removed from it, so this also merges two tags into one.
+    Example: {"old_tag": "kitty", "new_tag": "cat"} gives {"renamed": 12, "merged": 3}
+    '''
+    throttle_scope = 'write'
+
+    def post(self, request, user):
+        usr = get_object_or_404(UserEntry, user=user)
+        old_tag = request.data.get('old_tag', None)
+        new_tag = request.data.get('new_tag', None)
+        tags, invalid = clean_tags([old_tag, new_tag])
+        if invalid:
+            return Response({"error": "old_tag and new_tag have to be valid tags.", "invalid_tags": invalid},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(tags) < 2:
+            return Response({"error": "old_tag and new_tag are the same tag."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(rename_tag(usr.user, *tags), status=status.HTTP_200_OK)
+
+
+class StickerSetTagsView(SeesPendingWrites, APIView):
+    '''
+    Works on every sticker a user has in a sticker set at once, so a whole pack can be tagged without listing its stickers.
+    GET lists the tags on them, e.g. {"set_name": "cats", "stickers": 12, "tags": [{"tag": "cat", "count": 12}]}
+    POST {"tags": ["cat", "cute"]} adds tags to all of them, DELETE {"tags": ["cute"]} removes tags from all of them.
+    Only stickers the user has tagged before count as theirs.
+    '''
+    throttle_scope = 'write'
+
+    def get(self, request, user, set_name):
+        usr = get_object_or_404(UserEntry, user=user)
+        stickers, tags = set_tags(usr.user, set_name)
+        if not stickers:
+            return self.not_found(user, set_name)
+        return Response({"set_name": set_name, "stickers": stickers,
+                         "tags": [{"tag": tag, "count": count} for tag, count in tags]}, status=status.HTTP_200_OK)
+
+    def post(self, request, user, set_name):
+        usr = get_object_or_404(UserEntry, user=user)
+        tags, invalid = self.tags(request)
+        if not tags:
+            return Response({"error": "Tags list not supplied or has no valid tags.", "invalid_tags": invalid},
+                            status=status.HTTP_400_BAD_REQUEST)
+        stickers, created = tag_set(usr.user, set_name, tags)
+        if not stickers:
+            return self.not_found(user, set_name)
+        return Response({"set_name": set_name, "stickers": stickers, "created": created,
+                         "skipped": stickers * len(tags) - created, "invalid_tags": invalid}, status=status.HTTP_200_OK)
+
+    def delete(self, request, user, set_name):
+        usr = get_object_or_404(UserEntry, user=user)
+        tags, invalid = self.tags(request)
+        if not tags:
+            return Response({"error": "Tags list not supplied or has no valid tags.", "invalid_tags": invalid},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({"set_name": set_name, "removed": untag_set(usr.user, set_name, tags)},
+                        status=status.HTTP_200_OK)
+
+    def tags(self, request):
+        tags = request.data.get('tags', None)
+        return clean_tags(tags if isinstance(tags, list) else None)
+
+    def not_found(self, user, set_name):
+        return Response({"error": f"user {user} has no stickers in the set {set_name}."},
+                        status=status.HTTP_404_NOT_FOUND)
+
+
+class FilterCacheStatsView(APIView):
+    '''
+    Shows how well the filter-stickers response cache is doing in this server process.
+    e.g. {"enabled": true, "hits": 120, "misses": 30, "invalidations": 4, "hit_rate": 0.8}
+    '''
+
+    def get(self, request):
+        return Response(filter_cache.stats(), status=status.HTTP_200_OK)
+
+
+class UserStickerTagList(SeesPendingWrites, APIView):
+    '''
+    view a user's complete list of stickers and tags. Every sticker is listed once, with all of its tags.
+    The response is streamed straight out of a single grouped query, so big libraries never have to fit in memory.
+    e.g. {"user": 1234, "chat": 3845, "status": "", "stickers": [{"sticker": "abc", "tags": ["cat", "happy"], "set_name": "cats", "file_id": "xyz"}]}
+    '''
+    throttle_scope = 'bulk'
+
+    def get(self, request, user):
+        usr = get_object_or_404(UserEntry, user=user)
+        return streaming_response(request, library_parts(usr))
+
+
+class LibraryExportView(SeesPendingWrites, APIView):
+    '''
+    Streams a user's tag library (records/export/1234/), or every user's (records/export/), as NDJSON.
+    See records/ndjson.py for the format. POST it to records/import/ to load it back in.
+    '''
+    throttle_scope = 'bulk'
+
+    def get(self, request, user=None):
+        if user is not None:
+            get_object_or_404(UserEntry, user=user)
+        response = streaming_response(request, export_lines(user), content_type=NDJSON)
+        response['Content-Disposition'] = f'attachment; filename="tagmystickies-{user or "all"}.ndjson"'
+        return response
+
+
+class LibraryImportView(APIView):
+    '''
+    Imports NDJSON in the format records/export/ gives (POST the file as the request body).
+    Users are created or updated and tags are added, nothing gets deleted. The body is read a chunk at a time, so it
+    can be as big as a whole database export.
+    Returns a report, e.g. {"lines": 3, "users": 1, "stickers": 2, "entries": 5, "rejected": 0, "rejected_lines": []}
+    with an "error" and a 400 status if a chunk couldn't be written (that chunk and everything after it wasn't).
+    '''
+    throttle_scope = 'bulk'
+    # the body gets read a line at a time below, so nothing else may parse it
+    streams_body = True
+
+    def post(self, request):
+        # request.data would read the whole body into memory, the stream gets read a line at a time instead. which
+        # also means SeesPendingWrites can't look for a user in it, so everyone's queued writes go in first
+        write_behind.flush()
+        if request.stream is None:
+            return Response({"error": "No NDJSON body provided."}, status=status.HTTP_400_BAD_REQUEST)
+        report = Importer().run(iter(request.stream.readline, b''))
+        if "error" in report:
+            return Response(report, status=status.HTTP_400_BAD_REQUEST)
+        return Response(report, status=status.HTTP_200_OK)
+
+
+class ManipulateMultiStickerView(SeesPendingWrites, APIView):
     '''
     Some useful multi entry manipulation utility views
     '''
+    throttle_scope = 'write'
 
     def post(self, request, user, sticker):
         '''
         Adds a set of tags to 1 user's sticker
         '''
         usr = get_object_or_404(UserEntry, user=user)
+        # with "Prefer: respond-async" this gets queued and written a moment later, see records/write_behind.py
+        deferred = defer(request, user)
+        if deferred is not None:
+            return deferred
         set_name = request.data.get('set_name', None)
         file_id = request.data.get('file_id', None)
         tags_to_add = request.data.get('tags_to_add', None)
         if (tags_to_add is not None and len(tags_to_add) > 0):
-            for tag in tags_to_add:
-                try:
-                    serializer = StickerTagEntrySerializer(
-                        data={"user": user, "sticker": sticker, "tag": tag, "file_id": file_id, "set_name": set_name})
-                    if not serializer.is_valid(raise_exception=False):
-                        continue
-                    serializer.save()
-                except Exception as e:
-                    continue
+            report = bulk_tag(usr.user, [
+                              {"sticker": sticker, "file_id": file_id, "set_name": set_name}], tags_to_add)
         else:
             return Response({"error": "Tag list not supplied or is empty"}, status=status.HTTP_400_BAD_REQUEST)
-        return Response(status=status.HTTP_200_OK)
+        return Response(report, status=status.HTTP_200_OK)
 
     def delete(self, request, user, sticker):
         '''
         Deletes a user's sticker from the database
         '''
+        deferred = defer(request, user)
+        if deferred is not None:
+            return deferred
         try:
             queryset = StickerTagEntry.objects.filter(
                 user=user, sticker=sticker)
             if queryset.exists():
-                queryset.delete()
+                _, tags = delete_entries(queryset)
+                notify_tags_changed(user, stickers=[sticker], tags=tags)
                 return Response(status=status.HTTP_204_NO_CONTENT)
             else:
                 return Response("Sticker not found for that user.", status=status.HTTP_404_NOT_FOUND)
@@ -251,6 +489,9 @@ class ManipulateMultiStickerView(APIView):
         '''
         Replaces a set of tags on a sticker with another set (delete, then add)
         '''
+        deferred = defer(request, user)
+        if deferred is not None:
+            return deferred
         tags_to_remove = request.data.get('tags_to_remove', None)
         tags_to_add = request.data.get('tags_to_add', None)
         file_id = request.data.get('file_id', None)
@@ -258,8 +499,9 @@ class ManipulateMultiStickerView(APIView):
         if (tags_to_remove is not None):
             validated_tags_to_remove = [tg.lower().strip()
                                         for tg in tags_to_remove]
-            StickerTagEntry.objects.filter(
-                user=user, tag__in=validated_tags_to_remove, sticker=sticker).delete()
+            _, tags = delete_entries(StickerTagEntry.objects.filter(
+                user=user, tag__in=validated_tags_to_remove, sticker=sticker))
+            notify_tags_changed(user, stickers=[sticker], tags=tags)
         if (tags_to_add is not None):
             for tag in tags_to_add:
                 try:
@@ -273,16 +515,20 @@ class ManipulateMultiStickerView(APIView):
         return Response(status=status.HTTP_200_OK)
 
 
-class MultiStickerView(APIView):
+class MultiStickerView(SeesPendingWrites, APIView):
     '''
     Some more utility functions for manipulating multiple stickers at a time.
     '''
+    throttle_scope = 'write'
 
     def post(self, request, user):
         '''
         tag multliple stickers with multiple tags all at once
         '''
         userEntry = get_object_or_404(UserEntry, user=user)
+        deferred = defer(request, user)
+        if deferred is not None:
+            return deferred
         # stickers may need to be an object that has sticker, file_id, and set_name
         stickers = request.data.get('stickers', None)
         tags = request.data.get('tags', None)
@@ -290,24 +536,18 @@ class MultiStickerView(APIView):
             return Response({"error": "Sticker list not supplied or is empty."}, status=status.HTTP_400_BAD_REQUEST)
         if (tags is None) or (len(tags) == 0):
             return Response({"error": "Tags list not supplied or is empty."}, status=status.HTTP_400_BAD_REQUEST)
-        for sticker in stickers:
-            for tag in tags:
-                serializer = StickerTagEntrySerializer(
-                    data={"user": userEntry.user, "sticker": sticker.get("sticker"), "tag": tag, "file_id": sticker.get("file_id"), "set_name": sticker.get("set_name")})
-                if serializer.is_valid():
-                    try:
-                        serializer.save()
-                    except:
-                        continue
-                else:
-                    continue
-        return Response(status=status.HTTP_201_CREATED)
+        # invalid tags and stickers get skipped (and reported) rather than failing the whole request
+        report = bulk_tag(userEntry.user, stickers, tags)
+        return Response(report, status=status.HTTP_201_CREATED)
 
     def delete(self, request, user):
         '''
         Delete a list of stickers belonging to a user
         '''
         usr = get_object_or_404(UserEntry, user=user)
+        deferred = defer(request, user)
+        if deferred is not None:
+            return deferred
         # Ensure the 'stickers' list is provided
         stickers = request.data.get('stickers', None)
         if stickers is None:
@@ -320,41 +560,69 @@ class MultiStickerView(APIView):
         # Check if the queryset exists and has matching stickers
         if queryset.exists():
             # Delete the stickers found in the queryset
-            queryset.delete()
+            _, tags = delete_entries(queryset)
+            notify_tags_changed(usr, stickers=stickers, tags=tags)
             return Response({"success": "Stickers deleted."}, status=status.HTTP_204_NO_CONTENT)
         else:
             # If no stickers found
             return Response({"error": "No matching stickers found."}, status=status.HTTP_404_NOT_FOUND)
 
 
-class DeleteTagSetView(APIView):
+class StickerUsedView(SeesPendingWrites, APIView):
+    '''
+    Records that a user sent one of their stickers (POST, no body), so it ranks higher in their inline results.
+    The bot calls this from telegram's chosen_inline_result. The sticker is its file_unique_id, like in the other urls.
+    Returns how many times they used it ever and lately, e.g. {"sticker": "abc", "uses": 12, "recent_uses": 4.2}
+    '''
+    throttle_scope = 'write'
+
+    def post(self, request, user, sticker):
+        usr = get_object_or_404(UserEntry, user=user)
+        # only stickers they tagged ever show up in their results, so nothing else is worth counting
+        if not StickerTagEntry.objects.filter(user=usr, sticker=sticker).exists():
+            return Response({"error": f"user {user} has no sticker {sticker}."}, status=status.HTTP_404_NOT_FOUND)
+        usage = record_use(usr.user, sticker)
+        return Response({"sticker": sticker, "uses": usage.uses, "recent_uses": round(recent_uses(usage.score), 3)},
+                        status=status.HTTP_200_OK)
+
+
+class DeleteTagSetView(SeesPendingWrites, APIView):
     '''
     view to delete a set of tags from a sticker 
     '''
+    throttle_scope = 'write'
 
     def delete(self, request, user, sticker):
         usr = get_object_or_404(UserEntry, user=user)
+        deferred = defer(request, user)
+        if deferred is not None:
+            return deferred
         sticker = sticker.strip()
         tags_to_remove = request.data.get('tags_to_remove', None)
         if tags_to_remove is None or len(tags_to_remove) < 1:
             return Response({"error": "tag list not supplied or is empty."}, status=status.HTTP_400_BAD_REQUEST)
         validated_tags_to_remove = [a.lower().strip() for a in tags_to_remove]
         try:
-            StickerTagEntry.objects.filter(
-                user=usr, sticker=sticker, tag__in=validated_tags_to_remove).delete()
+            _, tags = delete_entries(StickerTagEntry.objects.filter(
+                user=usr, sticker=sticker, tag__in=validated_tags_to_remove))
+            notify_tags_changed(usr, stickers=[sticker], tags=tags)
         except Exception as e:
             return Response(str(e), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class DeleteMultiTagSetView(APIView):
+class DeleteMultiTagSetView(SeesPendingWrites, APIView):
     '''
     view to delete a set of tags from multiple stickers at once
     '''
+    throttle_scope = 'write'
 
     def delete(self, request, user):
         usr = get_object_or_404(UserEntry, user=user)
+        deferred = defer(request, user)
+        if deferred is not None:
+            return deferred
         tags_to_remove = request.data.get('tags_to_remove', None)
         stickers = request.data.get('stickers', None)
         if tags_to_remove is None or len(tags_to_remove) < 1:
@@ -363,46 +631,95 @@ class DeleteMultiTagSetView(APIView):
             return Response({"error": "Sticker list not supplied or is empty."}, status=status.HTTP_400_BAD_REQUEST)
         validated_tags_to_remove = [a.lower().strip() for a in tags_to_remove]
         try:
-            StickerTagEntry.objects.filter(
-                user=usr, sticker__in=stickers, tag__in=validated_tags_to_remove).delete()
+            _, tags = delete_entries(StickerTagEntry.objects.filter(
+                user=usr, sticker__in=stickers, tag__in=validated_tags_to_remove))
+            notify_tags_changed(usr, stickers=stickers, tags=tags)
         except Exception as e:
             return Response(str(e), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class MassTagReplaceView(APIView):
+class MassTagReplaceView(SeesPendingWrites, APIView):
     '''
     a view to mass replace multiple tags from multiple stickers.
     '''
+    throttle_scope = 'write'
 
     def patch(self, request, user):
         usr = get_object_or_404(UserEntry, user=user)
+        deferred = defer(request, user)
+        if deferred is not None:
+            return deferred
         tags_to_remove = request.data.get('tags_to_remove', None)
         tags_to_add = request.data.get('tags_to_add', None)
         # sticker may need to be an object that has sticker, file_id, and set_name in it
         stickers = request.data.get('stickers', None)
+        if stickers is None or len(stickers) == 0:
+            return Response({"error": "No or empty stickers list provided."}, status=status.HTTP_400_BAD_REQUEST)
         mapped_stickers = []
         for sticker in stickers:
             mapped_stickers.append(sticker.get("sticker"))
-        if stickers is None or len(stickers) == 0:
-            return Response({"error": "No or empty stickers list provided."}, status=status.HTTP_400_BAD_REQUEST)
 
-        if ((tags_to_remove is not None) and (len(tags_to_remove) > 0)):
-            validated_tags_to_remove = [tg.lower().strip()
-                                        for tg in tags_to_remove]
-            StickerTagEntry.objects.filter(
-                user=user, tag__in=validated_tags_to_remove, sticker__in=mapped_stickers).delete()
-        if (tags_to_add is None) or (len(tags_to_add) < 1):
-            return Response(status=status.HTTP_200_OK)
+        # the removal and the additions either both happen or neither does
+        try:
+            with transaction.atomic():
+                removed = 0
+                if ((tags_to_remove is not None) and (len(tags_to_remove) > 0)):
+                    validated_tags_to_remove = [tg.lower().strip()
+                                                for tg in tags_to_remove]
+                    removed, tags = delete_entries(StickerTagEntry.objects.filter(
+                        user=user, tag__in=validated_tags_to_remove, sticker__in=mapped_stickers))
+                    notify_tags_changed(usr, stickers=mapped_stickers, tags=tags)
+                if (tags_to_add is None) or (len(tags_to_add) < 1):
+                    return Response({"removed": removed}, status=status.HTTP_200_OK)
+
+                report = bulk_tag(usr.user, stickers, tags_to_add)
+        except Exception as e:
+            return Response(str(e), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({"removed": removed, **report}, status=status.HTTP_200_OK)
 
-        for sticker in stickers:
-            for tag in tags_to_add:
-                try:
-                    serializer = StickerTagEntrySerializer(
-                        data={"user": usr.user, "sticker": sticker.get("sticker"), "tag": tag, "file_id": sticker.get("file_id"), "set_name": sticker.get("set_name")})
-                    if not serializer.is_valid():
-                        continue
-                    serializer.save()
-                except Exception as e:
-                    return Response(str(e), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        return Response(status=status.HTTP_200_OK)
+
+class BatchView(SeesPendingWrites, APIView):
+    '''
+    Runs several requests to the other endpoints in one database transaction, in order (POST). See records/batch.py.
+    e.g. {"operations": [{"method": "GET", "path": "/records/user-entries/1234/"},
+                         {"method": "PATCH", "path": "/records/user-entries/1234/", "body": {"status": "tagging"}}]}
+
+    Returns {"committed": true, "results": [{"status": 200, "body": {...}}, ...]} with one result per operation.
+    If an operation fails, nothing in the batch is saved and the response has the failed operation's status, the
+    results up to and including it, "committed": false and "failed" (the index of the operation that failed).
+    '''
+    throttle_scope = 'bulk'
+
+    def post(self, request):
+        operations = request.data.get('operations', None)
+        error = clean_operations(operations)
+        if error is not None:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+        # the operations can be about any number of users, and writes queued while the batch runs wait until after
+        # it (see records/write_behind.py), so everyone's queued writes go in first
+        write_behind.flush()
+        results, committed = run_batch(request, operations)
+        if committed:
+            return Response({"committed": True, "results": results}, status=status.HTTP_200_OK)
+        return Response({"committed": False, "failed": len(results) - 1, "results": results},
+                        status=results[-1]["status"])
+
+
+class WriteOperationView(APIView):
+    '''
+    Whether a write queued with "Prefer: respond-async" has been written yet (see records/write_behind.py).
+    With ?wait=true the user's queued writes get written first, so the answer is never "pending".
+    e.g. {"operation": "3f2a...", "user": 1234, "status": "applied", "method": "POST", "path": "/records/stickers/1234/",
+          "url": "/records/operations/3f2a.../", "result": {"status": 201, "body": {...}}}
+    "status" is "pending", "applied" or "failed", and "result" is what the request got when it was run.
+    '''
+
+    def get(self, request, operation):
+        queued = write_behind.get(operation)
+        if queued is None:
+            return Response({"error": f"no operation {operation}, or it finished too long ago."},
+                            status=status.HTTP_404_NOT_FOUND)
+        if request.query_params.get('wait', '').lower() in ('true', '1'):
+            write_behind.flush([queued.user])
+        return Response(queued.report(), status=status.HTTP_200_OK)
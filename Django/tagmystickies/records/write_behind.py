@@ -0,0 +1,307 @@
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.response import Response
+from records.batch import OperationFailed, in_batch, run_operation
+
+'''
+Write-behind for the tagging endpoints the bot sends bursts of small writes to (MultiStickerView,
+ManipulateMultiStickerView, MassTagReplaceView, ...). Each of those writes takes sqlite's single writer lock on its own.
+
+With WRITE_BEHIND_ENABLED on, a request to one of them that has a "Prefer: respond-async" header isn't run right away.
+It gets queued and answered with 202 Accepted and an operation id. A background thread waits WRITE_BEHIND_DELAY
+seconds for the rest of the burst to arrive, then runs everything that's queued through the same views, many
+operations to a transaction. Every operation runs in its own savepoint, so one that fails doesn't take the others
+with it.
+
+records/operations/<id>/ says whether an operation has been written yet. With ?wait=true it writes the user's queued
+operations right away and answers once they're in the database.
+
+Users always see their own writes: every other request about a user (their filter-stickers, their ste list, one of
+their entries, a write that isn't queued, ...) writes whatever that user has queued before it runs. Views get that
+from SeesPendingWrites.
+
+The queue lives in the server process, like the tag index, so only turn this on when running a single worker.
+Operations that are still queued when the process exits get written on the way out, but a crash loses them, which is
+what waiting on the operation is for.
+'''
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+APPLIED = 'applied'
+FAILED = 'failed'
+
+# the most operations written in one transaction, so a big burst doesn't hold the writer lock for too long
+OPERATIONS_PER_TRANSACTION = 100
+# how many finished operations are remembered for the status endpoint
+KEEP_OPERATIONS = 10000
+
+
+class Operation:
+    '''
+    One queued request, run later with records/batch.py's run_operation()
+    '''
+
+    def __init__(self, user, method, path, body, host, secure=False):
+        self.id = uuid.uuid4().hex
+        self.user = user
+        self.method = method
+        self.path = path
+        self.body = body
+        self.host = host
+        self.secure = secure
+        self.status = PENDING
+        self.result = None
+        self.submitted = time.time()
+        self.finished = None
+
+    def finish(self, status, result):
+        self.status = status
+        self.result = result
+        self.finished = time.time()
+
+    def report(self):
+        report = {"operation": self.id, "user": self.user, "status": self.status, "method": self.method,
+                  "path": self.path, "url": reverse('write-operation', args=[self.id])}
+        if self.result is not None:
+            # the status and body the request got when it was run
+            report["result"] = self.result
+        return report
+
+
+class WriteBehindQueue:
+    '''
+    The queued operations of every user, in the order they came in
+    '''
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._pending = {}  # user -> [Operation]
+        self._pending_count = 0
+        self._applying = set()  # users whose operations some thread is writing right now
+        self._operations = OrderedDict()  # id -> Operation, the last KEEP_OPERATIONS of them
+        self._local = threading.local()
+        self._thread = None
+        # the tests turn the background thread off and flush when they want to
+        self.background = True
+
+    def enabled(self):
+        return settings.WRITE_BEHIND_ENABLED
+
+    def submit(self, user, method, path, body, host, secure=False):
+        '''
+        Queues a request. Returns its Operation, or None if WRITE_BEHIND_MAX_PENDING operations are queued already,
+        in which case the request should be run right away.
+        '''
+        operation = Operation(user, method, path, body, host, secure)
+        with self._lock:
+            if self._pending_count >= settings.WRITE_BEHIND_MAX_PENDING:
+                return None
+            self._pending.setdefault(user, []).append(operation)
+            self._pending_count += 1
+            self._operations[operation.id] = operation
+            while len(self._operations) > KEEP_OPERATIONS:
+                self._operations.popitem(last=False)
+            self._lock.notify_all()
+        self.start()
+        return operation
+
+    def get(self, operation_id):
+        return self._operations.get(operation_id, None)
+
+    def is_empty(self):
+        # read without the lock, it's only ever used to skip taking it
+        return not self._pending and not self._applying
+
+    def has_pending(self, user):
+        return user in self._pending or user in self._applying
+
+    def flush(self, users=None):
+        '''
+        Writes the queued operations of the users (everyone's when None) in this thread. Operations of theirs that
+        another thread is writing already get waited for, so everything they queued before this call is in the
+        database afterwards.
+        '''
+        if getattr(self._local, 'applying', False):
+            # the views the queued operations run through end up here too, and they're written already
+            return
+        if in_batch():
+            # the batch's transaction could still roll back what we'd write and report as written. BatchView writes
+            # everything that's queued before it starts, so only writes queued while it runs wait until after it
+            return
+        with self._lock:
+            wanted = self._applying if users is None else self._applying.intersection(users)
+            while wanted:
+                self._lock.wait()
+                wanted = self._applying if users is None else self._applying.intersection(users)
+            batch = {user: self._pending.pop(user) for user in
+                     (list(self._pending) if users is None else [user for user in users if user in self._pending])}
+            if not batch:
+                return
+            self._pending_count -= sum(len(operations) for operations in batch.values())
+            self._applying.update(batch)
+        try:
+            self.apply(batch)
+        finally:
+            with self._lock:
+                self._applying.difference_update(batch)
+                self._lock.notify_all()
+
+    def apply(self, batch):
+        # a user's operations stay in the same transaction unless there are more than fit in one
+        operations = []
+        for user_operations in batch.values():
+            operations += user_operations
+            if len(operations) >= OPERATIONS_PER_TRANSACTION:
+                self.apply_transaction(operations)
+                operations = []
+        if operations:
+            self.apply_transaction(operations)
+
+    def apply_transaction(self, operations):
+        results = []
+        self._local.applying = True
+        try:
+            with transaction.atomic():
+                for operation in operations:
+                    try:
+                        with transaction.atomic():
+                            code, body = run_operation(
+                                {"method": operation.method, "path": operation.path, "body": operation.body},
+                                operation.host, operation.secure)
+                            if code >= 400:
+                                # rolls back whatever the failed request wrote before it failed
+                                raise OperationFailed()
+                    except OperationFailed:
+                        pass
+                    except Exception as e:
+                        code, body = status.HTTP_500_INTERNAL_SERVER_ERROR, {"error": str(e)}
+                    results.append((operation, code, body))
+        except Exception as e:
+            # the commit failed, so none of them were written
+            logger.exception('write-behind transaction failed')
+            for operation in operations:
+                operation.finish(FAILED, {"status": status.HTTP_500_INTERNAL_SERVER_ERROR, "body": {"error": str(e)}})
+            return
+        finally:
+            self._local.applying = False
+        for operation, code, body in results:
+            operation.finish(APPLIED if code < 400 else FAILED, {"status": code, "body": body})
+
+    def start(self):
+        '''
+        Starts the background flusher, when write-behind is on and it isn't running yet
+        '''
+        if not self.background or not self.enabled() or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is None:
+                # whatever's still queued gets written when the process exits normally
+                atexit.register(self.flush)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._lock.wait()
+            # lets the rest of the burst arrive, so it all goes into one transaction
+            time.sleep(settings.WRITE_BEHIND_DELAY)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('write-behind flush failed')
+            finally:
+                # this thread never goes through a request, which is what normally closes stale connections
+                close_old_connections()
+
+
+write_behind = WriteBehindQueue()
+
+
+def wants_write_behind(request):
+    return write_behind.enabled() and 'respond-async' in request.headers.get('Prefer', '')
+
+
+def defer(request, user):
+    '''
+    Queues a write the request asked to have done later. Returns the 202 response for it, or None if the view should
+    run it now.
+    '''
+    if not wants_write_behind(request):
+        return None
+    data = request.data
+    operation = write_behind.submit(user, request.method, request.get_full_path(),
+                                    data.dict() if hasattr(data, 'dict') else data,
+                                    request.get_host(), request.is_secure())
+    if operation is None:
+        # the queue is full, so it runs now. after the user's queued writes, which it has to come after
+        write_behind.flush([user])
+        return None
+    return Response(operation.report(), status=status.HTTP_202_ACCEPTED,
+                    headers={'Location': operation.report()["url"], 'Preference-Applied': 'respond-async'})
+
+
+def request_user(request, kwargs, body=True):
+    '''
+    The user a request is about: from the url, or the "user" in the query string or (unless body is False) the body.
+    None when there isn't one.
+    '''
+    user = kwargs.get('user', None)
+    if user is None:
+        user = request.query_params.get('user', None)
+    if user is None and body and isinstance(request.data, dict):
+        user = request.data.get('user', None)
+    try:
+        return int(user)
+    except (TypeError, ValueError):
+        return None
+
+
+class SeesPendingWrites:
+    '''
+    A mixin for views that read or write a user's tags. Before the request runs, the user's queued writes get written,
+    so they see them. Requests that don't say who they're about in the url or body (like ste/<pk>/) get the user from
+    the object they look up instead, and ones that aren't about any one user don't write anything, so one user's
+    read never waits on everyone else's writes. Requests that are getting queued themselves skip this, they just go
+    in the queue after the others.
+    '''
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if write_behind.is_empty() or wants_write_behind(request):
+            return
+        user = request_user(request, kwargs)
+        if user is not None:
+            write_behind.flush([user])
+
+    def get_object(self):
+        obj = super().get_object()
+        if write_behind.is_empty() or wants_write_behind(self.request):
+            return obj
+        # a UserEntry's user is its primary key, everything else has a foreign key to it
+        user = getattr(obj, 'user_id', getattr(obj, 'user', None))
+        if user is not None and write_behind.has_pending(user):
+            write_behind.flush([user])
+            # the queued writes could have changed or deleted it
+            obj = super().get_object()
+        return obj
+
+
+async def asee_pending_writes(user):
+    '''
+    SeesPendingWrites for the async views. Only leaves the event loop when the user has writes queued.
+    '''
+    if not write_behind.is_empty() and write_behind.has_pending(user):
+        await sync_to_async(write_behind.flush)([user])
@@ -10,8 +10,10 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+from importlib.util import find_spec
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -49,6 +51,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so it times everything below it (see records/metrics.py)
+    'records.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,12 +86,69 @@ WSGI_APPLICATION = 'tagmystickies.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# STORAGE_PROFILE picks how the database is set up:
+# - sqlite-tuned (the default): one sqlite file in WAL mode with the pragmas below, so the bot's writes don't block
+#   inline query reads, transactions that wait for each other instead of failing, and connections that stay open
+#   between requests
+# - sqlite-plain: django's stock sqlite setup, for comparing against
+# - postgresql: for when we outgrow a single file, configured with the DATABASE_* settings
+STORAGE_PROFILE = config('STORAGE_PROFILE', default='sqlite-tuned', cast=str)
+STORAGE_PROFILES = ['sqlite-tuned', 'sqlite-plain', 'postgresql']
+if STORAGE_PROFILE not in STORAGE_PROFILES:
+    raise ImproperlyConfigured(
+        f'STORAGE_PROFILE must be one of {STORAGE_PROFILES}, not {STORAGE_PROFILE!r}.')
+
+if STORAGE_PROFILE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': config('DATABASE_NAME', default='tagmystickies', cast=str),
+            'USER': config('DATABASE_USER', default='', cast=str),
+            'PASSWORD': config('DATABASE_PASSWORD', default='', cast=str),
+            'HOST': config('DATABASE_HOST', default='', cast=str),
+            'PORT': config('DATABASE_PORT', default='', cast=str),
+        }
     }
-}
+else:
+    DATABASES = {
+        'default': {
+            # sqlite-tuned starts transactions with SQLITE_TRANSACTION_MODE (see records/backends/sqlite3/base.py)
+            'ENGINE': 'records.backends.sqlite3' if STORAGE_PROFILE == 'sqlite-tuned' else 'django.db.backends.sqlite3',
+            'NAME': config('DATABASE_NAME', default=str(BASE_DIR / 'db.sqlite3'), cast=str),
+        }
+    }
+
+if STORAGE_PROFILE != 'sqlite-plain':
+    # seconds a connection is kept open for the next request (0 closes it after every request). every thread keeps its
+    # own, django closes it at the end of a request if it's too old or broken. with sqlite that's safe too: between
+    # requests a connection is in autocommit mode with no transaction open, so it doesn't hold a WAL read snapshot or
+    # a lock, just the open file and its page cache, which is what makes the next request on that thread faster
+    DATABASES['default']['CONN_MAX_AGE'] = config('DATABASE_CONN_MAX_AGE', default=600, cast=int)
+    # a connection that died while it sat around gets replaced instead of failing the next request
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+# the pragmas every sqlite connection gets when it's opened (see records/storage.py)
+SQLITE_PRAGMAS = {}
+if STORAGE_PROFILE == 'sqlite-tuned':
+    SQLITE_PRAGMAS = {
+        # readers never wait for a writer and a writer never waits for readers
+        'journal_mode': config('SQLITE_JOURNAL_MODE', default='wal', cast=str),
+        # in WAL mode "normal" can only lose the last transactions in a power cut, it can't corrupt anything
+        'synchronous': config('SQLITE_SYNCHRONOUS', default='normal', cast=str),
+        # bytes of the file that get read through memory mapping instead of read() calls
+        'mmap_size': config('SQLITE_MMAP_SIZE', default=256 * 1024 * 1024, cast=int),
+        # negative means KiB, so this is a 64MB page cache per connection
+        'cache_size': config('SQLITE_CACHE_SIZE', default=-64000, cast=int),
+        # milliseconds to wait for a lock before giving up with "database is locked"
+        'busy_timeout': config('SQLITE_BUSY_TIMEOUT', default=5000, cast=int),
+    }
+
+# how sqlite-tuned starts a transaction. IMMEDIATE takes the write lock right away, so a transaction that reads before
+# it writes waits out busy_timeout for another writer instead of failing with "database is locked"
+SQLITE_TRANSACTION_MODE = config('SQLITE_TRANSACTION_MODE', default='IMMEDIATE', cast=str).upper()
+if SQLITE_TRANSACTION_MODE not in ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE'):
+    raise ImproperlyConfigured(
+        f'SQLITE_TRANSACTION_MODE must be DEFERRED, IMMEDIATE or EXCLUSIVE, not {SQLITE_TRANSACTION_MODE!r}.')
 
 
 # Password validation
@@ -130,3 +191,161 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Tag index
+# An in-memory index of every user's tags that the inline mode gets answered from (see records/tag_index.py).
+# Every server process keeps its own copy, so turn it off if you run more than one worker.
+
+TAG_INDEX_ENABLED = config('TAG_INDEX_ENABLED', default=True, cast=bool)
+
+# the memory cap, counted in (sticker, tag) pairs across all cached users
+TAG_INDEX_MAX_ENTRIES = config('TAG_INDEX_MAX_ENTRIES', default=500000, cast=int)
+
+# Caches
+# Both are per process. The throttle buckets (see THROTTLE_CACHE below) get a cache of their own, so clearing them
+# doesn't take the filter cache with it.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'throttle': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'throttle',
+    },
+}
+
+# Filter cache
+# Caches whole filter-stickers responses until the user's tags change (see records/response_cache.py).
+# It uses the default cache, which is per process unless CACHES says otherwise.
+
+FILTER_CACHE_ENABLED = config('FILTER_CACHE_ENABLED', default=True, cast=bool)
+
+# how long a cached response is kept, in seconds
+FILTER_CACHE_TIMEOUT = config('FILTER_CACHE_TIMEOUT', default=300, cast=int)
+
+# Fuzzy matching
+# With the tag index off, fuzzy mode keeps each user's trigram index until their tags change (see records/fuzzy.py).
+
+# the memory cap, counted in tags across all cached users
+FUZZY_INDEX_MAX_TAGS = config('FUZZY_INDEX_MAX_TAGS', default=100000, cast=int)
+
+# List paging
+# The user-entries and ste list endpoints page with a cursor when asked to (see records/pagination.py).
+
+# rows per page when the request doesn't say
+LIST_PAGE_SIZE = config('LIST_PAGE_SIZE', default=100, cast=int)
+
+# the biggest page_size a request can ask for
+LIST_MAX_PAGE_SIZE = config('LIST_MAX_PAGE_SIZE', default=1000, cast=int)
+
+# Metrics
+# Per route latency, query counts, response sizes and status codes, served at /metrics (see records/metrics.py).
+
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+
+# when running more than one worker, a directory they can all write to, so /metrics can add up all of their counters.
+# only delete it while the server is stopped (see records/metrics.py for what's in it)
+METRICS_DIR = config('METRICS_DIR', default='', cast=str)
+
+# Usage ranking
+# Inline results are ordered by how much the user has been using each sticker lately (see records/usage.py).
+
+# how many days it takes for a use to count half as much
+USAGE_HALF_LIFE_DAYS = config('USAGE_HALF_LIFE_DAYS', default=14, cast=float)
+
+# API formats
+# What the API can answer in (picked by the request's Accept header, the first one is the default) and the matching
+# request body parsers (see records/renderers.py):
+# - json: rest framework's own JSON
+# - orjson: the same JSON, several times faster to encode (pip install orjson)
+# - msgpack: MessagePack, smaller and faster still, for clients that ask for application/msgpack (pip install msgpack)
+# - browsable: rest framework's HTML pages for trying the API out in a browser
+# Formats whose package isn't installed get left out.
+
+API_RENDERERS = config('API_RENDERERS', default='json,browsable', cast=Csv())
+
+# the same for the endpoints the bot hits the most: filter-stickers, user entry lookups and the ste list.
+# user-sticker-tag-list (which streams its JSON) and the records/async/ views use orjson when it's in here
+FAST_API_RENDERERS = config('FAST_API_RENDERERS', default='orjson,msgpack,json', cast=Csv())
+
+API_FORMATS = {
+    # name: (renderer, parser, the package it needs)
+    'json': ('rest_framework.renderers.JSONRenderer', 'rest_framework.parsers.JSONParser', None),
+    'orjson': ('records.renderers.ORJSONRenderer', 'records.renderers.ORJSONParser', 'orjson'),
+    'msgpack': ('records.renderers.MessagePackRenderer', 'records.renderers.MessagePackParser', 'msgpack'),
+    'browsable': ('rest_framework.renderers.BrowsableAPIRenderer', None, None),
+}
+
+
+def api_formats(names, setting):
+    '''
+    the renderer and parser classes for a list of format names
+    '''
+    unknown = set(names) - set(API_FORMATS)
+    if unknown:
+        raise ImproperlyConfigured(
+            f'{setting} can only have {", ".join(API_FORMATS)} in it, not {", ".join(sorted(unknown))}.')
+    formats = [API_FORMATS[name] for name in names if API_FORMATS[name][2] is None or find_spec(API_FORMATS[name][2])]
+    if not formats:
+        raise ImproperlyConfigured(f'none of the formats in {setting} are installed.')
+    renderers = [renderer for renderer, _, _ in formats]
+    # form bodies are always accepted, like rest framework does by default
+    parsers = [parser for _, parser, _ in formats if parser] + [
+        'rest_framework.parsers.FormParser', 'rest_framework.parsers.MultiPartParser']
+    return renderers, parsers
+
+
+API_RENDERER_CLASSES, API_PARSER_CLASSES = api_formats(API_RENDERERS, 'API_RENDERERS')
+FAST_API_RENDERER_CLASSES, FAST_API_PARSER_CLASSES = api_formats(FAST_API_RENDERERS, 'FAST_API_RENDERERS')
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': API_RENDERER_CLASSES,
+    'DEFAULT_PARSER_CLASSES': API_PARSER_CLASSES,
+    # does nothing unless THROTTLE_ENABLED is on, see below
+    'DEFAULT_THROTTLE_CLASSES': ['records.throttling.TokenBucketThrottle'],
+}
+
+# Write-behind
+# Tag writes sent with a "Prefer: respond-async" header get queued, answered with 202 Accepted, and written a moment
+# later together with whatever else came in meanwhile, in shared transactions (see records/write_behind.py).
+# The queue lives in the server process, so only turn this on when running a single worker.
+
+WRITE_BEHIND_ENABLED = config('WRITE_BEHIND_ENABLED', default=False, cast=bool)
+
+# how many seconds the background thread waits for more writes before writing what's queued
+WRITE_BEHIND_DELAY = config('WRITE_BEHIND_DELAY', default=0.05, cast=float)
+
+# with this many writes queued, new ones get written right away instead
+WRITE_BEHIND_MAX_PENDING = config('WRITE_BEHIND_MAX_PENDING', default=1000, cast=int)
+
+# Rate limiting
+# Every user gets a token bucket per kind of endpoint, and requests past it get a 429 with Retry-After
+# (see records/throttling.py). Rates are like rest framework's: "20/s", "100/min", "1000/hour". A rate lets that many
+# requests through at once and then refills at that pace. Leave one empty to not limit that kind.
+
+THROTTLE_ENABLED = config('THROTTLE_ENABLED', default=False, cast=bool)
+
+THROTTLE_RATES = {
+    # filter-stickers and tag autocomplete, sync and async
+    'filter': config('THROTTLE_RATE_FILTER', default='20/s', cast=str),
+    # everything that changes tags
+    'write': config('THROTTLE_RATE_WRITE', default='10/s', cast=str),
+    # export, import, the whole tag list, and batches
+    'bulk': config('THROTTLE_RATE_BULK', default='10/min', cast=str),
+    # the rest
+    'default': config('THROTTLE_RATE_DEFAULT', default='30/s', cast=str),
+}
+
+# the cache the buckets are kept in, an alias from CACHES. the throttle cache is per process, point this at a shared
+# one so every worker counts against the same buckets. keep it to the buckets, clearing them empties the whole cache
+THROTTLE_CACHE = config('THROTTLE_CACHE', default='throttle', cast=str)
+
+# Inline snapshots
+# filter-stickers answers queries with one tag (or none) from a stored, ready-ordered list of the user's stickers with
+# that tag, when the tag index is off (see records/inline_snapshots.py).
+
+INLINE_SNAPSHOTS_ENABLED = config('INLINE_SNAPSHOTS_ENABLED', default=True, cast=bool)
+
+# seconds after which a snapshot gets rebuilt even if nothing said it changed
+INLINE_SNAPSHOT_MAX_AGE = config('INLINE_SNAPSHOT_MAX_AGE', default=3600, cast=int)
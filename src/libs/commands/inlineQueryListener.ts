@@ -3,8 +3,14 @@
  * The first sticker in the list should always be a randomly chosen one.
  */
 
-import { filterStickers } from "libs/database/databaseActions.js";
-import { FilterStickersInput } from "libs/database/databaseModels.js";
+import {
+  filterStickers,
+  recordStickerUsage,
+} from "libs/database/databaseActions.js";
+import {
+  FilterStickersInput,
+  FilterStickersResult,
+} from "libs/database/databaseModels.js";
 import TelegramBot, { InlineQueryResult } from "node-telegram-bot-api";
 import { devLog } from "libs/logging.js";
 import { parseTagsFromString } from "libs/utilities/parseTagsUtils.js";
@@ -42,6 +48,7 @@ export function setupInlineQueryListener(bot: TelegramBot) {
       exclude_tags: [],
       page: 1,
       user: 0,
+      ids: true, // the ids become the result ids, so chosen_inline_result can tell us which sticker got sent
     }; //necessary for the filterStickers function because I set it up wierd.
 
     let tagsFromQuery = parseTagsFromString(queryText);
@@ -53,7 +60,9 @@ export function setupInlineQueryListener(bot: TelegramBot) {
     input.user = userID;
 
     filterStickers(userID, input)
-      .then((stickerList: string[]) => {
+      .then((result: FilterStickersResult) => {
+        let stickerList = result.stickers;
+        let idList = result.ids ? result.ids : [];
         if (stickerList.length === 0) {
           // Handle empty list case
           bot.answerInlineQuery(queryID, []);
@@ -68,6 +77,12 @@ export function setupInlineQueryListener(bot: TelegramBot) {
           return index != poppedStickerIndex;
         });
         filteredStickerList = [poppedSticker, ...filteredStickerList];
+        // keep the ids lined up with the stickers
+        let poppedId = idList[poppedStickerIndex];
+        let filteredIdList = idList.filter((id, index) => {
+          return index != poppedStickerIndex;
+        });
+        filteredIdList = [poppedId, ...filteredIdList];
 
         //construct the query results object
         for (let i = 0; i < filteredStickerList.length; i++) {
@@ -75,7 +90,7 @@ export function setupInlineQueryListener(bot: TelegramBot) {
           results.push({
             type: "sticker",
             sticker_file_id: sticker_file_id,
-            id: generate64ByteString(),
+            id: filteredIdList[i] ? filteredIdList[i] : generate64ByteString(),
           });
         }
 
@@ -90,4 +105,11 @@ export function setupInlineQueryListener(bot: TelegramBot) {
         devLog("Error filtering stickers in inline query listener.", error);
       });
   });
+
+  // telegram only sends these when inline feedback is turned on for the bot in botfather (/setinlinefeedback)
+  bot.on("chosen_inline_result", (chosen) => {
+    recordStickerUsage(chosen.from.id, chosen.result_id).catch((error) => {
+      devLog("Error recording sticker usage.", error);
+    });
+  });
 }
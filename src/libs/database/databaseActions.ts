@@ -13,8 +13,15 @@ import {
   FilterStickersInput,
   FullUserData,
   Stkr,
+  BatchOperation,
+  BatchResult,
+  FilterStickersResult,
+  StickerSetTags,
+  TagStats,
+  WriteOperation,
 } from "./databaseModels.js";
 import {
+  batchURL,
   listUserEntriesURL,
   deleteMultiTagSetURL,
   deleteTagSetURL,
@@ -23,9 +30,14 @@ import {
   manipulateMultiStickerURL,
   massTagReplaceURL,
   multiStickerURL,
+  stickerSetTagsURL,
+  stickerUsedURL,
+  tagRenameURL,
+  tagStatsURL,
   stickerTagEntryDetailURL,
   userEntryDetailURL,
   userStickerTagListURL,
+  writeOperationURL,
 } from "./urls.js";
 
 interface DatabaseActionResponse<T> {
@@ -501,12 +513,12 @@ export async function getAStickersTags(
  *
  * @param user integer user ID of the user's stickers you want.
  * @param inputData {tags: ["tag1", "tag2"]} object containing a list of tags you want to filter by.
- * @returns Promise<string[]> Returns an array of sticker file ID's
+ * @returns Promise<FilterStickersResult> Returns the sticker file ID's, most used first (and their file_unique_id's if asked for)
  */
 export async function filterStickers(
   user: number,
   inputData: FilterStickersInput
-): Promise<string[]> {
+): Promise<FilterStickersResult> {
   try {
     const response = await fetch(filterStickersURL, {
       method: "POST",
@@ -525,7 +537,7 @@ export async function filterStickers(
       );
     }
 
-    const data: string[] = (await response.json()).stickers;
+    const data: FilterStickersResult = await response.json();
     return data;
   } catch (error) {
     throw error; //Re-throw error for the caller to handle
@@ -646,6 +658,16 @@ export async function deleteMultiTagSet(
   }
 }
 
+/**
+ * The headers for a JSON write, asking for it to be queued when writeBehind is set.
+ * The server answers a queued write with 202 and the operation, and only queues it if it has write-behind on.
+ */
+function writeHeaders(writeBehind: boolean): Record<string, string> {
+  return writeBehind
+    ? { "Content-Type": "application/json", Prefer: "respond-async" }
+    : { "Content-Type": "application/json" };
+}
+
 /**
  * Removes a set of tags and replaces it with another set of tags on multiple stickers at once.
  *
@@ -653,14 +675,16 @@ export async function deleteMultiTagSet(
  * @param stickerList an array of sticker file ID's to be affected
  * @param removeTagList an array of the tags you want to remove from the stickers
  * @param addTagList an array of the tags you want to add to the stickers.
- * @returns void
+ * @param writeBehind queue the change and return right away instead of waiting for it to be written (if the server has write-behind on)
+ * @returns the queued operation when writeBehind is set and the server queued it, see waitForOperation
  */
 export async function massTagReplace(
   user: number,
   stickerList: Stkr[],
   removeTagList: string[],
-  addTagList: string[]
-): Promise<void> {
+  addTagList: string[],
+  writeBehind: boolean = false
+): Promise<WriteOperation | undefined> {
   const data = {
     stickers: stickerList,
     tags_to_remove: removeTagList,
@@ -669,12 +693,14 @@ export async function massTagReplace(
   try {
     const response = await fetch(massTagReplaceURL(user), {
       method: "PATCH",
-      headers: {
-        "Content-Type": "application/json",
-      },
+      headers: writeHeaders(writeBehind),
       body: JSON.stringify(data),
     });
 
+    if (response.status === 202) {
+      return await response.json();
+    }
+
     if (response.status === 404) {
       throw new NotFoundError(`user ${user} not found. (404)`);
     } else if (response.status === 500) {
@@ -686,7 +712,7 @@ export async function massTagReplace(
         `Error while trying to replace multi tag list: ${response.statusText} (${response.status})`
       );
     }
-    return;
+    return undefined;
   } catch (error) {
     throw error; // re-throw error for the caller to handle.
   }
@@ -816,22 +842,26 @@ export async function replaceTagsOnSticker(
  * @param user The user's ID.
  * @param stickers An array of sticker IDs.
  * @param tags An array of tags to apply to the stickers.
- * @returns Promise<void>
+ * @param writeBehind queue the change and return right away instead of waiting for it to be written (if the server has write-behind on)
+ * @returns the queued operation when writeBehind is set and the server queued it, see waitForOperation
  */
 export async function tagMultipleStickers(
   user: number,
   stickers: Stkr[],
-  tags: string[]
-): Promise<void> {
+  tags: string[],
+  writeBehind: boolean = false
+): Promise<WriteOperation | undefined> {
   try {
     const response = await fetch(multiStickerURL(user), {
       method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-      },
+      headers: writeHeaders(writeBehind),
       body: JSON.stringify({ stickers, tags }),
     });
 
+    if (response.status === 202) {
+      return await response.json();
+    }
+
     if (response.status === 400) {
       throw new ValidationError(`Invalid data submitted (400).`);
     } else if (response.status === 404) {
@@ -843,6 +873,7 @@ export async function tagMultipleStickers(
         `Failed to tag stickers: ${response.statusText} (${response.status})`
       );
     }
+    return undefined;
   } catch (error) {
     throw error;
   }
@@ -881,3 +912,267 @@ export async function deleteMultipleStickers(
     throw error;
   }
 }
+
+/**
+ * Runs several operations in one request and one database transaction, in order.
+ * If any of them fails, none of them are saved.
+ *
+ * @param operations the requests to make, e.g. [{method: "PATCH", path: "/records/user-entries/123/", body: {status: "tagging"}}]
+ * @returns Promise<BatchResult[]> the status and body of every operation
+ */
+export async function batchOperations(
+  operations: BatchOperation[]
+): Promise<BatchResult[]> {
+  try {
+    const response = await fetch(batchURL, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify({ operations: operations }),
+    });
+
+    if (response.status === 200) {
+      return (await response.json()).results;
+    }
+    const data = await response.json().catch(() => ({}));
+    const failed =
+      data.failed !== undefined
+        ? `operation ${data.failed}: ${JSON.stringify(data.results[data.failed].body)}`
+        : JSON.stringify(data);
+    if (response.status === 400) {
+      throw new ValidationError(`Batch rolled back, ${failed} (400)`);
+    } else if (response.status === 404) {
+      throw new NotFoundError(`Batch rolled back, ${failed} (404)`);
+    } else if (response.status === 500) {
+      throw new ServerError(`Batch rolled back, ${failed} (500)`);
+    } else {
+      throw new UnknownError(
+        `Batch rolled back, ${failed}: ${response.statusText} (${response.status})`
+      );
+    }
+  } catch (error) {
+    throw error; // Re-throw error for the caller to handle.
+  }
+}
+
+/**
+ * Records that a user sent one of their stickers from the inline results, so it shows up earlier next time.
+ *
+ * @param user integer user ID of the user who sent the sticker
+ * @param sticker the sticker's file_unique_id
+ * @returns void
+ */
+export async function recordStickerUsage(
+  user: number,
+  sticker: string
+): Promise<void> {
+  try {
+    const response = await fetch(stickerUsedURL(user, sticker), {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+    });
+
+    if (response.status === 404) {
+      throw new NotFoundError(
+        `user ${user} or their sticker ${sticker} not found. (404)`
+      );
+    } else if (response.status === 500) {
+      throw new ServerError("Server error while recording sticker usage. (500)");
+    } else if (!response.ok) {
+      throw new UnknownError(
+        `Failed to record sticker usage: ${response.statusText} (${response.status})`
+      );
+    }
+  } catch (error) {
+    throw error; // Re-throw error for the caller to handle.
+  }
+}
+
+/**
+ * Renames one of a user's tags on every sticker that has it. Stickers that already have the new tag just lose the old one.
+ *
+ * @param user integer user ID of the user whose tag you want to rename
+ * @param oldTag the tag to rename
+ * @param newTag what to rename it to
+ * @returns Promise<{renamed: number, merged: number}> how many stickers got the tag renamed, and how many had both tags
+ */
+export async function renameTag(
+  user: number,
+  oldTag: string,
+  newTag: string
+): Promise<{ renamed: number; merged: number }> {
+  try {
+    const response = await fetch(tagRenameURL(user), {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify({ old_tag: oldTag, new_tag: newTag }),
+    });
+
+    if (response.status === 404) {
+      throw new NotFoundError(`user ${user} not found. (404)`);
+    } else if (response.status === 400) {
+      throw new ValidationError(
+        `Invalid tags: ${JSON.stringify(await response.json())} (400)`
+      );
+    } else if (response.status === 500) {
+      throw new ServerError("Server error while renaming a tag. (500)");
+    } else if (!response.ok) {
+      throw new UnknownError(
+        `Failed to rename tag: ${response.statusText} (${response.status})`
+      );
+    }
+
+    return await response.json();
+  } catch (error) {
+    throw error; // Re-throw error for the caller to handle.
+  }
+}
+
+/**
+ * Sends a list of tags to the sticker set endpoint and handles its errors.
+ */
+async function stickerSetRequest(
+  method: "GET" | "POST" | "DELETE",
+  user: number,
+  setName: string,
+  tags?: string[]
+): Promise<any> {
+  const response = await fetch(stickerSetTagsURL(user, setName), {
+    method,
+    headers: {
+      "Content-Type": "application/json",
+    },
+    body: tags === undefined ? undefined : JSON.stringify({ tags }),
+  });
+
+  if (response.status === 404) {
+    throw new NotFoundError(
+      `user ${user} or their stickers in ${setName} not found. (404)`
+    );
+  } else if (response.status === 400) {
+    throw new ValidationError(
+      `Invalid tags: ${JSON.stringify(await response.json())} (400)`
+    );
+  } else if (response.status === 500) {
+    throw new ServerError("Server error while working on a sticker set. (500)");
+  } else if (!response.ok) {
+    throw new UnknownError(
+      `Failed to work on a sticker set: ${response.statusText} (${response.status})`
+    );
+  }
+  return await response.json();
+}
+
+/**
+ * Lists the tags on every sticker a user has in a sticker set.
+ *
+ * @param user integer user ID
+ * @param setName the sticker set's name
+ * @returns Promise<StickerSetTags> how many of the set's stickers they tagged, and the tags on them
+ */
+export async function getStickerSetTags(
+  user: number,
+  setName: string
+): Promise<StickerSetTags> {
+  return await stickerSetRequest("GET", user, setName);
+}
+
+/**
+ * Adds tags to every sticker a user has in a sticker set, without listing the stickers.
+ *
+ * @param user integer user ID
+ * @param setName the sticker set's name
+ * @param tags the tags to add
+ * @returns Promise with how many stickers the set has, how many tags were added and skipped, and the invalid tags
+ */
+export async function tagStickerSet(
+  user: number,
+  setName: string,
+  tags: string[]
+): Promise<{ stickers: number; created: number; skipped: number; invalid_tags: string[] }> {
+  return await stickerSetRequest("POST", user, setName, tags);
+}
+
+/**
+ * Removes tags from every sticker a user has in a sticker set.
+ *
+ * @param user integer user ID
+ * @param setName the sticker set's name
+ * @param tags the tags to remove
+ * @returns Promise<{removed: number}> how many tags were removed
+ */
+export async function untagStickerSet(
+  user: number,
+  setName: string,
+  tags: string[]
+): Promise<{ removed: number }> {
+  return await stickerSetRequest("DELETE", user, setName, tags);
+}
+
+/**
+ * Gets how many stickers a user has tagged, and how many have each of their tags.
+ *
+ * @param user integer user ID
+ * @returns Promise<TagStats> the counts, the most used tags first
+ */
+export async function getTagStats(user: number): Promise<TagStats> {
+  try {
+    const response = await fetch(tagStatsURL(user));
+
+    if (response.status === 404) {
+      throw new NotFoundError(`user ${user} not found. (404)`);
+    } else if (response.status === 500) {
+      throw new ServerError("Server error while getting tag stats. (500)");
+    } else if (!response.ok) {
+      throw new UnknownError(
+        `Failed to get tag stats: ${response.statusText} (${response.status})`
+      );
+    }
+
+    return await response.json();
+  } catch (error) {
+    throw error; // Re-throw error for the caller to handle.
+  }
+}
+
+/**
+ * Waits until a write queued with writeBehind has been written to the database.
+ * The user's own reads always see their queued writes already, this is for when it has to be durable.
+ *
+ * @param operation the operation ID a queued write returned
+ * @returns Promise<WriteOperation> the operation, with the status and body the write got
+ */
+export async function waitForOperation(
+  operation: string
+): Promise<WriteOperation> {
+  try {
+    const response = await fetch(`${writeOperationURL(operation)}?wait=true`);
+
+    if (response.status === 404) {
+      throw new NotFoundError(`operation ${operation} not found. (404)`);
+    } else if (!response.ok) {
+      throw new UnknownError(
+        `Failed to check on operation ${operation}: ${response.statusText} (${response.status})`
+      );
+    }
+
+    const data: WriteOperation = await response.json();
+    if (data.status === "failed") {
+      const message = `queued ${data.method} ${data.path} failed: ${JSON.stringify(data.result?.body)}`;
+      if (data.result?.status === 400) {
+        throw new ValidationError(`${message} (400)`);
+      } else if (data.result?.status === 404) {
+        throw new NotFoundError(`${message} (404)`);
+      }
+      throw new ServerError(`${message} (${data.result?.status})`);
+    }
+    return data;
+  } catch (error) {
+    throw error; // Re-throw error for the caller to handle.
+  }
+}
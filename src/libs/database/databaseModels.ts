@@ -37,6 +37,13 @@ export interface FilterStickersInput {
   exclude_tags?: string[];
   page?: number;
   user: number;
+  ids?: boolean; // also return the file_unique_id of every sticker
+  query?: string; // a boolean query used instead of tags, like "cat (happy | excited) -sad"
+}
+
+export interface FilterStickersResult {
+  stickers: string[]; // file_ids, the stickers the user uses the most come first
+  ids?: string[]; // the stickers' file_unique_ids, in the same order. only there when the input asked for ids
 }
 
 export interface StickerWithTags {
@@ -69,3 +76,36 @@ export interface UserState {
   tags_to_remove?: string[];
   messages_to_delete?: number[];
 }
+
+export interface BatchOperation {
+  method: "GET" | "POST" | "PUT" | "PATCH" | "DELETE";
+  path: string; // the path of a records endpoint, e.g. /records/user-entries/123/
+  body?: object;
+}
+
+export interface BatchResult {
+  status: number;
+  body: any;
+}
+
+export interface StickerSetTags {
+  set_name: string;
+  stickers: number; // how many of the set's stickers the user has tagged
+  tags: { tag: string; count: number }[]; // the tags on them, the most common first
+}
+
+export interface TagStats {
+  user: number;
+  stickers: number; // how many stickers the user has tagged
+  tags: { tag: string; count: number }[]; // every tag with how many stickers have it, the most common first
+}
+
+export interface WriteOperation {
+  operation: string; // the ID to check on it with
+  user: number;
+  status: "pending" | "applied" | "failed";
+  method: string;
+  path: string;
+  url: string;
+  result?: BatchResult; // what the request got when it was written
+}
@@ -53,6 +53,13 @@ export const manipulateMultiStickerURL = (
   sticker: string
 ): string => `${APIURL}/records/stickers/${userId}/${sticker}/`;
 
+/**
+ * For recording that a user sent one of their stickers, so it ranks higher in their inline results (POST).
+ * Replace `%d` with the user's ID and `%s` with the sticker identifier.
+ */
+export const stickerUsedURL = (userId: number, sticker: string): string =>
+  `${APIURL}/records/stickers/${userId}/${sticker}/used/`;
+
 /**
  * For adding or removing tags across multiple stickers at once (POST or DELETE).
  * Replace `%d` with the user's ID.
@@ -80,3 +87,37 @@ export const deleteMultiTagSetURL = (userId: number): string =>
  */
 export const massTagReplaceURL = (userId: number): string =>
   `${APIURL}/records/stickers/tags/mass-replace/${userId}/`;
+
+/**
+ * For running several of the requests above in one database transaction (POST).
+ * Provide a JSON body with the operations in order: {"operations": [{"method": "GET", "path": "/records/user-entries/123/"}]}
+ */
+export const batchURL = `${APIURL}/records/batch/`;
+
+/**
+ * For renaming one of a user's tags on all of their stickers, merging it into the new tag where a sticker has both (POST).
+ * Replace `%d` with the user's ID.
+ */
+export const tagRenameURL = (userId: number): string =>
+  `${APIURL}/records/tags/rename/${userId}/`;
+
+/**
+ * For listing (GET), adding (POST) or removing (DELETE) tags on every sticker a user has in a sticker set.
+ * Replace `%d` with the user's ID and `%s` with the set's name.
+ */
+export const stickerSetTagsURL = (userId: number, setName: string): string =>
+  `${APIURL}/records/sets/${userId}/${encodeURIComponent(setName)}/tags/`;
+
+/**
+ * For how many stickers a user has tagged, and how many have each tag (GET).
+ * Replace `%d` with the user's ID.
+ */
+export const tagStatsURL = (userId: number): string =>
+  `${APIURL}/records/tags/stats/${userId}/`;
+
+/**
+ * For checking on a write that was queued with "Prefer: respond-async" (GET). Add ?wait=true to wait until it's written.
+ * Replace `%s` with the operation ID from the 202 response.
+ */
+export const writeOperationURL = (operation: string): string =>
+  `${APIURL}/records/operations/${operation}/`;